@@ -0,0 +1,83 @@
+"""
+Benchmark the ingest and transform paths without a live Nightscout site. Synthetic entries are recorded
+with the ReplayLoader, then ingested into storage and transformed into glucose measurements. Prints the
+throughput of both paths in rows per second.
+
+Pass --recording to replay an earlier recording (see `glucose record`) instead of synthetic entries.
+Uses the MongoDB server configured in MONGO_URI, or mongomock with --mock. Pass --storage parquet or
+--storage memory to benchmark the ParquetStorage or the InMemoryStorage instead.
+
+Run from the project root: python -m benchmarks.bench_ingest --days 365
+"""
+import tempfile
+from datetime import datetime, timedelta
+from typing import List
+
+import click
+
+from benchmarks.common import benchmark_ingester, storage_options, timed
+from predicting_glucose_levels.data.ingestion.loader.replay_loader import ReplayLoader
+from predicting_glucose_levels.data.metadata import Metadata
+from predicting_glucose_levels.data.transformation.transformer.transformers.glucose_measurements_transformer import (
+    GlucoseMeasurementTransformer,
+)
+
+
+def synthetic_entries(days: int) -> List[dict]:
+    """
+    Generate 5-minute CGM entries, as returned by Nightscout, for the last days.
+    """
+    start = datetime.now().replace(microsecond=0) - timedelta(days=days)
+    entries = []
+    for i in range(days * 24 * 12):
+        timestamp = start + timedelta(minutes=5 * i)
+        entries.append(
+            {
+                "_id": f"{i:024x}",
+                "date": int(timestamp.timestamp() * 1000),
+                "dateString": timestamp.isoformat(),
+                "delta": 1.5,
+                "device": "benchmark",
+                "direction": "Flat",
+                "sgv": 100 + i % 150,
+                "sysTime": timestamp.isoformat(),
+                "type": "sgv",
+                "utcOffset": 0,
+            }
+        )
+    return entries
+
+
+@click.command()
+@click.option("--days", default=30, help="Days of synthetic entries.")
+@click.option("--recording", help="Directory of a recording to replay instead.")
+@storage_options
+def main(days: int, recording: str, mock: bool, storage_type: str, chunk_size: int):
+    metadata = Metadata()
+    entries = metadata.get_table("entries")
+    with tempfile.TemporaryDirectory() as directory:
+        if recording is None:
+            recording = directory
+            ReplayLoader.write(
+                directory,
+                entries.endpoint,
+                entries.timestamp_col,
+                synthetic_entries(days),
+            )
+        loader = ReplayLoader(recording)
+        rows = len(
+            loader.load(datetime(2020, 1, 1), datetime.now(), "entries", "dateString")
+        )
+        with benchmark_ingester(
+            loader, metadata, storage_type, mock, directory
+        ) as ingester:
+            timed("ingest", rows, lambda: ingester.ingest([entries]))
+            timed(
+                "transform",
+                rows,
+                lambda: GlucoseMeasurementTransformer(chunk_size=chunk_size).etl(),
+            )
+
+
+if __name__ == "__main__":
+    main()
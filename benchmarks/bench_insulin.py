@@ -0,0 +1,100 @@
+"""
+Benchmark the InsulinInjectionTransformer without a live Nightscout site. Synthetic treatments are recorded
+with the ReplayLoader, then ingested into storage and transformed into insulin injections. Prints the
+throughput of both paths in rows per second.
+
+Each synthetic day has a temporary basal rate every 30 minutes, three meal boluses, a correction, a carb
+correction and a note, like the treatments of a pump user.
+Uses the MongoDB server configured in MONGO_URI, or mongomock with --mock. Pass --storage parquet or
+--storage memory to benchmark the ParquetStorage or the InMemoryStorage instead.
+
+Run from the project root: python -m benchmarks.bench_insulin --mock --storage memory --days 1095
+"""
+import tempfile
+from datetime import datetime, timedelta
+from typing import List
+
+import click
+
+from benchmarks.common import benchmark_ingester, storage_options, timed
+from predicting_glucose_levels.data.ingestion.loader.replay_loader import ReplayLoader
+from predicting_glucose_levels.data.metadata import Metadata
+from predicting_glucose_levels.data.transformation.transformer.transformers.insulin_injection_transformer import (
+    InsulinInjectionTransformer,
+)
+
+
+def synthetic_treatments(days: int) -> List[dict]:
+    """
+    Generate the treatments of a pump user, as returned by Nightscout, for the last days.
+    """
+    start = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    start -= timedelta(days=days)
+    treatments = []
+    for day in range(days):
+        events = [
+            (
+                timedelta(minutes=30 * i),
+                {"eventType": "Temp Basal", "absolute": 0.1 * (i % 12), "duration": 30},
+            )
+            for i in range(48)
+        ]
+        events += [
+            (
+                timedelta(hours=h, minutes=5),
+                {"eventType": "Meal Bolus", "insulin": 2 + day % 5, "carbs": "45"},
+            )
+            for h in [8, 12, 18]
+        ]
+        events += [
+            (
+                timedelta(hours=15, minutes=10),
+                {"eventType": "Correction Bolus", "insulin": 1.5},
+            ),
+            (
+                timedelta(hours=16, minutes=10),
+                {"eventType": "Carb Correction", "carbs": "15"},
+            ),
+            (
+                timedelta(hours=22, minutes=10),
+                {"eventType": "Note", "notes": "benchmark"},
+            ),
+        ]
+        for offset, event in events:
+            timestamp = start + timedelta(days=day) + offset
+            treatments.append(
+                {
+                    "_id": f"{len(treatments):024x}",
+                    "created_at": timestamp.isoformat(),
+                    "enteredBy": "benchmark",
+                    **event,
+                }
+            )
+    return treatments
+
+
+@click.command()
+@click.option("--days", default=365, help="Days of synthetic treatments.")
+@storage_options
+def main(days: int, mock: bool, storage_type: str, chunk_size: int):
+    metadata = Metadata()
+    treatments = metadata.get_table("treatments")
+    with tempfile.TemporaryDirectory() as directory:
+        rows = synthetic_treatments(days)
+        ReplayLoader.write(
+            directory, treatments.endpoint, treatments.timestamp_col, rows
+        )
+        loader = ReplayLoader(directory)
+        with benchmark_ingester(
+            loader, metadata, storage_type, mock, directory
+        ) as ingester:
+            timed("ingest", len(rows), lambda: ingester.ingest([treatments]))
+            timed(
+                "transform",
+                len(rows),
+                lambda: InsulinInjectionTransformer(chunk_size=chunk_size).etl(),
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+Benchmark the MongoStorage upsert path. Compares the old row-by-row update_one loop with the batched
+bulk_write implementation, and prints the throughput of both in rows per second.
+
+Uses the MongoDB server configured in MONGO_URI. Pass --mock to run against mongomock instead. Mongomock
+has no network round trips, so it only shows the Python overhead of both paths.
+
+Run from the project root: python -m benchmarks.bench_mongo_upsert --rows 105000
+"""
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+from typing import Iterable
+
+import click
+import mongomock
+from pymongo import MongoClient
+
+from predicting_glucose_levels.data.metadata import Metadata
+from predicting_glucose_levels.data.storage.mongo_storage import MongoStorage
+
+TABLE = "entries"
+DATABASE = "benchmark"
+
+
+def synthetic_entries(n: int) -> Iterable[dict]:
+    """
+    Generate n entries of 5-minute CGM readings, as returned by Nightscout.
+    """
+    start = datetime(2022, 1, 1)
+    for i in range(n):
+        timestamp = start + timedelta(minutes=5 * i)
+        yield {
+            "_id": f"{i:024x}",
+            "date": int(timestamp.timestamp() * 1000),
+            "dateString": timestamp.isoformat(),
+            "delta": 1.5,
+            "device": "benchmark",
+            "direction": "Flat",
+            "sgv": 100 + i % 150,
+            "type": "sgv",
+            "utcOffset": 0,
+        }
+
+
+def upsert_row_by_row(storage: MongoStorage, data: Iterable[dict]) -> None:
+    """
+    The implementation of MongoStorage._upsert before bulk writes: one update_one per row.
+    """
+    table = storage.database[TABLE]
+    for row in data:
+        table.update_one({"_id": row["_id"]}, {"$set": row}, upsert=True)
+
+
+def run(label: str, rows: int, fn) -> None:
+    start = time.perf_counter()
+    fn(synthetic_entries(rows))
+    duration = time.perf_counter() - start
+    click.echo(
+        f"{label:<12} {rows} rows in {duration:.2f}s: {rows / duration:,.0f} rows/s"
+    )
+
+
+@click.command()
+@click.option("--rows", default=105_000, help="Number of rows to upsert.")
+@click.option("--batch-size", default=1000, help="Batch size of the bulk path.")
+@click.option("--mock", is_flag=True, help="Use mongomock instead of MONGO_URI.")
+def main(rows: int, batch_size: int, mock: bool):
+    client = (
+        mongomock.MongoClient()
+        if mock
+        else MongoClient(
+            os.getenv("MONGO_URI"),
+            username=os.getenv("MONGO_USER"),
+            password=os.getenv("MONGO_PASSWORD"),
+        )
+    )
+    client.drop_database(DATABASE)
+    storage = MongoStorage(
+        client,
+        client[DATABASE],
+        Metadata(),
+        logging.getLogger("benchmark"),
+        batch_size=batch_size,
+    )
+    try:
+        run("row-by-row", rows, lambda data: upsert_row_by_row(storage, data))
+        client.drop_database(DATABASE)
+        run("bulk", rows, lambda data: storage.upsert(data, TABLE))
+    finally:
+        client.drop_database(DATABASE)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+The harness shared by the ingest and transform benchmarks: the command line options, the storage setup and
+the timing of a benchmarked call.
+"""
+import logging
+import os
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+import click
+import mongomock
+from kink import di
+from pymongo import MongoClient
+
+from predicting_glucose_levels.data.ingestion.ingester import Ingester
+from predicting_glucose_levels.data.ingestion.loader.abstract_loader import (
+    AbstractLoader,
+)
+from predicting_glucose_levels.data.metadata import Metadata
+from predicting_glucose_levels.data.storage.abstract_storage import AbstractStorage
+from predicting_glucose_levels.data.storage.in_memory_storage import InMemoryStorage
+from predicting_glucose_levels.data.storage.mongo_storage import MongoStorage
+from predicting_glucose_levels.data.storage.parquet_storage import ParquetStorage
+
+DATABASE = "benchmark"
+
+
+def storage_options(fn):
+    """
+    Add the --mock, --storage and --chunk-size options to a benchmark command.
+    """
+    fn = click.option(
+        "--chunk-size",
+        type=int,
+        help="Transform in chunks of this many rows.",
+    )(fn)
+    fn = click.option(
+        "--storage",
+        "storage_type",
+        type=click.Choice(["mongo", "parquet", "memory"]),
+        default="mongo",
+        help="The storage to ingest into.",
+    )(fn)
+    return click.option(
+        "--mock", is_flag=True, help="Use mongomock instead of MONGO_URI."
+    )(fn)
+
+
+@contextmanager
+def benchmark_ingester(
+    loader: AbstractLoader,
+    metadata: Metadata,
+    storage_type: str,
+    mock: bool,
+    directory: str,
+) -> Iterator[Ingester]:
+    """
+    Create the storage to benchmark and an Ingester that loads into it, and register both in the container.
+    Parquet files are written to the directory. The benchmark database is dropped afterwards.
+    """
+    client = (
+        mongomock.MongoClient()
+        if mock
+        else MongoClient(
+            os.getenv("MONGO_URI"),
+            username=os.getenv("MONGO_USER"),
+            password=os.getenv("MONGO_PASSWORD"),
+        )
+    )
+    client.drop_database(DATABASE)
+    logger = logging.getLogger("benchmark")
+    if storage_type == "parquet":
+        storage = ParquetStorage(os.path.join(directory, "parquet"), metadata, logger)
+    elif storage_type == "memory":
+        storage = InMemoryStorage(metadata, logger)
+    else:
+        storage = MongoStorage(client, client[DATABASE], metadata, logger)
+    ingester = Ingester(loader, storage, logger)
+    di[AbstractStorage] = storage
+    di[Ingester] = ingester
+    try:
+        yield ingester
+    finally:
+        client.drop_database(DATABASE)
+
+
+def timed(label: str, rows: int, fn) -> None:
+    start = time.perf_counter()
+    fn()
+    duration = time.perf_counter() - start
+    click.echo(
+        f"{label:<10} {rows} rows in {duration:.2f}s: {rows / duration:,.0f} rows/s"
+    )
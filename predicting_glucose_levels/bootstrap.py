@@ -15,12 +15,22 @@ from predicting_glucose_levels.data.ingestion.ingester import Ingester
 from predicting_glucose_levels.data.ingestion.loader.abstract_loader import (
     AbstractLoader,
 )
+from predicting_glucose_levels.data.ingestion.loader.async_nightscout_loader import (
+    AsyncNightscoutLoader,
+)
 from predicting_glucose_levels.data.ingestion.loader.nightscout_loader import (
     NightscoutLoader,
 )
+from predicting_glucose_levels.data.ingestion.loader.replay_loader import ReplayLoader
+from predicting_glucose_levels.data.ingestion.loader.retrying_loader import (
+    RetryingLoader,
+)
 from predicting_glucose_levels.data.metadata import Metadata
 from predicting_glucose_levels.data.storage.abstract_storage import AbstractStorage
+from predicting_glucose_levels.data.storage.buffered_storage import BufferedStorage
+from predicting_glucose_levels.data.storage.in_memory_storage import InMemoryStorage
 from predicting_glucose_levels.data.storage.mongo_storage import MongoStorage
+from predicting_glucose_levels.data.storage.parquet_storage import ParquetStorage
 from predicting_glucose_levels.data.table_metadata import TableMetadata
 from predicting_glucose_levels.helpers.config import LOGS_DIR, LOGS_FILE
 
@@ -44,6 +54,65 @@ def _get_logger(name: str):
     return logger
 
 
+def _get_loader(logger: logging.LoggerAdapter) -> AbstractLoader:
+    """
+    Get the loader selected by NIGHTSCOUT_LOADER. Use "async" for the AsyncNightscoutLoader, which loads
+    sub-windows concurrently. Otherwise use the blocking NightscoutLoader, which decodes responses while they
+    are transferred if NIGHTSCOUT_STREAM is "true".
+    Wrap it in a RetryingLoader, which retries and splits windows that fail or take too long.
+    Use "replay" to serve recorded entities from REPLAY_DIR with the ReplayLoader instead.
+    """
+    if os.getenv("NIGHTSCOUT_LOADER") == "replay":
+        return ReplayLoader(os.getenv("REPLAY_DIR"))
+    uri, secret = os.getenv("NIGHTSCOUT_URI"), os.getenv("NIGHTSCOUT_SECRET")
+    timeout = float(os.getenv("NIGHTSCOUT_TIMEOUT", 120))
+    if os.getenv("NIGHTSCOUT_LOADER", "sync") == "async":
+        loader = AsyncNightscoutLoader(
+            uri,
+            secret,
+            max_concurrency=int(os.getenv("NIGHTSCOUT_CONCURRENCY", 8)),
+            timeout=timeout,
+        )
+    else:
+        loader = NightscoutLoader(
+            uri,
+            secret,
+            timeout=timeout,
+            stream=os.getenv("NIGHTSCOUT_STREAM", "false") == "true",
+        )
+    return RetryingLoader(
+        loader,
+        logger,
+        retries=int(os.getenv("NIGHTSCOUT_RETRIES", 3)),
+        latency_budget=float(os.getenv("NIGHTSCOUT_LATENCY_BUDGET", 30)),
+    )
+
+
+def _get_storage(logger: logging.LoggerAdapter) -> AbstractStorage:
+    """
+    Get the storage selected by STORAGE. Use "parquet" for the ParquetStorage, which stores the tables as
+    Parquet files in PARQUET_DIR, or "memory" for the InMemoryStorage, which keeps them in memory until the
+    process exits. Otherwise use the MongoStorage.
+    If STORAGE_BUFFER_ROWS is set, wrap it in a BufferedStorage, which writes in batches of that many rows, or
+    of the writes of STORAGE_BUFFER_SECONDS.
+    """
+    storage_type = os.getenv("STORAGE", "mongo")
+    if storage_type == "parquet":
+        storage = ParquetStorage(os.getenv("PARQUET_DIR", "data/parquet"))
+    elif storage_type == "memory":
+        storage = InMemoryStorage()
+    else:
+        storage = MongoStorage()
+    if os.getenv("STORAGE_BUFFER_ROWS"):
+        storage = BufferedStorage(
+            storage,
+            logger=logger,
+            max_rows=int(os.getenv("STORAGE_BUFFER_ROWS")),
+            max_age=float(os.getenv("STORAGE_BUFFER_SECONDS", 60)),
+        )
+    return storage
+
+
 def bootstrap_di():
     """
     Inject dependencies into the dependency injection container.
@@ -56,13 +125,12 @@ def bootstrap_di():
         password=os.getenv("MONGO_PASSWORD"),
         serverSelectionTimeoutMS=1000,
         connectTimeoutMS=1000,
+        tz_aware=True,
     )
     di[Database] = lambda _di: _di[MongoClient][os.getenv("MONGO_DB", "MYDB")]
     # Logging
     di[logging.LoggerAdapter] = lambda di: _get_logger("logger")
     # Set the NightscoutLoader as the default loader.
-    di[AbstractLoader] = lambda _di: NightscoutLoader(
-        os.getenv("NIGHTSCOUT_URI"), os.getenv("NIGHTSCOUT_SECRET")
-    )
+    di[AbstractLoader] = lambda _di: _get_loader(_di[logging.LoggerAdapter])
     # Set the MongoStorage as the default storage
-    di[AbstractStorage] = lambda _di: MongoStorage()
+    di[AbstractStorage] = lambda _di: _get_storage(_di[logging.LoggerAdapter])
@@ -1,5 +1,7 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
 from logging import LoggerAdapter
-from typing import List
+from typing import Dict, Iterable, List, Tuple
 
 from kink import inject
 from prefect import flow, task
@@ -10,7 +12,25 @@ from predicting_glucose_levels.data.ingestion.loader.abstract_loader import (
     AbstractLoader,
 )
 from predicting_glucose_levels.data.storage.abstract_storage import AbstractStorage
+from predicting_glucose_levels.data.storage.upsert_result import UpsertResult
 from predicting_glucose_levels.data.table_metadata import TableMetadata
+from predicting_glucose_levels.helpers.general import split_window
+
+
+class IngestionError(Exception):
+    """
+    Raised when one or more tables could not be ingested.
+
+    Attributes:
+        errors: The error of each failed table, by table name.
+    """
+
+    errors: Dict[str, Exception]
+
+    def __init__(self, errors: Dict[str, Exception]):
+        self.errors = errors
+        failures = ", ".join(f"{table}: {error}" for table, error in errors.items())
+        super().__init__(f"Failed to ingest {len(errors)} tables. {failures}")
 
 
 @inject
@@ -40,23 +60,164 @@ class Ingester:
         self.storage = storage
         self.logger = logger
 
-    def ingest(self, tables: List[TableMetadata]):
+    def ingest(
+        self, tables: List[TableMetadata], max_workers: int = 1, chunk_workers: int = 1
+    ):
         """
         Ingest a new batch of data.
         Loop over all tables in the storage, and ingest the data.
         For each data type, read and write runmoments.
+
+        Parameters:
+            tables: The tables to ingest.
+            max_workers: If larger than 1, ingest the tables concurrently in a pool of this many threads. A
+                failing table does not abort the others, the errors of all tables are raised together
+                afterwards as an IngestionError.
+            chunk_workers: If larger than 1, ingest the chunks of a chunked table concurrently in a pool of
+                this many threads.
+
+        The storage is flushed afterwards, also if a table failed, so that buffered writes of the tables that
+        succeeded are stored.
         """
         self.storage.setup()
         self.logger.info(f"Ingesting {len(tables)} tables")
-        for table in tables:
-            start, end = self.storage.get_window(table.name)
-            self.logger.info(f"Ingesting {table.name} from {start} to {end}")
-            data = self.data_loader.load(
-                start, end, table.endpoint, table.timestamp_col
+        try:
+            if max_workers > 1:
+                self._ingest_concurrently(tables, max_workers, chunk_workers)
+            else:
+                for table in tables:
+                    self._ingest_table(table, chunk_workers)
+        finally:
+            self.storage.flush()
+        self.logger.info("Done ingesting")
+
+    def _ingest_concurrently(
+        self, tables: List[TableMetadata], max_workers: int, chunk_workers: int
+    ):
+        """
+        Ingest each table in a thread of a bounded pool. The loader and storage are shared by all threads.
+        Collect the error of each failed table, and raise them once all tables are done.
+        """
+        errors = {}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(self._ingest_table, table, chunk_workers): table
+                for table in tables
+            }
+            for future in as_completed(futures):
+                table = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    self.logger.error(f"Failed to ingest {table.name}: {e}")
+                    errors[table.name] = e
+        if errors:
+            raise IngestionError(errors)
+
+    def _ingest_table(self, table: TableMetadata, chunk_workers: int = 1):
+        """
+        Ingest the window of a single table. The runmoment is only set once all rows of the window are
+        stored. It is a single write on the row of this table, so a failure never moves it partially.
+
+        If the table has a chunk span, the window is split into chunks, and the runmoment is set after each
+        chunk. A failed run then resumes at the first chunk that was not stored yet.
+
+        Afterwards, also if the table failed, log the retry and split counters of the loader, if it keeps
+        them, like the RetryingLoader.
+        """
+        try:
+            self._ingest_table_windows(table, chunk_workers)
+        finally:
+            stats = getattr(self.data_loader, "stats", None)
+            if stats is not None:
+                self.logger.info(f"Loader stats after ingesting {table.name}: {stats}")
+
+    def _ingest_table_windows(self, table: TableMetadata, chunk_workers: int):
+        start, end = self.storage.get_window(table.name)
+        span = table.get_chunk_span()
+        if span is None:
+            self._ingest_window(table, start, end)
+            self.storage.set_last_runmoment(table.name, end)
+            return
+        windows = split_window(start, end, span)
+        self.logger.info(f"Ingesting {table.name} in {len(windows)} chunks")
+        if chunk_workers > 1:
+            self._ingest_chunks_concurrently(table, windows, chunk_workers)
+        else:
+            for chunk_start, chunk_end in windows:
+                self._ingest_window(table, chunk_start, chunk_end)
+                self.storage.set_last_runmoment(table.name, chunk_end)
+
+    def _ingest_chunks_concurrently(
+        self,
+        table: TableMetadata,
+        windows: List[Tuple[datetime, datetime]],
+        chunk_workers: int,
+    ):
+        """
+        Ingest the chunks of a table in a pool of chunk_workers threads. Chunks can finish in any order, but
+        the runmoment is only advanced to the end of the longest sequence of finished chunks from the start.
+        It therefore never moves past a chunk that is still running or failed. On the first failure, the
+        chunks that did not start yet are cancelled.
+        """
+        done = [False] * len(windows)
+        committed = 0
+        with ThreadPoolExecutor(max_workers=chunk_workers) as executor:
+            futures = {
+                executor.submit(self._ingest_window, table, *window): i
+                for i, window in enumerate(windows)
+            }
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception:
+                    for pending in futures:
+                        pending.cancel()
+                    raise
+                done[futures[future]] = True
+                previous = committed
+                while committed < len(windows) and done[committed]:
+                    committed += 1
+                if committed > previous:
+                    self.storage.set_last_runmoment(
+                        table.name, windows[committed - 1][1]
+                    )
+
+    def _ingest_window(self, table: TableMetadata, start: datetime, end: datetime):
+        """
+        Load the window of a table, and upsert it page by page.
+        """
+        self.logger.info(f"Ingesting {table.name} from {start} to {end}")
+        rows = 0
+        total = UpsertResult()
+        for page in self._load(table, start, end):
+            result = self.storage.upsert(page, table.name)
+            rows += len(page)
+            total += result
+            self.logger.info(f"Upserted {len(page)} rows into {table.name}: {result}")
+        self.logger.info(
+            f"Ingested {rows} rows for {table.name} during window {start} to {end}, "
+            f"skipped {total.skipped} unchanged rows ({total.get_skip_ratio():.0%})"
+        )
+
+    def _load(self, table: TableMetadata, start: datetime, end: datetime) -> Iterable:
+        """
+        Load the window of a table. If the table has a page size, load it page by page, so that each page
+        can be stored as soon as it arrives. Otherwise load the full window as a single page.
+        If the table projects its columns, only load the columns of its JSON schema.
+        """
+        kwargs = {"columns": table.get_columns()} if table.project_columns else {}
+        if table.page_size:
+            return self.data_loader.load_pages(
+                start,
+                end,
+                table.endpoint,
+                table.timestamp_col,
+                table.page_size,
+                **kwargs,
             )
-            self.storage.upsert(data, table.name)
-            self.logger.info(
-                f"Ingested {len(data)} rows for {table.name} during window {start} to {end}"
+        return [
+            self.data_loader.load(
+                start, end, table.endpoint, table.timestamp_col, **kwargs
             )
-            self.storage.set_last_runmoment(table.name, end)
-        self.logger.info("Done ingesting")
+        ]
@@ -1,6 +1,34 @@
 import datetime
 from abc import ABC, abstractmethod
-from typing import List
+from typing import Iterator, List, Optional, Tuple
+
+
+class LoaderError(Exception):
+    """
+    Raised when a loader fails to load a window.
+
+    Attributes:
+        retryable: Whether loading the window again could succeed, for example after a server error.
+        failed_windows: If the loader loaded the window in sub-windows of which only some failed, the
+            sub-windows that failed. Empty if the whole window failed.
+        rows: The rows of the sub-windows that did load.
+    """
+
+    retryable: bool
+    failed_windows: List[Tuple[datetime.datetime, datetime.datetime]]
+    rows: List
+
+    def __init__(self, message: str, retryable: bool = True):
+        super().__init__(message)
+        self.retryable = retryable
+        self.failed_windows = []
+        self.rows = []
+
+
+class LoaderTimeout(LoaderError):
+    """
+    Raised when loading a window took longer than the loader allows.
+    """
 
 
 class AbstractLoader(ABC):
@@ -14,10 +42,38 @@ class AbstractLoader(ABC):
 
     @abstractmethod
     def load(
-        self, start: datetime, end: datetime, endpoint: str, timestamp_col: str
+        self,
+        start: datetime,
+        end: datetime,
+        endpoint: str,
+        timestamp_col: str,
+        columns: Optional[List[str]] = None,
     ) -> List:
         """
         Load measurements from a data source between the start and end timestamps. Use the endpoint and
-        timestamp to determine the correct endpoint and timestamp column.
+        timestamp to determine the correct endpoint and timestamp column. If columns are given, each row only
+        contains those columns.
         """
         raise NotImplementedError
+
+    def load_pages(
+        self,
+        start: datetime,
+        end: datetime,
+        endpoint: str,
+        timestamp_col: str,
+        page_size: int,
+        columns: Optional[List[str]] = None,
+    ) -> Iterator[List]:
+        """
+        Load measurements between the start and end timestamps as a generator of pages of at most page_size
+        rows. Loaders that cannot paginate yield the full window as a single page.
+        """
+        yield self.load(start, end, endpoint, timestamp_col, columns)
+
+
+def project(row: dict, columns: List[str]) -> dict:
+    """
+    Select the columns of a row. Columns that the row does not have are left out.
+    """
+    return {column: row[column] for column in columns if column in row}
@@ -0,0 +1,167 @@
+import asyncio
+from datetime import datetime, timedelta
+from threading import Thread
+from typing import List
+
+import httpx
+
+from predicting_glucose_levels.data.ingestion.loader.abstract_loader import (
+    AbstractLoader,
+    LoaderError,
+    LoaderTimeout,
+    project,
+)
+from predicting_glucose_levels.helpers.general import split_window
+
+
+class AsyncNightscoutLoader(AbstractLoader):
+    """
+    AsyncNightscoutLoader loads entries and treatments from a Nightscout API with asyncio. A window is split
+    into sub-windows, which are requested concurrently over a pool of keep-alive connections.
+
+    The loader owns an event loop that runs in a background thread. The HTTP client and its connection pool
+    live on that loop, so they persist between calls to load, also when it is called from multiple threads.
+
+    Attributes:
+        url: The url of the Nightscout API.
+        headers: The headers to send with each request.
+        sub_window: The maximum span of a single request.
+        max_concurrency: The maximum number of requests that are in flight at the same time.
+        timeout: The number of seconds to wait for a response, or None to wait forever.
+        loop: The event loop on which all requests are executed.
+    """
+
+    url: str
+    headers: dict
+    sub_window: timedelta
+    max_concurrency: int
+    timeout: float
+    loop: asyncio.AbstractEventLoop
+
+    def __init__(
+        self,
+        nightscout_uri: str,
+        nightscout_secret: str,
+        sub_window: timedelta = timedelta(days=1),
+        max_concurrency: int = 8,
+        timeout: float = None,
+        transport: httpx.AsyncBaseTransport = None,
+    ):
+        """
+        Start the event loop. The client is created on the loop when the first request is made.
+        Use transport to replace the network layer, for example in tests.
+        """
+        self.url = nightscout_uri
+        self.headers = {"Accept": "application/json", "api_secret": nightscout_secret}
+        self.sub_window = sub_window
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self._transport = transport
+        self._client = None
+        self._semaphore = None
+        self.loop = asyncio.new_event_loop()
+        Thread(target=self.loop.run_forever, daemon=True).start()
+
+    def load(
+        self,
+        start: datetime,
+        end: datetime,
+        endpoint: str,
+        timestamp_col: str,
+        columns: List[str] = None,
+    ) -> List:
+        """
+        Load entities from endpoint between start and end timestamps. Blocks until all sub-windows are loaded.
+        """
+        return asyncio.run_coroutine_threadsafe(
+            self.load_async(start, end, endpoint, timestamp_col, columns), self.loop
+        ).result()
+
+    async def load_async(
+        self,
+        start: datetime,
+        end: datetime,
+        endpoint: str,
+        timestamp_col: str,
+        columns: List[str] = None,
+    ) -> List:
+        """
+        Split the window into sub-windows, and request them concurrently. Must run on the loop of the loader.
+        Sub-windows exclude their end, except for the last one, so that no entity is loaded twice.
+
+        If some sub-windows fail, the error of one of them is raised once all requests are done, with the
+        failed sub-windows and the rows of the others, so that only the failed sub-windows need to be loaded
+        again. A non-retryable error takes precedence.
+        """
+        windows = split_window(start, end, self.sub_window)
+        pages = await asyncio.gather(
+            *(self._get(endpoint, timestamp_col, s, e, e == end) for s, e in windows),
+            return_exceptions=True,
+        )
+        errors = [page for page in pages if isinstance(page, BaseException)]
+        rows = (row for page in pages if isinstance(page, list) for row in page)
+        rows = [project(row, columns) for row in rows] if columns else list(rows)
+        if not errors:
+            return rows
+        unexpected = [e for e in errors if not isinstance(e, LoaderError)]
+        if unexpected:
+            raise unexpected[0]
+        error = min(errors, key=lambda e: e.retryable)
+        error.failed_windows = [
+            window
+            for window, page in zip(windows, pages)
+            if isinstance(page, BaseException)
+        ]
+        error.rows = rows
+        raise error
+
+    async def _get(
+        self,
+        endpoint: str,
+        timestamp_col: str,
+        start: datetime,
+        end: datetime,
+        include_end: bool,
+    ) -> List:
+        """
+        Get the entities of a single sub-window. At most max_concurrency requests run at the same time.
+        """
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self.url,
+                headers=self.headers,
+                limits=httpx.Limits(
+                    max_connections=self.max_concurrency,
+                    max_keepalive_connections=self.max_concurrency,
+                ),
+                timeout=self.timeout,
+                transport=self._transport,
+            )
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        end_operator = "$lte" if include_end else "$lt"
+        params = {
+            f"find[{timestamp_col}][$gte]": start.isoformat(),
+            f"find[{timestamp_col}][{end_operator}]": end.isoformat(),
+            "count": 10000000000000,
+        }
+        async with self._semaphore:
+            try:
+                response = await self._client.get(f"/{endpoint}", params=params)
+            except httpx.TimeoutException as e:
+                raise LoaderTimeout(f"Timeout while loading data from Nightscout: {e}")
+            except httpx.TransportError as e:
+                raise LoaderError(f"Could not connect to Nightscout: {e}")
+        if response.status_code != 200:
+            raise LoaderError(
+                f"Error while loading data from Nightscout: {response.text}",
+                retryable=response.status_code >= 500 or response.status_code == 429,
+            )
+        return response.json()
+
+    def close(self) -> None:
+        """
+        Close the client and stop the event loop.
+        """
+        if self._client is not None:
+            asyncio.run_coroutine_threadsafe(self._client.aclose(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
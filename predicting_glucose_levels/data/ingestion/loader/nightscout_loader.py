@@ -1,12 +1,19 @@
+import codecs
 from datetime import datetime
-from typing import List
+from typing import Iterator, List
 
 import requests
 from kink import inject
+from requests.adapters import HTTPAdapter
 
 from predicting_glucose_levels.data.ingestion.loader.abstract_loader import (
     AbstractLoader,
+    LoaderError,
+    LoaderTimeout,
+    project,
 )
+from predicting_glucose_levels.helpers.general import batched
+from predicting_glucose_levels.helpers.streaming import iter_json_array
 
 
 class NightscoutLoader(AbstractLoader):
@@ -16,39 +23,153 @@ class NightscoutLoader(AbstractLoader):
     Attributes:
         session: The session to use to connect to the Nightscout API.
         url: The url of the Nightscout API.
+        timeout: The number of seconds to wait for a response, or None to wait forever.
+        stream: Whether to decode responses incrementally while they are transferred, instead of at once.
     """
 
     url: str
     session: requests.Session
+    timeout: float
+    stream: bool
 
-    def __init__(self, nightscout_uri: str, nightscout_secret: str):
+    def __init__(
+        self,
+        nightscout_uri: str,
+        nightscout_secret: str,
+        pool_size: int = 10,
+        timeout: float = None,
+        stream: bool = False,
+    ):
         """
-        Create a session with the Nightscout API.
+        Create a session with the Nightscout API. The session is not changed after this, so it can be shared
+        by threads that load concurrently. Its connection pool keeps up to pool_size connections open, one
+        for each concurrent thread.
         """
         session = requests.Session()
         session.headers.update({"Accept": "application/json"})
         session.headers.update({"api_secret": nightscout_secret})
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
         self.session = session
 
         self.url = nightscout_uri
+        self.timeout = timeout
+        self.stream = stream
 
     def load(
-        self, start: datetime, end: datetime, endpoint: str, timestamp_col: str
+        self,
+        start: datetime,
+        end: datetime,
+        endpoint: str,
+        timestamp_col: str,
+        columns: List[str] = None,
     ) -> List:
         """
         Load entities from endpoint between start and end timestamps.
-        Use a large count, so that all entities are loaded.
         """
-        url = f"{self.url}/{endpoint}"
+        return list(self.iter_rows(start, end, endpoint, timestamp_col, columns))
+
+    def iter_rows(
+        self,
+        start: datetime,
+        end: datetime,
+        endpoint: str,
+        timestamp_col: str,
+        columns: List[str] = None,
+    ) -> Iterator[dict]:
+        """
+        Load entities from endpoint between start and end timestamps, in a single request, and yield them
+        one by one. Use a large count, so that all entities are loaded.
+        """
         params = {
             f"find[{timestamp_col}][$gte]": start.isoformat(),
             f"find[{timestamp_col}][$lte]": end.isoformat(),
             "count": 10000000000000,
         }
+        return self._get(endpoint, params, columns)
+
+    def load_pages(
+        self,
+        start: datetime,
+        end: datetime,
+        endpoint: str,
+        timestamp_col: str,
+        page_size: int,
+        columns: List[str] = None,
+    ) -> Iterator[List]:
+        """
+        Load the window in pages of page_size entities.
+
+        When streaming, the window is loaded in a single request, and each page is yielded as soon as its
+        entities are decoded. Otherwise, walk the window from end to start with a request per page. Nightscout
+        returns the newest entities first, so each next page ends at the oldest timestamp of the previous
+        page. That timestamp is requested again, because more entities could share it. Entities that were
+        already yielded are skipped.
+        """
+        if self.stream:
+            rows = self.iter_rows(start, end, endpoint, timestamp_col, columns)
+            yield from batched(rows, page_size)
+            return
+        cursor = end.isoformat()
+        seen = []
+        while True:
+            params = {
+                f"find[{timestamp_col}][$gte]": start.isoformat(),
+                f"find[{timestamp_col}][$lte]": cursor,
+                "count": page_size,
+            }
+            page = list(self._get(endpoint, params, columns))
+            rows = [row for row in page if row not in seen]
+            if rows:
+                yield rows
+            if len(page) < page_size:
+                return
+            if not rows:
+                raise Exception(
+                    f"More than {page_size} entities in {endpoint} share {timestamp_col} {cursor}. "
+                    "Increase the page size."
+                )
+            cursor = min(row[timestamp_col] for row in page)
+            seen = [row for row in seen + rows if row[timestamp_col] == cursor]
 
-        response = self.session.get(url, params=params)
+    def _get(
+        self, endpoint: str, params: dict, columns: List[str] = None
+    ) -> Iterator[dict]:
+        """
+        Get the entities of an endpoint, filtered by the params, and projected to the columns if given.
+        Server errors, rate limits and network errors are raised as retryable LoaderErrors, other client
+        errors are not retryable.
+        """
+        url = f"{self.url}/{endpoint}"
+        try:
+            response = self.session.get(
+                url, params=params, timeout=self.timeout, stream=self.stream
+            )
+        except requests.Timeout as e:
+            raise LoaderTimeout(f"Timeout while loading data from Nightscout: {e}")
+        except requests.ConnectionError as e:
+            raise LoaderError(f"Could not connect to Nightscout: {e}")
         if response.status_code != 200:
-            raise Exception(
-                f"Error while loading data from Nightscout: {response.text}"
+            raise LoaderError(
+                f"Error while loading data from Nightscout: {response.text}",
+                retryable=response.status_code >= 500 or response.status_code == 429,
             )
-        return response.json()
+        rows = self._decode(response) if self.stream else response.json()
+        return (project(row, columns) for row in rows) if columns else iter(rows)
+
+    @staticmethod
+    def _decode(response: requests.Response) -> Iterator[dict]:
+        """
+        Decode the body of a streamed response incrementally, while it is being transferred.
+        """
+        decoder = codecs.getincrementaldecoder(response.encoding or "utf-8")()
+        try:
+            with response:
+                chunks = (
+                    decoder.decode(chunk)
+                    for chunk in response.iter_content(chunk_size=65536)
+                )
+                yield from iter_json_array(chunks)
+        except requests.RequestException as e:
+            raise LoaderError(f"Error while streaming data from Nightscout: {e}")
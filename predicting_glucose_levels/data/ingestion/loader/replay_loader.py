@@ -0,0 +1,150 @@
+import gzip
+import json
+from bisect import bisect_left
+from datetime import datetime
+from pathlib import Path
+from typing import Iterable, Iterator, List, Optional
+
+from predicting_glucose_levels.data.ingestion.loader.abstract_loader import (
+    AbstractLoader,
+    project,
+)
+from predicting_glucose_levels.helpers.general import batched
+
+
+class ReplayLoader(AbstractLoader):
+    """
+    ReplayLoader serves recorded entities from files, instead of from a live Nightscout API. It is used to
+    exercise the ingester and transformers at production scale, and to benchmark them reproducibly.
+
+    Each endpoint is recorded in two files in the directory:
+    - <endpoint>.jsonl.gz: The entities as JSON lines, sorted by timestamp. The file is a sequence of gzip
+      members of at most block_size entities each, which together form a single valid gzip file.
+    - <endpoint>.index.json: The timestamp column, and for each block its byte offset and length, and its
+      first and last timestamp.
+    A load only decompresses the blocks that overlap with the window. Timestamps are compared as ISO strings,
+    like the Nightscout API does.
+
+    Attributes:
+        directory: The directory that contains the recordings.
+    """
+
+    directory: Path
+
+    def __init__(self, directory: str):
+        self.directory = Path(directory)
+        self._indexes = {}
+
+    def load(
+        self,
+        start: datetime,
+        end: datetime,
+        endpoint: str,
+        timestamp_col: str,
+        columns: Optional[List[str]] = None,
+    ) -> List:
+        """
+        Load the recorded entities of endpoint between start and end timestamps, oldest first.
+        """
+        return list(self.iter_rows(start, end, endpoint, timestamp_col, columns))
+
+    def load_pages(
+        self,
+        start: datetime,
+        end: datetime,
+        endpoint: str,
+        timestamp_col: str,
+        page_size: int,
+        columns: Optional[List[str]] = None,
+    ) -> Iterator[List]:
+        rows = self.iter_rows(start, end, endpoint, timestamp_col, columns)
+        yield from batched(rows, page_size)
+
+    def iter_rows(
+        self,
+        start: datetime,
+        end: datetime,
+        endpoint: str,
+        timestamp_col: str,
+        columns: Optional[List[str]] = None,
+    ) -> Iterator[dict]:
+        """
+        Yield the recorded entities between start and end timestamps. Seek directly to the first block that
+        can contain start, and stop at the first block that starts after end.
+        """
+        index = self._get_index(endpoint)
+        if index["timestamp_col"] != timestamp_col:
+            raise Exception(
+                f"{endpoint} is recorded by {index['timestamp_col']}, not by {timestamp_col}."
+            )
+        start, end = start.isoformat(), end.isoformat()
+        blocks = index["blocks"]
+        first = bisect_left(index["lasts"], start)
+        with open(self.directory / f"{endpoint}.jsonl.gz", "rb") as f:
+            for block in blocks[first:]:
+                if block["first"] > end:
+                    return
+                f.seek(block["offset"])
+                lines = gzip.decompress(f.read(block["length"])).splitlines()
+                for line in lines:
+                    row = json.loads(line)
+                    if start <= row[timestamp_col] <= end:
+                        yield project(row, columns) if columns else row
+
+    def _get_index(self, endpoint: str) -> dict:
+        if endpoint not in self._indexes:
+            with open(self.directory / f"{endpoint}.index.json") as f:
+                index = json.load(f)
+            index["lasts"] = [block["last"] for block in index["blocks"]]
+            self._indexes[endpoint] = index
+        return self._indexes[endpoint]
+
+    @staticmethod
+    def write(
+        directory: str,
+        endpoint: str,
+        timestamp_col: str,
+        rows: Iterable[dict],
+        block_size: int = 1000,
+    ) -> None:
+        """
+        Record entities of an endpoint in directory, replacing an earlier recording.
+        """
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        rows = sorted(rows, key=lambda row: row[timestamp_col])
+        blocks = []
+        with open(directory / f"{endpoint}.jsonl.gz", "wb") as f:
+            for block in batched(rows, block_size):
+                lines = "".join(json.dumps(row) + "\n" for row in block)
+                data = gzip.compress(lines.encode())
+                blocks.append(
+                    {
+                        "offset": f.tell(),
+                        "length": len(data),
+                        "first": block[0][timestamp_col],
+                        "last": block[-1][timestamp_col],
+                        "rows": len(block),
+                    }
+                )
+                f.write(data)
+        with open(directory / f"{endpoint}.index.json", "w") as f:
+            json.dump({"timestamp_col": timestamp_col, "blocks": blocks}, f)
+
+    @staticmethod
+    def record(
+        loader: AbstractLoader,
+        directory: str,
+        start: datetime,
+        end: datetime,
+        endpoint: str,
+        timestamp_col: str,
+        block_size: int = 1000,
+    ) -> int:
+        """
+        Load the window of an endpoint with another loader, and record it in directory. Return the number of
+        recorded entities.
+        """
+        rows = loader.load(start, end, endpoint, timestamp_col)
+        ReplayLoader.write(directory, endpoint, timestamp_col, rows, block_size)
+        return len(rows)
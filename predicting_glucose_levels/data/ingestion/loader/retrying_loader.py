@@ -0,0 +1,244 @@
+import random
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from logging import LoggerAdapter
+from threading import Lock
+from typing import Iterator, List, Optional, Tuple
+
+from predicting_glucose_levels.data.ingestion.loader.abstract_loader import (
+    AbstractLoader,
+    LoaderError,
+    LoaderTimeout,
+)
+from predicting_glucose_levels.helpers.general import split_window
+
+
+@dataclass
+class LoaderStats:
+    """
+    Counters of a RetryingLoader.
+
+    Attributes:
+        retries: The number of times a window was loaded again after a failure.
+        splits: The number of times a window was bisected into two smaller windows.
+    """
+
+    retries: int = 0
+    splits: int = 0
+
+
+class RetryingLoader(AbstractLoader):
+    """
+    RetryingLoader wraps another loader, and retries failed loads with exponential backoff and full jitter.
+    A window that times out, or keeps failing after all retries, is bisected and both halves are loaded
+    separately, down to a minimum span. A window that loads slower than the latency budget also halves the
+    span in which the next windows are loaded, and fast windows double it again. Throughput therefore
+    degrades gracefully on a struggling server, instead of failing the whole ingest.
+
+    Attributes:
+        loader: The loader that does the actual loading.
+        logger: The logger to use to log messages.
+        retries: The number of retries of a window, before it is bisected.
+        backoff: The base number of seconds to wait before a retry. Doubles on every retry of a window.
+        max_backoff: The maximum number of seconds to wait before a retry.
+        latency_budget: The number of seconds a window may take before the next windows are made smaller.
+        min_span: Windows smaller than this are never bisected.
+        max_span: The span in which windows are currently loaded, or None if windows are not split upfront.
+        stats: The number of retries and splits so far.
+    """
+
+    loader: AbstractLoader
+    logger: LoggerAdapter
+    retries: int
+    backoff: float
+    max_backoff: float
+    latency_budget: float
+    min_span: timedelta
+    max_span: timedelta
+    stats: LoaderStats
+
+    def __init__(
+        self,
+        loader: AbstractLoader,
+        logger: LoggerAdapter,
+        retries: int = 3,
+        backoff: float = 1.0,
+        max_backoff: float = 60.0,
+        latency_budget: float = None,
+        min_span: timedelta = timedelta(minutes=30),
+    ):
+        self.loader = loader
+        self.logger = logger
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.latency_budget = latency_budget
+        self.min_span = min_span
+        self.max_span = None
+        self.stats = LoaderStats()
+        self._lock = Lock()
+
+    def load(
+        self,
+        start: datetime,
+        end: datetime,
+        endpoint: str,
+        timestamp_col: str,
+        columns: Optional[List[str]] = None,
+    ) -> List:
+        """
+        Load the window in sub-windows of at most max_span, each with retries and bisection.
+        """
+        rows = []
+        for sub_start, sub_end in self._split(start, end):
+            rows += self._load_window(
+                sub_start, sub_end, endpoint, timestamp_col, columns
+            )
+        return rows
+
+    def load_pages(
+        self,
+        start: datetime,
+        end: datetime,
+        endpoint: str,
+        timestamp_col: str,
+        page_size: int,
+        columns: Optional[List[str]] = None,
+    ) -> Iterator[List]:
+        """
+        Load the window page by page, in sub-windows of at most max_span. If a sub-window fails after some of
+        its pages were yielded, it is loaded again from the start. Those pages are then yielded twice, which
+        is harmless because pages are upserted.
+        """
+        for sub_start, sub_end in self._split(start, end):
+            yield from self._load_pages_window(
+                sub_start, sub_end, endpoint, timestamp_col, page_size, columns
+            )
+
+    def _load_window(
+        self,
+        start: datetime,
+        end: datetime,
+        endpoint: str,
+        timestamp_col: str,
+        columns: Optional[List[str]],
+        attempt: int = 0,
+    ) -> List:
+        """
+        Load a window, retrying and bisecting it after failures. If the loader loaded part of the window, its
+        rows are kept and only the sub-windows that failed are retried or bisected. A retried sub-window
+        includes its end, so a row at its end can be loaded twice, which is harmless because rows are upserted.
+        """
+        try:
+            started = time.monotonic()
+            rows = self.loader.load(start, end, endpoint, timestamp_col, columns)
+            self._adapt_span(start, end, time.monotonic() - started)
+            return rows
+        except LoaderError as e:
+            windows = e.failed_windows or [(start, end)]
+            if self._should_split(e, attempt, start, end):
+                windows = [half for window in windows for half in self._bisect(*window)]
+                attempt = -1
+            return e.rows + [
+                row
+                for window in windows
+                for row in self._load_window(
+                    *window, endpoint, timestamp_col, columns, attempt + 1
+                )
+            ]
+
+    def _load_pages_window(
+        self,
+        start: datetime,
+        end: datetime,
+        endpoint: str,
+        timestamp_col: str,
+        page_size: int,
+        columns: Optional[List[str]],
+        attempt: int = 0,
+    ) -> Iterator[List]:
+        """
+        Load a window page by page, like _load_window. The rows that the loader loaded before it failed are
+        yielded as a page. The latency of the window is the time spent waiting for its pages, the time in
+        which the caller processes a page is not counted.
+        """
+        try:
+            pages = self.loader.load_pages(
+                start, end, endpoint, timestamp_col, page_size, columns
+            )
+            duration = 0.0
+            while True:
+                started = time.monotonic()
+                page = next(pages, None)
+                duration += time.monotonic() - started
+                if page is None:
+                    break
+                yield page
+            self._adapt_span(start, end, duration)
+            return
+        except LoaderError as e:
+            windows = e.failed_windows or [(start, end)]
+            if self._should_split(e, attempt, start, end):
+                windows = [half for window in windows for half in self._bisect(*window)]
+                attempt = -1
+            if e.rows:
+                yield e.rows
+        for window in windows:
+            yield from self._load_pages_window(
+                *window, endpoint, timestamp_col, page_size, columns, attempt + 1
+            )
+
+    def _should_split(
+        self, error: LoaderError, attempt: int, start: datetime, end: datetime
+    ) -> bool:
+        """
+        Decide what to do after a failed attempt. Return True if the window should be bisected. Return False
+        after waiting for the backoff, if the window should be retried. Raise the error if neither helps,
+        also if it is not retryable: another window would fail the same way.
+        """
+        can_split = error.retryable and end - start > self.min_span
+        if can_split and (isinstance(error, LoaderTimeout) or attempt >= self.retries):
+            self.logger.warning(f"Splitting window {start} - {end} after: {error}")
+            with self._lock:
+                self.stats.splits += 1
+            return True
+        if not error.retryable or attempt >= self.retries:
+            raise error
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2**attempt))
+        self.logger.warning(
+            f"Retrying window {start} - {end} in {delay:.1f}s after: {error}"
+        )
+        with self._lock:
+            self.stats.retries += 1
+        time.sleep(delay)
+        return False
+
+    def _adapt_span(self, start: datetime, end: datetime, duration: float) -> None:
+        """
+        Halve the span of the next windows if this window was slower than the latency budget. Double it if
+        the window took less than a quarter of the budget.
+        """
+        if self.latency_budget is None:
+            return
+        with self._lock:
+            if duration > self.latency_budget:
+                self.max_span = max(self.min_span, (end - start) / 2)
+            elif self.max_span is not None and duration < self.latency_budget / 4:
+                self.max_span *= 2
+
+    def _split(self, start: datetime, end: datetime) -> List[Tuple[datetime, datetime]]:
+        if self.max_span is None:
+            return [(start, end)]
+        return split_window(start, end, self.max_span)
+
+    def _bisect(
+        self, start: datetime, end: datetime
+    ) -> List[Tuple[datetime, datetime]]:
+        """
+        Split a window into two halves, unless it is not larger than the minimum span.
+        """
+        if end - start <= self.min_span:
+            return [(start, end)]
+        middle = start + (end - start) / 2
+        return [(start, middle), (middle, end)]
@@ -21,12 +21,14 @@ class Metadata:
             TableMetadata(**json.load(open(f)))
             for f in (METADATA_DIR / "tables").glob("*.json")
         ]
+        self._tables_by_name = {table.name: table for table in self.tables}
 
     def get_table(self, table: str) -> TableMetadata:
         """
-        Get the metadata for a table.
+        Get the metadata for a table. Tables are looked up by name in a dict, because this is called for every
+        write.
         """
         try:
-            return next(x for x in self.tables if x.name == table)
-        except StopIteration:
+            return self._tables_by_name[table]
+        except KeyError:
             raise Exception(f"Table {table} not found in metadata.")
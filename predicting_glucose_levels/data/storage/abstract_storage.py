@@ -1,14 +1,19 @@
+import hashlib
+import json
+import time
 from abc import ABC, abstractmethod
 from datetime import datetime
 from logging import LoggerAdapter
-from typing import Any, List, Optional, Tuple
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
 
 import pandas as pd
 from kink import inject
 from prefect.logging.loggers import PrefectLogAdapter
 
 from predicting_glucose_levels.data.metadata import Metadata
-from predicting_glucose_levels.helpers.general import now
+from predicting_glucose_levels.data.storage.upsert_result import UpsertResult
+from predicting_glucose_levels.data.table_metadata import TableMetadata
+from predicting_glucose_levels.helpers.general import batched, now, to_local, to_utc
 
 
 class AbstractStorage(ABC):
@@ -19,14 +24,21 @@ class AbstractStorage(ABC):
     Attributes:
         metadata: The metadata class. Used to get information about the tables.
         logger: The logger to use to log messages.
+        runmoment_ttl: The number of seconds that a runmoment is cached. Runmoments that this storage writes
+            are cached right away, the TTL bounds how long a runmoment written by another process is missed.
+        supports_pushdown: Whether the storage can run aggregation pipelines in its backend, see aggregate and
+            merge_pipeline.
     """
 
     metadata: Metadata
     logger: LoggerAdapter
+    runmoment_ttl: float = 60
+    supports_pushdown: bool = False
 
     def __init__(self, metadata: Metadata, logger: LoggerAdapter) -> None:
         self.metadata = metadata
         self.logger = logger
+        self._runmoments: Dict[str, Tuple[datetime, float]] = {}
 
     @abstractmethod
     def setup(self) -> None:
@@ -36,10 +48,13 @@ class AbstractStorage(ABC):
         raise NotImplementedError
 
     @abstractmethod
-    def _upsert(self, data: List, table: str, key_col: str, timestamp_col: str) -> None:
+    def _upsert(
+        self, data: Iterable, table: str, key_col: str, timestamp_col: str
+    ) -> UpsertResult:
         """
-        Upsert a list of rows into a table. Use the key_col to identify the row and the timestamp_col to
-        determine the order of the rows.
+        Upsert an iterable of rows into a table. Use the key_col to identify the row and the timestamp_col to
+        determine the order of the rows. The iterable may be lazy, implementations should not assume it can
+        be consumed more than once. Return the number of matched, upserted and modified rows.
         """
         raise NotImplementedError
 
@@ -65,15 +80,18 @@ class AbstractStorage(ABC):
         raise NotImplementedError
 
     @abstractmethod
-    def find(
+    def iter_find(
         self,
         table: str,
         query: List[Tuple] = None,
         sort: List[str] = None,
         asc: bool = True,
-    ) -> List:
+        limit: int = None,
+        batch_size: int = None,
+        columns: List[str] = None,
+    ) -> Iterator[dict]:
         """
-        Find rows in a table that match the query.
+        Find rows in a table that match the query, and yield them one by one while they are read.
 
         Parameters:
             table: The name of the table to query.
@@ -82,73 +100,331 @@ class AbstractStorage(ABC):
                 appropriate query.
             sort: A list of columns to sort by.
             asc: Whether to sort ascending or descending.
+            limit: The maximum number of rows to return. Implementations should let the backend apply it.
+            batch_size: The number of rows to read from the backend at once, if the backend supports it.
+            columns: The columns to return, or None for all columns. Implementations should let the backend
+                select them, so that other columns are never read or transferred.
         """
         raise NotImplementedError
 
-    def get(self, table: str, as_dataframe: bool = False) -> List:
+    def find(
+        self,
+        table: str,
+        query: List[Tuple] = None,
+        sort: List[str] = None,
+        asc: bool = True,
+        limit: int = None,
+        columns: List[str] = None,
+    ) -> List:
+        """
+        Find rows in a table that match the query. See iter_find for the parameters.
+        """
+        return list(self.iter_find(table, query, sort, asc, limit, columns=columns))
+
+    def iter_find_chunks(
+        self,
+        table: str,
+        query: List[Tuple] = None,
+        sort: List[str] = None,
+        asc: bool = True,
+        chunk_size: int = 10000,
+        columns: List[str] = None,
+    ) -> Iterator[List[dict]]:
+        """
+        Find rows in a table that match the query, and yield them in lists of at most chunk_size rows. Only
+        one chunk is held in memory at a time. See iter_find for the other parameters.
+        """
+        rows = self.iter_find(
+            table, query, sort, asc, batch_size=chunk_size, columns=columns
+        )
+        return batched(rows, chunk_size)
+
+    def get(
+        self, table: str, as_dataframe: bool = False, columns: List[str] = None
+    ) -> List:
         """
         Get all rows in a table.
 
         Parameters:
             table: The name of the table to query.
+            as_dataframe: Whether to return a DataFrame instead of a list of rows.
+            columns: The columns to return, or None for all columns.
         """
-        result = self.find(table)
         if as_dataframe:
-            result = pd.DataFrame(result)
+            return self.find_frame(table, columns=columns)
+        return self.find(table, columns=columns)
+
+    def find_frame(
+        self,
+        table: str,
+        query: List[Tuple] = None,
+        sort: List[str] = None,
+        asc: bool = True,
+        columns: List[str] = None,
+        batch_size: int = 10000,
+        typed: bool = False,
+    ) -> pd.DataFrame:
+        """
+        Find rows in a table that match the query, and return them as a DataFrame. By default, pandas infers
+        the dtypes from the rows. If typed, the rows are read in batches of batch_size, and each batch is
+        converted into one array per column with the dtypes derived from the json_schema of the table, for
+        example Int64 for an integer column with missing values. Both are built from the rows that the backend
+        decoded, and the typed path is slower than letting pandas infer the dtypes. See iter_find for the
+        other parameters.
+        """
+        if not typed:
+            rows = self.find(table, query, sort, asc, columns=columns)
+            return pd.DataFrame(rows, columns=columns)
+        frames = list(
+            self.iter_find_frames(table, query, sort, asc, columns, batch_size, typed)
+        )
+        if not frames:
+            return pd.DataFrame(columns=columns)
+        return pd.concat(frames, ignore_index=True)
+
+    def iter_find_frames(
+        self,
+        table: str,
+        query: List[Tuple] = None,
+        sort: List[str] = None,
+        asc: bool = True,
+        columns: List[str] = None,
+        batch_size: int = 10000,
+        typed: bool = False,
+    ) -> Iterator[pd.DataFrame]:
+        """
+        Find rows in a table that match the query, and yield them as DataFrames of at most batch_size rows,
+        with dtypes like in find_frame. Only one batch is held in memory at a time. See iter_find for the
+        other parameters.
+        """
+        dtypes = {}
+        if typed:
+            try:
+                dtypes = self.metadata.get_table(table).get_dtypes()
+            except Exception:
+                pass
+        for batch in self.iter_find_chunks(
+            table, query, sort, asc, batch_size, columns
+        ):
+            if not typed:
+                yield pd.DataFrame(batch, columns=columns)
+                continue
+            yield pd.DataFrame(self._decode_columns(batch, columns, dtypes), copy=False)
+
+    @staticmethod
+    def _decode_columns(
+        batch: List[dict], columns: Optional[List[str]], dtypes: Dict[str, str]
+    ) -> Dict[str, Any]:
+        """
+        Convert a batch of rows into an array per column. Use the dtype of the column if it has one, and if
+        the values fit it. Otherwise return the values, so that pandas infers the type like it does for a list
+        of rows.
+        """
+        if columns is None:
+            columns = list(dict.fromkeys(key for row in batch for key in row))
+        result = {}
+        for column in columns:
+            values = [row.get(column) for row in batch]
+            result[column] = values
+            if column in dtypes:
+                try:
+                    result[column] = pd.array(values, dtype=dtypes[column])
+                except (TypeError, ValueError):
+                    pass
         return result
 
     def overwrite(self, data: pd.DataFrame, table: str) -> None:
         """
-        Overwrite the full contents of a table with a dataframe.
+        Overwrite the full contents of a table with a dataframe. Like in upsert, the timestamp column is
+        normalized first.
         """
+        timestamp_col = self.metadata.get_table(table).timestamp_col
+        if timestamp_col in data:
+            data = data.assign(**{timestamp_col: data[timestamp_col].map(to_utc)})
+        self._invalidate(table)
         self._overwrite(data, table)
 
-    def upsert(self, data: List, table_name: str) -> None:
+    def upsert(self, data: Iterable, table_name: str) -> UpsertResult:
         """
-        Add updated_at, and then call _upsert.
+        Add updated_at, normalize the timestamp column, and then call _upsert. If the table detects changes,
+        add the row_hash and skip the rows of which it did not change.
         """
         updated_at = now().isoformat()
-        data = map(lambda x: {**x, "updated_at": updated_at}, data)
         table = self.metadata.get_table(table_name)
-        self._upsert(data, table_name, table.key_col, table.timestamp_col)
+        if table_name == "runmoments":
+            data = self._invalidate_runmoments(data)
+        data = map(
+            lambda x: self._normalize_timestamp(
+                {**x, "updated_at": updated_at}, table.timestamp_col
+            ),
+            data,
+        )
+        skipped = UpsertResult()
+        if table.detect_changes:
+            data = self._skip_unchanged(data, table, skipped)
+        result = self._upsert(data, table_name, table.key_col, table.timestamp_col)
+        return result + skipped
+
+    def _skip_unchanged(
+        self, data: Iterable[dict], table: TableMetadata, skipped: UpsertResult
+    ) -> Iterator[dict]:
+        """
+        Add the row_hash to each row, and only yield the rows that are new or of which the hash changed. The
+        stored hashes are read in batches, so that each batch costs a single read of only the key and hash.
+        The number of skipped rows is counted in skipped.
+        """
+        for batch in batched(data, 1000):
+            for row in batch:
+                row["row_hash"] = self._get_row_hash(row)
+            keys = [row[table.key_col] for row in batch]
+            hashes = self._find_hashes(table.name, table.key_col, keys)
+            for row in batch:
+                if hashes.get(row[table.key_col]) == row["row_hash"]:
+                    skipped.skipped += 1
+                else:
+                    yield row
+
+    @staticmethod
+    def _get_row_hash(row: dict) -> str:
+        """
+        Get a digest of the contents of a row, excluding updated_at and the row_hash itself.
+        """
+        contents = {k: v for k, v in row.items() if k not in ["updated_at", "row_hash"]}
+        encoded = json.dumps(contents, sort_keys=True, default=str).encode()
+        return hashlib.blake2b(encoded, digest_size=16).hexdigest()
+
+    def _find_hashes(self, table: str, key_col: str, keys: List[Any]) -> Dict[Any, str]:
+        """
+        Get the stored row_hash of the rows with the keys.
+        """
+        rows = self.iter_find(
+            table, [(key_col, "in", keys)], columns=[key_col, "row_hash"]
+        )
+        return {row[key_col]: row.get("row_hash") for row in rows}
 
     def insert(self, data: List, table: str) -> None:
         """
-        Add inserted_at, and then call _insert.
+        Add inserted_at, normalize the timestamp column if the table has metadata, and then call _insert.
         """
         inserted_at = now().isoformat()
-        data = map(lambda x: {**x, "inserted_at": inserted_at}, data)
+        self._invalidate(table)
+        try:
+            timestamp_col = self.metadata.get_table(table).timestamp_col
+        except Exception:
+            timestamp_col = None
+        data = map(
+            lambda x: self._normalize_timestamp(
+                {**x, "inserted_at": inserted_at}, timestamp_col
+            ),
+            data,
+        )
         self._insert(data, table)
 
+    @staticmethod
+    def _normalize_timestamp(row: dict, timestamp_col: Optional[str]) -> dict:
+        """
+        Store the timestamp column as a native datetime in UTC, so that storage compares it as a point in
+        time, instead of as a string that can have any offset.
+        """
+        if timestamp_col in row:
+            row[timestamp_col] = to_utc(row[timestamp_col])
+        return row
+
+    def migrate_timestamps(self, table_name: str) -> int:
+        """
+        Convert the timestamp column of rows that were stored before timestamps were normalized, from ISO
+        strings to native datetimes in UTC. Only the timestamp column is upserted, the other columns and
+        updated_at are left as is. Return the number of converted rows.
+        """
+        table = self.metadata.get_table(table_name)
+        rows = self.iter_find(table_name, columns=[table.key_col, table.timestamp_col])
+        rows = (
+            self._normalize_timestamp(row, table.timestamp_col)
+            for row in rows
+            if isinstance(row.get(table.timestamp_col), str)
+        )
+        result = self._upsert(rows, table_name, table.key_col, table.timestamp_col)
+        self.logger.info(
+            f"Migrated the timestamps of {result.matched} rows of {table_name}"
+        )
+        return result.matched
+
+    def flush(self) -> None:
+        """
+        Write any buffered writes to the backend. Storage classes that write directly have nothing to flush.
+        """
+
+    def migrate_layout(self, table_name: str) -> int:
+        """
+        Move rows that are stored in an older layout into the layout declared in the metadata of the table.
+        Return the number of moved rows. Storage classes with a single layout have nothing to move.
+        """
+        return 0
+
+    def aggregate(self, table: str, pipeline: List[dict]) -> Iterator[dict]:
+        """
+        Run an aggregation pipeline, in MongoDB syntax, on the rows of a table in the backend, and yield its
+        output. Only storage classes that support pushdown implement it.
+        """
+        raise NotImplementedError
+
+    def merge_pipeline(
+        self, source: str, pipeline: List[dict], destination: str
+    ) -> None:
+        """
+        Run an aggregation pipeline, in MongoDB syntax, on the rows of the source table in the backend, and
+        upsert its output into the destination table by its key_col. The rows are never read into Python. Only
+        storage classes that support pushdown implement it.
+        """
+        raise NotImplementedError
+
     def find_one(
         self, table: str, query: dict, sort: List[str] = [], asc: bool = True
     ) -> Optional[dict]:
         """
-        Find one row in a table that matches the query.
+        Find one row in a table that matches the query. Only one row is read from the backend.
         """
-        result = self.find(table, query, sort, asc)
-        return result[0] if result else None
+        return next(self.iter_find(table, query, sort, asc, limit=1), None)
 
     def get_last_runmoment(self, source: str) -> datetime:
         """
         Get the last timestamp from the runmoments table. This is used to determine the window of data
         to load. Return 2020-01-01 if there is no timestamp in the runmoments table.
+        The result is cached for runmoment_ttl seconds, so that repeated runs do not read it again.
         """
+        cached = self._runmoments.get(source)
+        if cached is not None and time.monotonic() - cached[1] < self.runmoment_ttl:
+            return cached[0]
         result = self.find_one("runmoments", [("source", "eq", source)])
-        return (
-            datetime.fromisoformat(result["timestamp"])
-            if result
-            else datetime(2020, 1, 1)
-        )
+        timestamp = to_local(result["timestamp"]) if result else datetime(2020, 1, 1)
+        self._runmoments[source] = (timestamp, time.monotonic())
+        return timestamp
 
     def set_last_runmoment(self, source: str, timestamp: datetime) -> None:
         """
-        Set the last timestamp in the runmoments table. Use the upsert method.
+        Set the last timestamp in the runmoments table. Use the upsert method, which stores it in UTC.
+        Write it through to the cache once it is stored.
         """
-        data = [{"source": source, "timestamp": timestamp.isoformat()}]
+        data = [{"source": source, "timestamp": timestamp}]
         self.upsert(data, "runmoments")
+        self._runmoments[source] = (to_local(to_utc(timestamp)), time.monotonic())
         self.logger.info(f"Updated runmoment of {source} to {timestamp}")
 
+    def _invalidate(self, table: str) -> None:
+        """
+        Clear the cached runmoments if the runmoments table is inserted into or overwritten.
+        """
+        if table == "runmoments":
+            self._runmoments.clear()
+
+    def _invalidate_runmoments(self, rows: Iterable[dict]) -> Iterator[dict]:
+        """
+        Remove the cached runmoment of each upserted row, while the rows are passed on.
+        """
+        for row in rows:
+            self._runmoments.pop(row.get("source"), None)
+            yield row
+
     def get_window(self, source: str) -> Tuple[datetime, datetime]:
         """
         Get the window of data to load. This is the last timestamp in the runmoments table and the
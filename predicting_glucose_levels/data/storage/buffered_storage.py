@@ -0,0 +1,253 @@
+import time
+from datetime import datetime
+from logging import LoggerAdapter
+from threading import RLock
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import pandas as pd
+from kink import inject
+
+from predicting_glucose_levels.data.metadata import Metadata
+from predicting_glucose_levels.data.storage.abstract_storage import AbstractStorage
+from predicting_glucose_levels.data.storage.upsert_result import UpsertResult
+from predicting_glucose_levels.helpers.general import to_local
+
+
+class BufferedStorage(AbstractStorage):
+    """
+    The BufferedStorage class wraps another storage, and buffers its writes, so that many small writes become a
+    few large ones.
+
+    Upserts are buffered per table and coalesced by key: a row is merged into the buffered row with the same
+    key, and the row with the latest timestamp_col wins. Inserts are buffered as is. The buffers are flushed
+    when they hold max_rows rows, when a write arrives max_age seconds after the oldest buffered write, on
+    flush(), and when the storage is used as a context manager and the context exits.
+
+    Config tables, such as the runmoments, are always flushed after all other tables. A runmoment is
+    therefore never stored before the data it covers, also if a flush fails halfway.
+
+    Reads see the buffered writes: a read of a table first flushes that table, and the last runmoment is
+    read from the buffer if it has one.
+
+    Attributes:
+        storage: The storage that the writes are flushed to.
+        max_rows: The number of buffered rows at which the buffers are flushed.
+        max_age: The number of seconds after which buffered writes are flushed.
+    """
+
+    storage: AbstractStorage
+    max_rows: int
+    max_age: float
+
+    @inject
+    def __init__(
+        self,
+        storage: AbstractStorage,
+        metadata: Metadata,
+        logger: LoggerAdapter,
+        max_rows: int = 50000,
+        max_age: float = 60,
+    ):
+        super().__init__(metadata, logger)
+        self.storage = storage
+        self.max_rows = max_rows
+        self.max_age = max_age
+        self._upserts: Dict[str, Dict[Any, dict]] = {}
+        self._inserts: Dict[str, List[dict]] = {}
+        self._columns: Dict[str, Tuple[str, str]] = {}
+        self._rows = 0
+        self._oldest: Optional[float] = None
+        self._lock = RLock()
+
+    def __enter__(self) -> "BufferedStorage":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.flush()
+
+    def setup(self) -> None:
+        self.storage.setup()
+
+    def convert_query(self, query: List[Tuple] = None) -> Any:
+        return self.storage.convert_query(query)
+
+    def _upsert(
+        self, data: Iterable, table: str, key_col: str, timestamp_col: str
+    ) -> UpsertResult:
+        """
+        Buffer the rows, coalesced by key. The counts of the rows are only known once they are flushed, so
+        an empty result is returned. The counts are logged on flush.
+        """
+        with self._lock:
+            rows = self._upserts.setdefault(table, {})
+            self._columns[table] = (key_col, timestamp_col)
+            for row in data:
+                key = row[key_col]
+                if key not in rows:
+                    rows[key] = row
+                    self._rows += 1
+                elif self._is_newer(row, rows[key], timestamp_col):
+                    rows[key] = {**rows[key], **row}
+                else:
+                    rows[key] = {**row, **rows[key]}
+            self._after_write()
+        return UpsertResult()
+
+    @staticmethod
+    def _is_newer(row: dict, buffered: dict, timestamp_col: str) -> bool:
+        """
+        Check whether a row wins over the buffered row with the same key: if its timestamp is not older. If
+        either has no timestamp, the latest write wins.
+        """
+        new, old = row.get(timestamp_col), buffered.get(timestamp_col)
+        if new is None or old is None:
+            return True
+        try:
+            return new >= old
+        except TypeError:
+            return True
+
+    def _insert(self, data: List, table: str) -> None:
+        with self._lock:
+            rows = list(data)
+            self._inserts.setdefault(table, []).extend(rows)
+            self._rows += len(rows)
+            self._after_write()
+
+    def _after_write(self) -> None:
+        """
+        Start the age of the buffers at their first write, and flush them if they are too large or too old.
+        """
+        if self._oldest is None:
+            self._oldest = time.monotonic()
+        if self._rows >= self.max_rows:
+            self.flush()
+        elif time.monotonic() - self._oldest >= self.max_age:
+            self.flush()
+
+    def _overwrite(self, data: pd.DataFrame, table: str) -> None:
+        """
+        Drop the buffered writes of the table, because the overwrite replaces them, and overwrite it directly.
+        """
+        with self._lock:
+            self._rows -= len(self._upserts.pop(table, {}))
+            self._rows -= len(self._inserts.pop(table, []))
+            self.storage._overwrite(data, table)
+
+    def flush(self, tables: List[str] = None) -> None:
+        """
+        Write the buffered rows to the storage. Other tables are written before config tables. If tables is
+        given, only flush those tables. A config table among them flushes all tables, to keep that order.
+        """
+        with self._lock:
+            buffered = list(dict.fromkeys([*self._upserts, *self._inserts]))
+            if tables is not None and not any(self._is_config(t) for t in tables):
+                buffered = [t for t in buffered if t in tables]
+            for table in sorted(buffered, key=self._is_config):
+                self._flush_table(table)
+            if not self._upserts and not self._inserts:
+                self._oldest = None
+            self.storage.flush()
+
+    def _flush_table(self, table: str) -> None:
+        """
+        Write the buffered rows of one table, and remove them from the buffer once they are written.
+        """
+        if table in self._inserts:
+            rows = self._inserts[table]
+            self.storage._insert(rows, table)
+            self._rows -= len(rows)
+            del self._inserts[table]
+        if table in self._upserts:
+            rows = self._upserts[table]
+            result = self.storage._upsert(rows.values(), table, *self._columns[table])
+            self._rows -= len(rows)
+            del self._upserts[table]
+            self.logger.info(f"Flushed {len(rows)} rows to {table}: {result}")
+
+    def _is_config(self, table: str) -> bool:
+        try:
+            return self.metadata.get_table(table).type == "config_table"
+        except Exception:
+            return False
+
+    def iter_find(
+        self,
+        table: str,
+        query: List[Tuple] = None,
+        sort: List[str] = None,
+        asc: bool = True,
+        limit: int = None,
+        batch_size: int = None,
+        columns: List[str] = None,
+    ) -> Iterator[dict]:
+        """
+        Flush the table, and find the rows in the storage.
+        """
+        self.flush([table])
+        return self.storage.iter_find(
+            table, query, sort, asc, limit, batch_size, columns
+        )
+
+    def find_frame(
+        self,
+        table: str,
+        query: List[Tuple] = None,
+        sort: List[str] = None,
+        asc: bool = True,
+        columns: List[str] = None,
+        batch_size: int = 10000,
+        typed: bool = False,
+    ) -> pd.DataFrame:
+        """
+        Flush the table, and find the rows in the storage, which may read them as a DataFrame directly.
+        """
+        self.flush([table])
+        return self.storage.find_frame(
+            table, query, sort, asc, columns, batch_size, typed
+        )
+
+    def _find_hashes(self, table: str, key_col: str, keys: List[Any]) -> Dict[Any, str]:
+        """
+        Get the row_hash of buffered rows from the buffer, and of the other rows from the storage, without
+        flushing the table.
+        """
+        with self._lock:
+            buffered = self._upserts.get(table, {})
+            result = {k: buffered[k].get("row_hash") for k in keys if k in buffered}
+        missing = [k for k in keys if k not in result]
+        if missing:
+            result.update(self.storage._find_hashes(table, key_col, missing))
+        return result
+
+    def get_last_runmoment(self, source: str) -> datetime:
+        """
+        Get the last runmoment from the buffer if it has one, so that reading it does not flush all tables.
+        """
+        with self._lock:
+            buffered = self._upserts.get("runmoments", {}).get(source)
+        if buffered is not None:
+            return to_local(buffered["timestamp"])
+        return super().get_last_runmoment(source)
+
+    @property
+    def supports_pushdown(self) -> bool:
+        return self.storage.supports_pushdown
+
+    def aggregate(self, table: str, pipeline: List[dict]) -> Iterator[dict]:
+        self.flush([table])
+        return self.storage.aggregate(table, pipeline)
+
+    def merge_pipeline(
+        self, source: str, pipeline: List[dict], destination: str
+    ) -> None:
+        """
+        Flush the source and destination tables, so that the pipeline reads and merges into the stored rows,
+        and run it in the storage.
+        """
+        self.flush([source, destination])
+        self.storage.merge_pipeline(source, pipeline, destination)
+
+    def migrate_layout(self, table_name: str) -> int:
+        self.flush()
+        return self.storage.migrate_layout(table_name)
@@ -0,0 +1,271 @@
+import operator
+from bisect import bisect_left, bisect_right
+from itertools import count, islice
+from logging import LoggerAdapter
+from threading import RLock
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import pandas as pd
+from kink import inject
+
+from predicting_glucose_levels.data.metadata import Metadata
+from predicting_glucose_levels.data.storage.abstract_storage import AbstractStorage
+from predicting_glucose_levels.data.storage.upsert_result import UpsertResult
+from predicting_glucose_levels.data.table_metadata import TableMetadata
+
+OPERATORS = {
+    "eq": operator.eq,
+    "gt": operator.gt,
+    "gte": operator.ge,
+    "lt": operator.lt,
+    "lte": operator.le,
+    "in": lambda value, values: value in values,
+    "ne": operator.ne,
+    "nin": lambda value, values: value not in values,
+}
+# Operators of which the condition can only hold if the column has a value
+RANGE_OPERATORS = ["eq", "gt", "gte", "lt", "lte"]
+
+
+class InMemoryTable:
+    """
+    The rows of a table, by key, and a sorted index on a time column.
+
+    Attributes:
+        key_col: The column that identifies a row, or None if rows get a generated key.
+        index_col: The indexed column, or None if the table has no index.
+        rows: The rows, by key.
+        values: The sorted values of the index_col of the rows that have one.
+        keys: The keys of the rows, in the order of values.
+    """
+
+    key_col: Optional[str]
+    index_col: Optional[str]
+    rows: Dict[Any, dict]
+    values: List[Any]
+    keys: List[Any]
+
+    def __init__(self, key_col: Optional[str], index_col: Optional[str]):
+        self.key_col = key_col
+        self.index_col = index_col
+        self.rows = {}
+        self.values = []
+        self.keys = []
+        self._generated_keys = count()
+
+    def get_key(self, row: dict) -> Any:
+        """
+        Get the key of a row, or generate one if it has no value in the key_col.
+        """
+        if row.get(self.key_col) is None:
+            return next(self._generated_keys)
+        return row[self.key_col]
+
+    def put(self, key: Any, row: dict) -> None:
+        """
+        Store a row under a key, and keep the index up to date.
+        """
+        if key in self.rows:
+            self._unindex(key, self.rows[key])
+        self.rows[key] = row
+        value = row.get(self.index_col) if self.index_col else None
+        if value is not None:
+            position = bisect_right(self.values, value)
+            self.values.insert(position, value)
+            self.keys.insert(position, key)
+
+    def _unindex(self, key: Any, row: dict) -> None:
+        value = row.get(self.index_col) if self.index_col else None
+        if value is None:
+            return
+        position = bisect_left(self.values, value)
+        while self.keys[position] != key:
+            position += 1
+        del self.values[position]
+        del self.keys[position]
+
+    def range(self, query: List[Tuple]) -> Optional[List[Any]]:
+        """
+        Get the keys of the rows that can match the conditions of the query on the index_col, in the order of
+        the index. Return None if the query has no such conditions, then all rows must be scanned.
+        """
+        conditions = [
+            (op, value)
+            for column, op, value in query
+            if column == self.index_col and op in RANGE_OPERATORS and value is not None
+        ]
+        if not conditions:
+            return None
+        start, end = 0, len(self.values)
+        try:
+            for op, value in conditions:
+                if op in ["gt", "gte", "eq"]:
+                    bound = bisect_right if op == "gt" else bisect_left
+                    start = max(start, bound(self.values, value, start, end))
+                if op in ["lt", "lte", "eq"]:
+                    bound = bisect_left if op == "lt" else bisect_right
+                    end = min(end, bound(self.values, value, start, end))
+        except TypeError:
+            return None
+        return self.keys[start:end]
+
+
+class InMemoryStorage(AbstractStorage):
+    """
+    The InMemoryStorage class keeps the data in memory. It is meant for tests and benchmarks, to run the
+    pipelines at scale without a database, and to profile the Python side in isolation.
+
+    Each table is a map of rows by their key_col, and a sorted index on the partition column from the
+    metadata. Queries with a range on that column bisect the index, queries on the key_col look up the keys,
+    other queries scan all rows. Like in MongoDB, conditions on a missing column compare against None.
+
+    Attributes:
+        tables: The tables, by name.
+    """
+
+    tables: Dict[str, InMemoryTable]
+
+    @inject
+    def __init__(self, metadata: Metadata, logger: LoggerAdapter):
+        super().__init__(metadata, logger)
+        self.tables = {}
+        self._lock = RLock()
+
+    def setup(self) -> None:
+        pass
+
+    def convert_query(self, query: List[Tuple] = None) -> Any:
+        """
+        Convert the query into a function that checks whether a row matches all of its conditions.
+        Comparisons between values of different types do not match.
+        """
+        conditions = [(c, OPERATORS[op], v) for c, op, v in query or []]
+
+        def matches(row: dict) -> bool:
+            try:
+                return all(compare(row.get(c), v) for c, compare, v in conditions)
+            except TypeError:
+                return False
+
+        return matches
+
+    def iter_find(
+        self,
+        table: str,
+        query: List[Tuple] = None,
+        sort: List[str] = None,
+        asc: bool = True,
+        limit: int = None,
+        batch_size: int = None,
+        columns: List[str] = None,
+    ) -> Iterator[dict]:
+        """
+        Find rows in a table that match the query. The candidate rows are selected while holding the lock,
+        after which copies of the matching rows are yielded. Rows that are selected by the index are already
+        sorted by it.
+        """
+        query = query or []
+        sort = sort or []
+        data = self._get_table(table)
+        with self._lock:
+            keys, indexed = self._get_candidates(data, query)
+            rows = [data.rows[key] for key in keys if key in data.rows]
+        matches = self.convert_query(query)
+        rows = [row for row in rows if matches(row)]
+        if sort and not (indexed and sort == [data.index_col]):
+            rows.sort(key=lambda r: self._sort_key(r, sort))
+        if sort and not asc:
+            rows.reverse()
+        rows = islice(rows, limit) if limit else iter(rows)
+        if columns:
+            return ({c: row[c] for c in columns if c in row} for row in rows)
+        return (dict(row) for row in rows)
+
+    def _get_candidates(
+        self, data: InMemoryTable, query: List[Tuple]
+    ) -> Tuple[List[Any], bool]:
+        """
+        Get the keys of the rows that can match the query: the keys of a condition on the key_col, the keys in
+        the range of the index, or all keys. Also return whether the keys are in the order of the index.
+        """
+        for column, op, value in query:
+            if column == data.key_col and op == "eq":
+                return [value], False
+            if column == data.key_col and op == "in":
+                return list(dict.fromkeys(value)), False
+        in_range = data.range(query)
+        return (list(data.rows), False) if in_range is None else (in_range, True)
+
+    @staticmethod
+    def _sort_key(row: dict, sort: List[str]) -> tuple:
+        """
+        Get the sort key of a row, on which missing values come first, like in MongoDB.
+        """
+        return tuple((row.get(c) is not None, row.get(c)) for c in sort)
+
+    def _upsert(
+        self, data: Iterable, table: str, key_col: str, timestamp_col: str
+    ) -> UpsertResult:
+        """
+        Upsert the rows by key_col. Like a MongoDB update, the columns of a row are set on the existing row.
+        """
+        rows = self._get_table(table, key_col)
+        matched = upserted = modified = 0
+        with self._lock:
+            for row in data:
+                key = row[key_col]
+                existing = rows.rows.get(key)
+                if existing is None:
+                    upserted += 1
+                    rows.put(key, dict(row))
+                    continue
+                merged = {**existing, **row}
+                matched += 1
+                modified += merged != existing
+                rows.put(key, merged)
+        return UpsertResult(matched, upserted, modified)
+
+    def _insert(self, data: List, table: str) -> None:
+        """
+        Insert the rows. Rows of tables without metadata get a generated key.
+        """
+        rows = self._get_table(table)
+        with self._lock:
+            for row in data:
+                rows.put(rows.get_key(row), dict(row))
+
+    def _overwrite(self, data: pd.DataFrame, table: str) -> None:
+        """
+        Replace the table by a new table with the data. The rows and index of the new table are built first,
+        and then swapped in while holding the lock, so readers see either the old or the new table.
+        """
+        rows = self._new_table(table)
+        for row in data.to_dict("records"):
+            rows.put(rows.get_key(row), row)
+        with self._lock:
+            self.tables[table] = rows
+
+    def _get_table(self, table: str, key_col: str = None) -> InMemoryTable:
+        """
+        Get a table, or create it.
+        """
+        with self._lock:
+            if table not in self.tables:
+                self.tables[table] = self._new_table(table, key_col)
+            return self.tables[table]
+
+    def _new_table(self, table: str, key_col: str = None) -> InMemoryTable:
+        """
+        Create an empty table. Its key_col and index are taken from the metadata, if it has any.
+        """
+        metadata = self._get_metadata(table)
+        return InMemoryTable(
+            metadata.key_col if metadata else key_col,
+            metadata.get_partition_col() if metadata else None,
+        )
+
+    def _get_metadata(self, table: str) -> Optional[TableMetadata]:
+        try:
+            return self.metadata.get_table(table)
+        except Exception:
+            return None
@@ -1,28 +1,45 @@
 from ast import Tuple
+from datetime import datetime, timedelta, timezone
 from logging import LoggerAdapter
-from typing import Any, List
+from typing import Any, Dict, Iterable, Iterator, List, Optional
 
 import pandas as pd
 from kink import inject
 from prefect.logging.loggers import PrefectLogAdapter
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateMany, UpdateOne
 from pymongo.database import Database
 
 from predicting_glucose_levels.data.metadata import Metadata
 from predicting_glucose_levels.data.storage.abstract_storage import AbstractStorage
+from predicting_glucose_levels.data.storage.upsert_result import UpsertResult
+from predicting_glucose_levels.data.table_metadata import TableMetadata
+from predicting_glucose_levels.helpers.general import batched, to_utc
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
 
 
 class MongoStorage(AbstractStorage):
     """
     The MongoStorage class is used to store data in a MongoDB database.
 
+    Tables with a bucket_col in their metadata are stored in bucket documents. Each bucket holds the rows of
+    bucket_hours, as {"_id": <start of the bucket>, "start": <min>, "end": <max>, "rows": [<row>, ...]}, where
+    start and end are the bounds of the bucket_col of its rows. Reads unwind the buckets, so the layout is
+    invisible to the callers of find and upsert.
+
+    Aggregation pipelines can be pushed down: they run on the server, and their output is merged into the
+    destination table with $merge, so that transformations never transfer the rows.
+
     Attributes:
         client: The MongoDB client.
         database: The MongoDB database.
+        batch_size: The number of rows that are sent to MongoDB in a single bulk write.
     """
 
     client: MongoClient
     database: Database
+    batch_size: int
+    supports_pushdown = True
 
     @inject
     def __init__(
@@ -31,6 +48,7 @@ class MongoStorage(AbstractStorage):
         database: Database,
         metadata: Metadata,
         logger: LoggerAdapter,
+        batch_size: int = 1000,
     ):
         """
         Create a connection to the MongoDB database.
@@ -38,6 +56,8 @@ class MongoStorage(AbstractStorage):
         super().__init__(metadata, logger)
         self.client = client
         self.database = database
+        self.batch_size = batch_size
+        self._checked_queries = set()
 
     def setup(self):
         self.test_connection()
@@ -45,57 +65,313 @@ class MongoStorage(AbstractStorage):
 
     def convert_query(self, query: List[Tuple] = None) -> Any:
         """
-        Each operator is simply prefixed with a $. The list is converted to a dictionary.
+        Each operator is simply prefixed with a $. The list is converted to a dictionary. Multiple operators
+        on the same column are combined, for example into a range.
         """
-        query = query or []
-        return {q[0]: {f"${q[1]}": q[2]} for q in query}
+        result = {}
+        for column, operator, value in query or []:
+            result.setdefault(column, {})[f"${operator}"] = value
+        return result
 
-    def find(
+    def iter_find(
         self,
         table: str,
         query: List[Tuple] = None,
         sort: List[str] = None,
         asc: bool = True,
-    ) -> List:
+        limit: int = None,
+        batch_size: int = None,
+        columns: List[str] = None,
+    ) -> Iterator[dict]:
         """
-        Find rows in a table that match the query. A query is a dictionary of key-equals-value pairs.
+        Find rows in a table that match the query. Return the cursor, which fetches the rows from MongoDB in
+        batches of batch_size while it is iterated. The columns are sent as projection, _id is only
+        included if it is one of them.
         """
         sort = sort or []
+        self._check_index(table, query or [])
+        metadata = self._get_bucketed(table)
+        if metadata is not None:
+            return self._iter_find_buckets(
+                metadata, query or [], sort, asc, limit, batch_size, columns
+            )
         query = self.convert_query(query)
         sort = [(key, 1 if asc else -1) for key in sort]
-        result = self.database[table].find(query)
+        projection = None
+        if columns:
+            projection = {"_id": 0, **{column: 1 for column in columns}}
+        result = self.database[table].find(query, projection)
         if sort:
             result = result.sort(sort)
-        return list(result)
+        if limit:
+            result = result.limit(limit)
+        if batch_size:
+            result = result.batch_size(batch_size)
+        return result
+
+    def _iter_find_buckets(
+        self,
+        metadata: TableMetadata,
+        query: List[Tuple],
+        sort: List[str],
+        asc: bool,
+        limit: Optional[int],
+        batch_size: Optional[int],
+        columns: Optional[List[str]],
+    ) -> Iterator[dict]:
+        """
+        Find rows in a bucketed table. Conditions on the bucket_col first select the buckets by their bounds,
+        then the rows of those buckets are unwound and filtered, sorted, limited and projected as usual.
+        """
+        pipeline = []
+        bucket_query = self._bucket_query(metadata, query)
+        if bucket_query:
+            pipeline.append({"$match": self.convert_query(bucket_query)})
+        pipeline += [{"$unwind": "$rows"}, {"$replaceRoot": {"newRoot": "$rows"}}]
+        if query:
+            pipeline.append({"$match": self.convert_query(query)})
+        if sort:
+            pipeline.append({"$sort": {key: 1 if asc else -1 for key in sort}})
+        if limit:
+            pipeline.append({"$limit": limit})
+        if columns:
+            pipeline.append({"$project": {"_id": 0, **{c: 1 for c in columns}}})
+        options = {"batchSize": batch_size} if batch_size else {}
+        return self.database[metadata.name].aggregate(pipeline, **options)
 
-    def _upsert(self, data: List, table: str, key_col: str, timestamp_col: str) -> None:
+    @staticmethod
+    def _bucket_query(metadata: TableMetadata, query: List[Tuple]) -> List[Tuple]:
+        """
+        Convert the conditions of a query on the bucket_col into conditions on the bounds of the buckets. A
+        bucket can only contain matching rows if its end is after a lower bound, and its start before an upper
+        bound.
         """
-        Upsert each item. For now, simply loop over them and insert each one separately.
-        Also add an updated_at column.
+        result = []
+        for column, operator, value in query:
+            if column != metadata.bucket_col:
+                continue
+            if operator in ["gt", "gte", "eq"]:
+                result.append(("end", "gte" if operator == "eq" else operator, value))
+            if operator in ["lt", "lte", "eq"]:
+                result.append(("start", "lte" if operator == "eq" else operator, value))
+        return result
 
-        Todo: Speed up
+    def _upsert(
+        self, data: Iterable, table: str, key_col: str, timestamp_col: str
+    ) -> UpsertResult:
         """
+        Upsert the rows in batches of batch_size. Each batch is sent as a single unordered bulk write of
+        UpdateOne operations on the key_col. The data is consumed lazily, so only one batch is held in memory.
+        Rows with the same key within a batch are coalesced, the last one wins. This prevents an unordered
+        bulk write from inserting the same new key twice.
+        """
+        metadata = self._get_bucketed(table)
+        if metadata is not None:
+            return self._upsert_buckets(data, metadata)
         table = self.database[table]
-        for row in data:
-            table.update_one({key_col: row[key_col]}, {"$set": row}, upsert=True)
+        result = UpsertResult()
+        for batch in batched(data, self.batch_size):
+            rows = {row[key_col]: row for row in batch}
+            operations = [
+                UpdateOne({key_col: key}, {"$set": row}, upsert=True)
+                for key, row in rows.items()
+            ]
+            bulk_result = table.bulk_write(operations, ordered=False)
+            result += UpsertResult(
+                bulk_result.matched_count,
+                bulk_result.upserted_count,
+                bulk_result.modified_count,
+            )
+        return result
+
+    def _upsert_buckets(
+        self, data: Iterable, metadata: TableMetadata, collection: str = None
+    ) -> UpsertResult:
+        """
+        Upsert the rows of a bucketed table in batches of batch_size. Each batch is sent as a single ordered
+        bulk write: first the keys that already exist are pulled from whichever bucket holds them, then the
+        rows are pushed into the bucket of their bucket_col. A key therefore lives in exactly one bucket, also
+        if its bucket_col changed. Like in _upsert, the columns of a row are set on the existing row: the
+        stored rows of the batch are read first, and the merged rows are pushed. Pulled rows count as matched
+        and modified. The rows are written to the collection of the table, unless another collection is given.
+        """
+        collection = self.database[collection or metadata.name]
+        key_col = f"rows.{metadata.key_col}"
+        span = metadata.get_bucket_span()
+        result = UpsertResult()
+        for batch in batched(data, self.batch_size):
+            rows = {row[metadata.key_col]: row for row in batch}
+            keys = list(rows)
+            stored = collection.aggregate(
+                [
+                    {"$match": {key_col: {"$in": keys}}},
+                    {"$unwind": "$rows"},
+                    {"$replaceRoot": {"newRoot": "$rows"}},
+                    {"$match": {metadata.key_col: {"$in": keys}}},
+                ]
+            )
+            existing = {row[metadata.key_col]: row for row in stored}
+            buckets: Dict[datetime, List[dict]] = {}
+            for key, row in rows.items():
+                row = {**existing.get(key, {}), **row}
+                bucket = self._get_bucket(row[metadata.bucket_col], span)
+                buckets.setdefault(bucket, []).append(row)
+            operations = []
+            if existing:
+                pull = {"rows": {metadata.key_col: {"$in": list(existing)}}}
+                operations.append(
+                    UpdateMany({key_col: {"$in": list(existing)}}, {"$pull": pull})
+                )
+            for bucket, bucket_rows in buckets.items():
+                bounds = [to_utc(row[metadata.bucket_col]) for row in bucket_rows]
+                update = {
+                    "$push": {"rows": {"$each": bucket_rows}},
+                    "$min": {"start": min(bounds)},
+                    "$max": {"end": max(bounds)},
+                }
+                operations.append(UpdateOne({"_id": bucket}, update, upsert=True))
+            collection.bulk_write(operations, ordered=True)
+            result += UpsertResult(
+                len(existing), len(rows) - len(existing), len(existing)
+            )
+        return result
+
+    def aggregate(self, table: str, pipeline: List[dict]) -> Iterator[dict]:
+        """
+        Run an aggregation pipeline on the rows of a table. The buckets of a bucketed table are unwound first,
+        so that the pipeline sees rows.
+        """
+        if self._get_bucketed(table) is not None:
+            pipeline = [
+                {"$unwind": "$rows"},
+                {"$replaceRoot": {"newRoot": "$rows"}},
+                *pipeline,
+            ]
+        return self.database[table].aggregate(pipeline, batchSize=self.batch_size)
+
+    def merge_pipeline(
+        self, source: str, pipeline: List[dict], destination: str
+    ) -> None:
+        """
+        Run an aggregation pipeline on the rows of the source table, and merge its output into the destination
+        table on the server. See _merge_stages for how the output is merged.
+        """
+        stages = self._merge_stages(self.metadata.get_table(destination))
+        list(self.aggregate(source, [*pipeline, *stages]))
+
+    def _merge_stages(self, metadata: TableMetadata) -> List[dict]:
+        """
+        Get the stages that merge the output rows of a pipeline into a table. Rows are merged on the key_col:
+        the columns of a row are set on the existing row, like in _upsert. The _id of the output is dropped,
+        the table assigns its own. This relies on the unique index on the key_col.
+
+        Rows of a bucketed table are grouped into their buckets, which are merged on their _id: rows with a
+        key that the bucket already holds replace the stored rows, and the bounds are widened. Unlike
+        _upsert_buckets, a row of which the bucket_col moved to another bucket is not pulled from its old
+        bucket, so pipelines into bucketed tables should only write rows of which the bucket_col is fixed.
+        """
+        key_col = metadata.key_col
+        span = metadata.get_bucket_span()
+        if span is None:
+            merge = {"into": metadata.name, "on": key_col, "whenMatched": "merge"}
+            return [
+                {"$unset": "_id"},
+                {"$merge": {**merge, "whenNotMatched": "insert"}},
+            ]
+        time = f"${metadata.bucket_col}"
+        millis = {"$toLong": time}
+        span_ms = int(span.total_seconds() * 1000)
+        bucket = {"$toDate": {"$subtract": [millis, {"$mod": [millis, span_ms]}]}}
+        kept = {
+            "$filter": {
+                "input": "$rows",
+                "cond": {
+                    "$not": [{"$in": [f"$$this.{key_col}", f"$$new.rows.{key_col}"]}]
+                },
+            }
+        }
+        update = {
+            "rows": {"$concatArrays": [kept, "$$new.rows"]},
+            "start": {"$min": ["$start", "$$new.start"]},
+            "end": {"$max": ["$end", "$$new.end"]},
+        }
+        group = {
+            "_id": bucket,
+            "start": {"$min": time},
+            "end": {"$max": time},
+            "rows": {"$push": "$$ROOT"},
+        }
+        merge = {"into": metadata.name, "on": "_id", "whenMatched": [{"$set": update}]}
+        return [
+            {"$unset": "_id"},
+            {"$group": group},
+            {"$merge": {**merge, "whenNotMatched": "insert"}},
+        ]
+
+    @staticmethod
+    def _get_bucket(value: Any, span: timedelta) -> datetime:
+        """
+        Get the start of the bucket of a value of the bucket_col, in UTC.
+        """
+        return EPOCH + (to_utc(value) - EPOCH) // span * span
+
+    def _get_bucketed(self, table: str) -> Optional[TableMetadata]:
+        """
+        Get the metadata of the table if it is stored in buckets, otherwise None.
+        """
+        try:
+            metadata = self.metadata.get_table(table)
+        except Exception:
+            return None
+        return metadata if metadata.get_bucket_span() else None
 
     def _insert(self, data: List, table: str) -> None:
         """
-        Insert all items in the data list.
-        Also add an inserted_at column.
+        Insert all items in the data list, in batches of batch_size.
         """
-        if data:
-            table = self.database[table]
-            table.insert_many(data)
+        metadata = self._get_bucketed(table)
+        if metadata is not None:
+            self._upsert_buckets(data, metadata)
+            return
+        for batch in batched(data, self.batch_size):
+            self.database[table].insert_many(batch)
 
     def _overwrite(self, data: pd.DataFrame, table: str) -> None:
         """
-        Overwrite the full contents of a table with the data.
+        Overwrite the full contents of a table with the data, without readers ever seeing a partial table. The
+        data is converted and written in chunks of batch_size into a staging collection, which gets the
+        indexes of the table, and then replaces the table in a single atomic rename. If writing fails, the
+        table is left as is and the staging collection is dropped.
+
+        Indexes are built after the rows are written, which is faster than maintaining them per row. Bucketed
+        tables are the exception, their upsert looks up keys, so their indexes are built first.
         """
-        with self.client.start_session() as session:
-            with session.start_transaction():
-                self.database[table].drop()
-                self._insert(data.to_dict("records"), table)
+        try:
+            metadata = self.metadata.get_table(table)
+        except Exception:
+            metadata = None
+        bucketed = metadata is not None and metadata.get_bucket_span() is not None
+        staging = f"{table}_staging"
+        self.database[staging].drop()
+        self.database.create_collection(staging)
+        rows = (
+            row
+            for start in range(0, len(data), self.batch_size)
+            for row in data.iloc[start : start + self.batch_size].to_dict("records")
+        )
+        try:
+            if bucketed:
+                self._set_table_indexes(metadata, staging)
+                self._upsert_buckets(rows, metadata, staging)
+            else:
+                for batch in batched(rows, self.batch_size):
+                    self.database[staging].insert_many(batch)
+                if metadata is not None:
+                    self._set_table_indexes(metadata, staging)
+            self.database[staging].rename(table, dropTarget=True)
+        except Exception:
+            self.database[staging].drop()
+            raise
 
     def test_connection(self) -> None:
         """
@@ -109,19 +385,73 @@ class MongoStorage(AbstractStorage):
 
     def set_indexes(self) -> None:
         """
-        Set indexes on the tables.
-        - Index on glucose_measurement_id of glucose_measurements
+        Create the indexes declared in the metadata of each table. MongoDB creates a collection with its first
+        index, and creating an index that already exists is a no-op. This can therefore run on every setup.
         """
-        # Check if index already exists
-        if "glucose_measurements" not in self.database.list_collection_names():
-            return
+        for table in self.metadata.tables:
+            self._set_table_indexes(table)
 
-        if (
-            "glucose_measurement_id_index"
-            in self.database["glucose_measurements"].index_information()
-        ):
-            return
+    def _set_table_indexes(self, table: TableMetadata, collection: str = None) -> None:
+        """
+        Create the indexes of a table, on its own collection unless another collection is given. The indexes of a bucketed table are created on the columns of its rows,
+        and it gets an index on the bounds of its buckets. Those indexes are never unique, because a unique
+        index does not apply within a single bucket. Keys are unique because upserts pull them first.
+        """
+        bucketed = table.get_bucket_span() is not None
+        prefix = "rows." if bucketed else ""
+        for index in table.get_indexes():
+            keys = [(f"{prefix}{column}", order) for column, order in index["keys"]]
+            options = {"unique": index.get("unique", False) and not bucketed}
+            if index.get("partial"):
+                options["partialFilterExpression"] = self.convert_query(
+                    [(f"{prefix}{c}", o, v) for c, o, v in index["partial"]]
+                )
+            self.database[collection or table.name].create_index(keys, **options)
+        if bucketed:
+            self.database[collection or table.name].create_index(
+                [("end", 1), ("start", 1)]
+            )
 
-        self.database["glucose_measurements"].create_index(
-            "glucose_measurement_id", unique=True
+    def migrate_layout(self, table_name: str) -> int:
+        """
+        Move rows of a bucketed table that are still stored as separate documents into buckets. Their timestamp
+        column is normalized on the way, so that migrate_timestamps is not needed afterwards. The indexes of
+        the old layout are dropped and those of the buckets are created. Return the number of moved rows.
+        """
+        metadata = self._get_bucketed(table_name)
+        if metadata is None:
+            return 0
+        collection = self.database[table_name]
+        query = {"rows": {"$exists": False}}
+        if not collection.count_documents(query, limit=1):
+            return 0
+        collection.drop_indexes()
+        rows = (
+            self._normalize_timestamp(row, metadata.timestamp_col)
+            for row in collection.find(query, {"_id": 0})
         )
+        result = self._upsert_buckets(rows, metadata)
+        collection.delete_many(query)
+        self._set_table_indexes(metadata)
+        moved = result.upserted + result.matched
+        self.logger.info(f"Moved {moved} rows of {table_name} into buckets")
+        return moved
+
+    def _check_index(self, table: str, query: List[Tuple]) -> None:
+        """
+        Warn if a query would not use an index, because none of its columns is the first key of an index of
+        the table. Each combination of table and columns is only warned about once.
+        """
+        columns = tuple(sorted({q[0] for q in query}))
+        if not columns or (table, columns) in self._checked_queries:
+            return
+        self._checked_queries.add((table, columns))
+        try:
+            indexes = self.metadata.get_table(table).get_indexes()
+        except Exception:
+            return
+        prefixes = {"_id"} | {index["keys"][0][0] for index in indexes}
+        if not prefixes.intersection(columns):
+            self.logger.warning(
+                f"Query on {table} by {', '.join(columns)} does not use an index."
+            )
@@ -0,0 +1,482 @@
+import operator
+import os
+import shutil
+import uuid
+from datetime import datetime
+from itertools import chain, islice
+from logging import LoggerAdapter
+from threading import Lock, RLock
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from kink import inject
+
+from predicting_glucose_levels.data.metadata import Metadata
+from predicting_glucose_levels.data.storage.abstract_storage import AbstractStorage
+from predicting_glucose_levels.data.storage.upsert_result import UpsertResult
+from predicting_glucose_levels.data.table_metadata import TableMetadata
+from predicting_glucose_levels.helpers.general import batched, to_utc
+
+# The partition of rows without a value in the partition column
+NO_PARTITION = "none"
+OPERATORS = {
+    "eq": operator.eq,
+    "gt": operator.gt,
+    "gte": operator.ge,
+    "lt": operator.lt,
+    "lte": operator.le,
+    "in": lambda field, values: field.isin(values),
+    "ne": operator.ne,
+    "nin": lambda field, values: ~field.isin(values),
+}
+# The Arrow type of each type of the json_schema, and how values are converted to it
+ARROW_TYPES = {
+    "string": pa.string(),
+    "number": pa.float64(),
+    "integer": pa.int64(),
+    "boolean": pa.bool_(),
+}
+CONVERTERS = {"string": str, "number": float}
+
+
+class ParquetStorage(AbstractStorage):
+    """
+    The ParquetStorage class is used to store data in local Parquet files, for fast analytical scans.
+
+    Each table is a directory with one file per month of its partition column, <directory>/<table>/<YYYY-MM>.parquet.
+    Rows are sorted by the partition column within a file, so that the statistics of its row groups are
+    selective. A query first prunes the partitions by its conditions on the partition column, then the
+    remaining files are read with the conditions pushed down to their row groups, and with only the requested
+    columns.
+
+    Writes to a table hold the lock of that table, so that concurrent writers do not overwrite each other's
+    partitions. The partition of each key is read once per table and then kept up to date by the writes, so it
+    assumes that no other process writes to the directory.
+
+    Attributes:
+        directory: The directory in which the tables are stored.
+        batch_size: The number of rows that are merged into the partitions at once on upsert.
+        row_group_size: The maximum number of rows in a row group of a file.
+    """
+
+    directory: str
+    batch_size: int
+    row_group_size: int
+    _locks: Dict[str, RLock]
+    _keys: Dict[Tuple[str, str], Dict[Any, str]]
+
+    @inject
+    def __init__(
+        self,
+        directory: str,
+        metadata: Metadata,
+        logger: LoggerAdapter,
+        batch_size: int = 10000,
+        row_group_size: int = 4096,
+    ):
+        super().__init__(metadata, logger)
+        self.directory = directory
+        self.batch_size = batch_size
+        self.row_group_size = row_group_size
+        self._locks = {}
+        self._locks_lock = Lock()
+        self._keys = {}
+
+    def setup(self) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+
+    def convert_query(self, query: List[Tuple] = None) -> Any:
+        """
+        Convert the query into a pyarrow expression, in which all conditions must hold. Like in MongoDB, ne
+        and nin also match rows without a value. Return None for an empty query.
+        """
+        expression = None
+        for column, op, value in query or []:
+            field = ds.field(column)
+            condition = OPERATORS[op](field, value)
+            if op in ["ne", "nin"]:
+                condition = condition | field.is_null()
+            expression = condition if expression is None else expression & condition
+        return expression
+
+    def iter_find(
+        self,
+        table: str,
+        query: List[Tuple] = None,
+        sort: List[str] = None,
+        asc: bool = True,
+        limit: int = None,
+        batch_size: int = None,
+        columns: List[str] = None,
+    ) -> Iterator[dict]:
+        """
+        Find rows in a table that match the query. The partitions are read one at a time. If the rows are
+        sorted by the partition column, they are yielded while the partitions are read, otherwise all matching
+        rows are read before they are sorted. A partition is at most a month of rows, so it is read at once,
+        and batch_size is not used.
+        """
+        sort = sort or []
+        metadata = self._get_metadata(table)
+        paths = self._get_partitions(table, query or [])
+        if not asc:
+            paths = paths[::-1]
+        read_columns = list(dict.fromkeys(columns + sort)) if columns else None
+        tables = (self._read_table(path, query or [], read_columns) for path in paths)
+        rows = chain.from_iterable(
+            self._sort_table(t, sort, asc).to_pylist() for t in tables if t is not None
+        )
+        if sort and (metadata is None or sort[0] != metadata.get_partition_col()):
+            rows = iter(
+                sorted(rows, key=lambda r: self._sort_key(r, sort), reverse=not asc)
+            )
+        if columns:
+            rows = ({c: row[c] for c in columns if c in row} for row in rows)
+        return islice(rows, limit) if limit else rows
+
+    def find_frame(
+        self,
+        table: str,
+        query: List[Tuple] = None,
+        sort: List[str] = None,
+        asc: bool = True,
+        columns: List[str] = None,
+        batch_size: int = 10000,
+        typed: bool = False,
+    ) -> pd.DataFrame:
+        """
+        Find rows in a table that match the query, and return them as a DataFrame. The partitions are
+        converted to pandas directly, the rows are never converted to dicts. The frame is always typed by the
+        schema of the files: integers and booleans use the nullable pandas dtypes.
+        """
+        sort = sort or []
+        read_columns = list(dict.fromkeys(columns + sort)) if columns else None
+        types = {pa.int64(): pd.Int64Dtype(), pa.bool_(): pd.BooleanDtype()}
+        frames = [
+            t.to_pandas(types_mapper=types.get)
+            for path in self._get_partitions(table, query or [])
+            if (t := self._read_table(path, query or [], read_columns)) is not None
+        ]
+        if not frames:
+            return pd.DataFrame(columns=columns)
+        frame = pd.concat(frames, ignore_index=True)
+        if sort:
+            frame = frame.sort_values(sort, ascending=asc, ignore_index=True)
+        return frame[[c for c in columns if c in frame]] if columns else frame
+
+    def _upsert(
+        self, data: Iterable, table: str, key_col: str, timestamp_col: str
+    ) -> UpsertResult:
+        """
+        Upsert the rows in batches of batch_size, while holding the lock of the table. The partition of each
+        existing key is read from the key column of the files once, and then kept up to date. Per batch, only
+        the partitions that hold or receive its rows are read, merged and rewritten. Like a MongoDB update, the
+        columns of a row are set on the existing row, and a row moves to another partition if its partition
+        column changed.
+        """
+        metadata = self._get_metadata(table)
+        column = metadata.get_partition_col() if metadata else timestamp_col
+        types = metadata.get_types() if metadata else {}
+        directory = os.path.join(self.directory, table)
+        result = UpsertResult()
+        with self._get_lock(table):
+            locations = self._get_keys(table, key_col)
+            try:
+                for batch in batched(data, self.batch_size):
+                    result += self._upsert_batch(
+                        batch, directory, key_col, column, locations, types
+                    )
+            except Exception:
+                # The partitions of the keys may not match the files anymore
+                self._keys.pop((table, key_col), None)
+                raise
+        return result
+
+    def _upsert_batch(
+        self,
+        batch: List[dict],
+        directory: str,
+        key_col: str,
+        column: str,
+        locations: Dict[Any, str],
+        types: Dict[str, str],
+    ) -> UpsertResult:
+        """
+        Merge a batch of rows into the partitions that hold or receive them, and update the partition of each
+        key in locations. The columns are written with the types.
+        """
+        rows = {row[key_col]: row for row in batch}
+        partitions = {locations[key] for key in rows if key in locations}
+        partitions |= {self._partition_of(row.get(column)) for row in rows.values()}
+        contents = {p: self._read_partition(directory, p) for p in partitions}
+        existing = {}
+        for partition, partition_rows in contents.items():
+            contents[partition] = [
+                row for row in partition_rows if row.get(key_col) not in rows
+            ]
+            existing.update(
+                (row[key_col], row)
+                for row in partition_rows
+                if row.get(key_col) in rows
+            )
+        modified = 0
+        for key, row in rows.items():
+            merged = {**existing.get(key, {}), **row}
+            modified += key in existing and merged != existing[key]
+            locations[key] = self._partition_of(merged.get(column))
+            contents[locations[key]].append(merged)
+        for partition, partition_rows in contents.items():
+            self._write_partition(directory, partition, partition_rows, column, types)
+        return UpsertResult(len(existing), len(rows) - len(existing), modified)
+
+    def _insert(self, data: List, table: str) -> None:
+        """
+        Append the rows to their partitions, in batches of batch_size, while holding the lock of the table.
+        """
+        metadata = self._get_metadata(table)
+        column = metadata.get_partition_col() if metadata else None
+        types = metadata.get_types() if metadata else {}
+        directory = os.path.join(self.directory, table)
+        with self._get_lock(table):
+            self._forget_keys(table)
+            for batch in batched(data, self.batch_size):
+                partitions: Dict[str, List[dict]] = {}
+                for row in batch:
+                    partition = self._partition_of(row.get(column))
+                    partitions.setdefault(partition, []).append(row)
+                for partition, rows in partitions.items():
+                    rows = self._read_partition(directory, partition) + rows
+                    self._write_partition(directory, partition, rows, column, types)
+
+    def _overwrite(self, data: pd.DataFrame, table: str) -> None:
+        """
+        Overwrite the full contents of a table with the data, while holding the lock of the table. The
+        partitions are written into a staging directory, which then replaces the directory of the table.
+        """
+        metadata = self._get_metadata(table)
+        column = metadata.get_partition_col() if metadata else None
+        directory = os.path.join(self.directory, table)
+        if column in data:
+            partitions = (
+                pd.to_datetime(data[column], utc=True)
+                .dt.strftime("%Y-%m")
+                .fillna(NO_PARTITION)
+            )
+            data = data.sort_values(column)
+        else:
+            partitions = pd.Series(NO_PARTITION, index=data.index)
+        with self._get_lock(table):
+            self._forget_keys(table)
+            staging = f"{directory}.staging"
+            shutil.rmtree(staging, ignore_errors=True)
+            os.makedirs(staging)
+            for partition, rows in data.groupby(partitions, sort=False):
+                pq.write_table(
+                    pa.Table.from_pandas(rows, preserve_index=False),
+                    self._get_path(staging, partition),
+                    row_group_size=self.row_group_size,
+                )
+            shutil.rmtree(directory, ignore_errors=True)
+            os.replace(staging, directory)
+
+    def _get_lock(self, table: str) -> RLock:
+        """
+        Get the lock that writes to the table hold.
+        """
+        with self._locks_lock:
+            return self._locks.setdefault(table, RLock())
+
+    def _get_keys(self, table: str, key_col: str) -> Dict[Any, str]:
+        """
+        Get the partition of each key of the table. The keys are read once, the caller must hold the lock of
+        the table and keep the result up to date.
+        """
+        if (table, key_col) not in self._keys:
+            self._keys[(table, key_col)] = self._read_keys(table, key_col)
+        return self._keys[(table, key_col)]
+
+    def _forget_keys(self, table: str) -> None:
+        """
+        Remove the partitions of the keys of the table, because its rows are written without a key.
+        """
+        for cached in [k for k in self._keys if k[0] == table]:
+            del self._keys[cached]
+
+    def _get_metadata(self, table: str) -> Optional[TableMetadata]:
+        """
+        Get the metadata of the table, or None if it has none.
+        """
+        try:
+            return self.metadata.get_table(table)
+        except Exception:
+            return None
+
+    def _get_partitions(self, table: str, query: List[Tuple]) -> List[str]:
+        """
+        Get the paths of the partitions of the table that can contain rows matching the query, in order.
+        """
+        directory = os.path.join(self.directory, table)
+        if not os.path.isdir(directory):
+            return []
+        partitions = sorted(
+            name[: -len(".parquet")]
+            for name in os.listdir(directory)
+            if name.endswith(".parquet")
+        )
+        metadata = self._get_metadata(table)
+        column = metadata.get_partition_col() if metadata else None
+        for condition in [q for q in query if q[0] == column]:
+            partitions = [p for p in partitions if self._may_match(p, *condition[1:])]
+        return [self._get_path(directory, p) for p in partitions]
+
+    def _may_match(self, partition: str, operator: str, value: Any) -> bool:
+        """
+        Check whether a partition can contain rows of which the partition column matches the condition.
+        """
+        if operator in ["ne", "nin"]:
+            return True
+        if partition == NO_PARTITION:
+            return False
+        if operator == "in":
+            return partition in {self._partition_of(v) for v in value}
+        month = self._partition_of(value)
+        if operator == "eq":
+            return partition == month
+        return partition >= month if operator in ["gt", "gte"] else partition <= month
+
+    def _read_table(
+        self, path: str, query: List[Tuple], columns: Optional[List[str]]
+    ) -> Optional[pa.Table]:
+        """
+        Read the rows of a partition that match the query, with only the columns. The conditions are pushed
+        down, so that row groups whose statistics do not match are skipped. Return None if the partition
+        cannot match, because it lacks a column that a condition requires.
+        """
+        dataset = ds.dataset(path, format="parquet")
+        schema = dataset.schema
+        filters = []
+        for column, operator, value in query:
+            if column not in schema.names:
+                if operator in ["ne", "nin"]:
+                    continue
+                return None
+            value = self._cast(value, schema.field(column).type)
+            filters.append((column, operator, value))
+        if columns:
+            columns = [c for c in columns if c in schema.names]
+        return dataset.to_table(columns=columns, filter=self.convert_query(filters))
+
+    @staticmethod
+    def _cast(value: Any, data_type: pa.DataType) -> Any:
+        """
+        Convert the datetimes of a condition on a timestamp column to the timezone of the column.
+        """
+        if isinstance(value, (list, tuple, set)):
+            return [ParquetStorage._cast(v, data_type) for v in value]
+        if not pa.types.is_timestamp(data_type):
+            return value
+        if not isinstance(value, (str, datetime)):
+            return value
+        value = to_utc(value)
+        return value if data_type.tz else value.replace(tzinfo=None)
+
+    def _read_keys(self, table: str, key_col: str) -> Dict[Any, str]:
+        """
+        Get the partition of each key of the table. Only the key column is read.
+        """
+        result = {}
+        for path in self._get_partitions(table, []):
+            keys = self._read_table(path, [], [key_col])
+            if keys is None or key_col not in keys.column_names:
+                continue
+            partition = os.path.basename(path)[: -len(".parquet")]
+            result.update((key, partition) for key in keys[key_col].to_pylist())
+        return result
+
+    def _read_partition(self, directory: str, partition: str) -> List[dict]:
+        """
+        Read all rows of a partition, or an empty list if it does not exist.
+        """
+        path = self._get_path(directory, partition)
+        return pq.read_table(path).to_pylist() if os.path.exists(path) else []
+
+    def _write_partition(
+        self,
+        directory: str,
+        partition: str,
+        rows: List[dict],
+        column: Optional[str],
+        types: Dict[str, str],
+    ) -> None:
+        """
+        Write the rows of a partition, sorted by the partition column, with the types of the json_schema. The file is written next to the
+        partition under a unique name and then replaces it, so readers never see a partially written file.
+        Remove the partition if there are no rows.
+        """
+        path = self._get_path(directory, partition)
+        if not rows:
+            if os.path.exists(path):
+                os.remove(path)
+            return
+        if column:
+            rows = sorted(rows, key=lambda row: self._sort_key(row, [column]))
+        os.makedirs(directory, exist_ok=True)
+        temporary = f"{path}.{uuid.uuid4().hex}.tmp"
+        pq.write_table(
+            self._to_table(rows, types), temporary, row_group_size=self.row_group_size
+        )
+        os.replace(temporary, path)
+
+    @staticmethod
+    def _to_table(rows: List[dict], types: Dict[str, str]) -> pa.Table:
+        """
+        Convert rows into a table with the columns of all rows, in the order in which they first occur. A
+        column is missing in the rows that lack it. The values of a column of which the json_schema declares
+        the type are cast to that type, like the carbs "20" and 15 to strings. Raise a ValueError if the
+        values cannot be cast, or if they have different types and the type of the column is not declared.
+        """
+        columns = list(dict.fromkeys(c for row in rows for c in row))
+        arrays = []
+        for column in columns:
+            values = [row.get(column) for row in rows]
+            declared = types.get(column)
+            try:
+                if declared in CONVERTERS:
+                    convert = CONVERTERS[declared]
+                    values = [None if v is None else convert(v) for v in values]
+                arrays.append(pa.array(values, type=ARROW_TYPES.get(declared)))
+            except (ValueError, TypeError) as e:
+                raise ValueError(
+                    f"Cannot write column {column} as {declared or 'a single type'}: {e}"
+                ) from e
+        return pa.Table.from_arrays(arrays, names=columns)
+
+    @staticmethod
+    def _sort_table(table: pa.Table, sort: List[str], asc: bool) -> pa.Table:
+        """
+        Sort a partition by the columns of sort that it has.
+        """
+        order = "ascending" if asc else "descending"
+        keys = [(c, order) for c in sort if c in table.column_names]
+        return table.sort_by(keys) if keys else table
+
+    @staticmethod
+    def _sort_key(row: dict, sort: List[str]) -> tuple:
+        """
+        Get the sort key of a row, on which missing values come first.
+        """
+        return tuple((row.get(c) is not None, row.get(c)) for c in sort)
+
+    @staticmethod
+    def _partition_of(value: Any) -> str:
+        """
+        Get the partition of a value of the partition column: its month in UTC.
+        """
+        moment = to_utc(value)
+        return NO_PARTITION if moment is None else moment.strftime("%Y-%m")
+
+    @staticmethod
+    def _get_path(directory: str, partition: str) -> str:
+        return os.path.join(directory, f"{partition}.parquet")
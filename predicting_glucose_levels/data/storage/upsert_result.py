@@ -0,0 +1,34 @@
+from dataclasses import dataclass
+
+
+@dataclass
+class UpsertResult:
+    """
+    The result of an upsert. Results of multiple batches can be added together.
+
+    Attributes:
+        matched: The number of rows that matched an existing row on the key column.
+        upserted: The number of rows that were inserted, because no row matched.
+        modified: The number of existing rows that were actually changed.
+        skipped: The number of rows that were not written, because they did not change.
+    """
+
+    matched: int = 0
+    upserted: int = 0
+    modified: int = 0
+    skipped: int = 0
+
+    def __add__(self, other: "UpsertResult") -> "UpsertResult":
+        return UpsertResult(
+            self.matched + other.matched,
+            self.upserted + other.upserted,
+            self.modified + other.modified,
+            self.skipped + other.skipped,
+        )
+
+    def get_skip_ratio(self) -> float:
+        """
+        Get the fraction of the rows that were skipped.
+        """
+        total = self.matched + self.upserted + self.skipped
+        return self.skipped / total if total else 0.0
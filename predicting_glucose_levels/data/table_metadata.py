@@ -1,10 +1,34 @@
 from dataclasses import dataclass
+from datetime import timedelta
+from typing import Dict, List, Optional
 
 
 @dataclass
 class TableMetadata:
     """
     A class that contains metadata about a table.
+
+    Attributes:
+        page_size: If set, source tables are loaded and stored in pages of at most this many rows.
+        chunk_hours: If set, source tables are ingested in chunks of at most this many hours.
+        chunk_rows: If set together with rows_per_hour, source tables are ingested in chunks that are expected
+            to contain at most this many rows.
+        rows_per_hour: The expected number of rows per hour. Used to convert chunk_rows into a span.
+        project_columns: If set, source tables are only loaded with the columns declared in the json_schema.
+        indexes: The indexes of the table. Each index is a dict with:
+            - keys: The indexed columns. Each is a column name, or a [column, direction] pair for descending
+              (-1) keys.
+            - unique: Optional. Whether the combination of keys must be unique.
+            - partial: Optional. A query, as accepted by AbstractStorage.find, that limits the index to the
+              rows matching it.
+        bucket_col: If set together with bucket_hours, the rows are stored grouped into bucket documents, one
+            per bucket_hours of this column. Storage classes that support it read and write the rows
+            transparently, and store far fewer documents and index entries.
+        bucket_hours: The span of a bucket in hours.
+        detect_changes: If set, a digest of each row is stored in the row_hash column, and upserts skip the rows
+            of which the digest did not change.
+        partition_col: The time column by which storage classes that support it partition or index the table.
+            Defaults to the timestamp_col.
     """
 
     name: str
@@ -13,3 +37,89 @@ class TableMetadata:
     type: str
     endpoint: str = None
     json_schema: dict = None
+    page_size: int = None
+    chunk_hours: float = None
+    chunk_rows: int = None
+    rows_per_hour: float = None
+    project_columns: bool = False
+    indexes: List[dict] = None
+    bucket_col: str = None
+    bucket_hours: float = None
+    partition_col: str = None
+    detect_changes: bool = False
+
+    def get_chunk_span(self) -> Optional[timedelta]:
+        """
+        Get the span of the chunks in which the table is ingested, or None if the table is not chunked.
+        """
+        if self.chunk_hours:
+            return timedelta(hours=self.chunk_hours)
+        if self.chunk_rows and self.rows_per_hour:
+            return timedelta(hours=self.chunk_rows / self.rows_per_hour)
+        return None
+
+    def get_bucket_span(self) -> Optional[timedelta]:
+        """
+        Get the span of the buckets in which the rows are stored, or None if the table is not bucketed.
+        """
+        if self.bucket_col and self.bucket_hours:
+            return timedelta(hours=self.bucket_hours)
+        return None
+
+    def get_partition_col(self) -> str:
+        """
+        Get the column by which the table is partitioned.
+        """
+        return self.partition_col or self.timestamp_col
+
+    def get_columns(self) -> Optional[List[str]]:
+        """
+        Get the columns declared in the json_schema of the rows, or None if the table has no schema.
+        """
+        if not self.json_schema:
+            return None
+        return list(self.json_schema["items"]["properties"])
+
+    def get_types(self) -> Dict[str, str]:
+        """
+        Get the type of each column declared in the json_schema that has a single type besides null.
+        """
+        if not self.json_schema:
+            return {}
+        result = {}
+        for column, definition in self.json_schema["items"]["properties"].items():
+            types = definition.get("type")
+            types = (
+                [t for t in types if t != "null"]
+                if isinstance(types, list)
+                else [types]
+            )
+            if len(types) == 1:
+                result[column] = types[0]
+        return result
+
+    def get_dtypes(self) -> Dict[str, str]:
+        """
+        Get the pandas dtype of each column declared in the json_schema. Integers and booleans use the
+        nullable pandas dtypes, numbers use float64, where missing values become NaN. Other columns are
+        left out, their dtype is inferred.
+        """
+        dtypes = {"integer": "Int64", "number": "float64", "boolean": "boolean"}
+        return {
+            column: dtypes[t] for column, t in self.get_types().items() if t in dtypes
+        }
+
+    def get_indexes(self) -> List[dict]:
+        """
+        Get the indexes of the table, with the keys normalized to a list of (column, direction) pairs.
+        """
+        return [
+            {
+                **index,
+                "keys": [
+                    (key, 1) if isinstance(key, str) else tuple(key)
+                    for key in index["keys"]
+                ],
+            }
+            for index in self.indexes or []
+        ]
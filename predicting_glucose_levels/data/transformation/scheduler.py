@@ -0,0 +1,194 @@
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from logging import LoggerAdapter
+from typing import Dict, List, Type
+
+from kink import inject
+
+from predicting_glucose_levels.data.ingestion.ingester import Ingester
+from predicting_glucose_levels.data.metadata import Metadata
+from predicting_glucose_levels.data.transformation.transformer.transformers.base_transformer import (
+    BaseTransformer,
+)
+from predicting_glucose_levels.data.transformation.transformer.transformers.glucose_measurements_transformer import (
+    GlucoseMeasurementTransformer,
+)
+from predicting_glucose_levels.data.transformation.transformer.transformers.insulin_injection_transformer import (
+    InsulinInjectionTransformer,
+)
+
+TRANSFORMERS: List[Type[BaseTransformer]] = [
+    GlucoseMeasurementTransformer,
+    InsulinInjectionTransformer,
+]
+
+
+class TransformationError(Exception):
+    """
+    Raised when one or more transformers failed, or were skipped because a transformer they depend on failed.
+
+    Attributes:
+        errors: The error of each failed or skipped transformer, by transformer name.
+    """
+
+    errors: Dict[str, Exception]
+
+    def __init__(self, errors: Dict[str, Exception]):
+        self.errors = errors
+        failures = ", ".join(f"{name}: {error}" for name, error in errors.items())
+        super().__init__(f"Failed to run {len(errors)} transformers. {failures}")
+
+
+@inject
+class TransformationScheduler:
+    """
+    The TransformationScheduler runs transformers in the order of the tables they declare. A transformer
+    depends on the transformers of which a destination table is one of its source tables. Together they form
+    a DAG, in which each transformer runs once all transformers it depends on are done. Transformers that do
+    not depend on each other run concurrently.
+
+    The source tables that no transformer produces are ingested once, before any transformer runs. The
+    transformers then skip their own ingestion.
+
+    Attributes:
+        ingester: The ingester to ingest the source tables with.
+        metadata: The metadata class. Used to get the metadata of the source tables.
+        logger: The logger to use to log messages.
+        max_workers: The number of transformers that run concurrently.
+    """
+
+    ingester: Ingester
+    metadata: Metadata
+    logger: LoggerAdapter
+    max_workers: int
+
+    def __init__(
+        self,
+        ingester: Ingester,
+        metadata: Metadata,
+        logger: LoggerAdapter,
+        max_workers: int = 4,
+    ):
+        self.ingester = ingester
+        self.metadata = metadata
+        self.logger = logger
+        self.max_workers = max_workers
+
+    @staticmethod
+    def get_dependencies(
+        transformers: List[Type[BaseTransformer]],
+    ) -> Dict[Type[BaseTransformer], List[Type[BaseTransformer]]]:
+        """
+        Get the transformers that each transformer depends on, in a topological order: every transformer comes
+        after the transformers it depends on. Raise an exception if the dependencies contain a cycle.
+        """
+        producers = {
+            table: transformer
+            for transformer in transformers
+            for table in transformer.destination_tables
+        }
+        dependencies = {
+            transformer: list(
+                dict.fromkeys(
+                    producers[table]
+                    for table in transformer.source_tables
+                    if table in producers and producers[table] is not transformer
+                )
+            )
+            for transformer in transformers
+        }
+        result = {}
+        while len(result) < len(dependencies):
+            ready = [
+                t
+                for t, deps in dependencies.items()
+                if t not in result and all(d in result for d in deps)
+            ]
+            if not ready:
+                cycle = [t.__name__ for t in dependencies if t not in result]
+                raise Exception(f"Transformers depend on each other: {cycle}")
+            for transformer in ready:
+                result[transformer] = dependencies[transformer]
+        return result
+
+    def get_sources(self, transformers: List[Type[BaseTransformer]]) -> List[str]:
+        """
+        Get the source tables of the transformers that no transformer produces, and that can be ingested.
+        """
+        produced = {
+            t for transformer in transformers for t in transformer.destination_tables
+        }
+        tables = dict.fromkeys(
+            table
+            for transformer in transformers
+            for table in transformer.source_tables
+            if table not in produced
+        )
+        return [t for t in tables if self.metadata.get_table(t).type == "source_table"]
+
+    def ingest(self, transformers: List[Type[BaseTransformer]]) -> None:
+        """
+        Ingest the source tables of the transformers, each table once.
+        """
+        tables = [self.metadata.get_table(t) for t in self.get_sources(transformers)]
+        if tables:
+            self.ingester.ingest(tables, max_workers=min(len(tables), self.max_workers))
+
+    def run(self, transformers: List[Type[BaseTransformer]] = None, **options) -> None:
+        """
+        Ingest the source tables, and run the transformers, each as soon as the transformers it depends on
+        are done. The options are set as attributes on the transformers that have them, for example
+        chunk_size. A failing transformer does not abort the others, but the transformers that depend on it
+        are skipped. The errors are raised together afterwards as a TransformationError.
+        """
+        dependencies = self.get_dependencies(transformers or TRANSFORMERS)
+        self.ingest(list(dependencies))
+        errors: Dict[str, Exception] = {}
+        done = set()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            running: Dict[Future, Type[BaseTransformer]] = {}
+            pending = dict(dependencies)
+            while pending or running:
+                for transformer, deps in list(pending.items()):
+                    failed = [d.__name__ for d in deps if d.__name__ in errors]
+                    if failed:
+                        del pending[transformer]
+                        errors[transformer.__name__] = Exception(
+                            f"Skipped, because {', '.join(failed)} failed"
+                        )
+                    elif all(d in done for d in deps):
+                        del pending[transformer]
+                        future = executor.submit(self._run_one, transformer, options)
+                        running[future] = transformer
+                if not running:
+                    continue
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    transformer = running.pop(future)
+                    try:
+                        future.result()
+                        done.add(transformer)
+                    except Exception as e:
+                        self.logger.error(f"Failed to run {transformer.__name__}: {e}")
+                        errors[transformer.__name__] = e
+        if errors:
+            raise TransformationError(errors)
+
+    def _run_one(self, transformer: Type[BaseTransformer], options: dict) -> None:
+        """
+        Create a transformer, without ingestion of its sources, and run its ETL process.
+        """
+        instance = self.create(transformer, options)
+        self.logger.info(f"Running {transformer.__name__}")
+        instance.etl()
+
+    @staticmethod
+    def create(transformer: Type[BaseTransformer], options: dict) -> BaseTransformer:
+        """
+        Create a transformer that does not ingest its sources itself, with the options that it has.
+        """
+        instance = transformer()
+        instance.ingest_sources = False
+        for name, value in options.items():
+            if hasattr(instance, name):
+                setattr(instance, name, value)
+        return instance
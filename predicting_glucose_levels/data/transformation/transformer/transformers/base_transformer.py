@@ -1,6 +1,10 @@
 from abc import ABC, abstractmethod
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
 from logging import LoggerAdapter
+from typing import Iterator, List, Optional, Tuple
 
+import pandas as pd
 from kink import inject
 
 from predicting_glucose_levels.data.ingestion.ingester import Ingester
@@ -11,6 +15,7 @@ from predicting_glucose_levels.data.transformation.transformer.validators.schema
     SchemaValidator,
 )
 from predicting_glucose_levels.helpers.config import PROJECT_DIR
+from predicting_glucose_levels.helpers.general import to_utc
 
 
 @inject
@@ -18,13 +23,47 @@ class BaseTransformer(ABC):
     """
     Base Transformer class. Will be implemented by concrete transformer classes.
     Concrete implementations must implement ETL methods for specific destination tables.
+
+    Concrete implementations can also run chunked, by implementing the per-chunk methods extract_chunks,
+    validate_chunk, transform_chunk and load_chunk. See etl_chunked.
+
+    By default, a transformer reads the rows of its first source table that were updated since the last
+    runmoment of its first destination table, validates them against the schema of the source, and upserts
+    its result into the destination. Such a transformer only implements transform and transform_chunk.
+
+    Attributes:
+        source_tables: The names of the tables that the transformer reads.
+        destination_tables: The names of the tables that the transformer writes.
+        ingest_sources: Whether extract ingests the source tables first. Disabled when a scheduler ingests
+            them once for all transformers.
+        source_columns: The columns of the source table that the transformer uses. Only these columns are
+            read from storage. None reads all columns.
+        chunk_size: If set, etl runs chunked, with chunks of this many source rows.
+        watermark_col: The column of the source by which the chunks are sorted. The runmoment of the
+            destination is advanced to it after each loaded chunk.
+        source_metadata: The metadata of the first source table.
+        destination_metadata: The metadata of the first destination table.
+        source: The source data.
+        result: The result of the transformation.
+        runmoment: The start of the transformation. The runmoment of the destination table will be set to this value.
     """
 
+    source_tables: List[str] = []
+    destination_tables: List[str] = []
+    ingest_sources: bool = True
+    source_columns: List[str] = None
+    chunk_size: Optional[int] = None
+    watermark_col: Optional[str] = None
     schema_validator: SchemaValidator
     ingester: Ingester
     storage: AbstractStorage
     logger: LoggerAdapter
     metadata: Metadata
+    source_metadata: TableMetadata
+    destination_metadata: TableMetadata
+    source: pd.DataFrame
+    result: Optional[pd.DataFrame]
+    runmoment: datetime
 
     def __init__(
         self,
@@ -39,22 +78,51 @@ class BaseTransformer(ABC):
         self.ingester = ingester
         self.logger = logger
         self.metadata = metadata
+        if self.source_tables:
+            self.source_metadata = self.metadata.get_table(self.source_tables[0])
+        if self.destination_tables:
+            self.destination_metadata = self.metadata.get_table(
+                self.destination_tables[0]
+            )
+        self.runmoment = datetime.now()
+
+    def _ingest_sources(self):
+        """
+        Ingest the source tables that are ingested from the data source, unless ingest_sources is disabled.
+        """
+        if not self.ingest_sources:
+            return
+        tables = [self.metadata.get_table(t) for t in self.source_tables]
+        self.ingester.ingest([t for t in tables if t.type == "source_table"])
 
-    @abstractmethod
     def extract(self):
         """
-        Extracts data from the source tables.
-        Uses the ingester to extract the data.
+        Ingest the source tables. Then load only the rows of the source table since the last runmoment of the
+        destination table, as a DataFrame.
         """
-        raise NotImplementedError
+        self._ingest_sources()
+        last_runmoment = self.storage.get_last_runmoment(self.destination_metadata.name)
+        self.source = self.storage.find_frame(
+            self.source_metadata.name,
+            self._get_query(last_runmoment),
+            columns=self.source_columns,
+        )
+        self.logger.info(
+            f"Transforming {len(self.source)} rows of {self.source_metadata.name}."
+        )
+
+    def _get_query(self, last_runmoment: datetime) -> List[Tuple]:
+        """
+        Get the query of the source rows to transform: all rows since the last runmoment.
+        """
+        return [(self.source_metadata.timestamp_col, "gt", to_utc(last_runmoment))]
 
-    @abstractmethod
     def validate_schemas(self):
         """
-        Validates the schema(s) of the source table(s).
+        Validates the schema of the source table.
         Uses the schema validator to validate the schema.
         """
-        raise NotImplementedError
+        self.validate_chunk(self.source)
 
     @abstractmethod
     def transform(self):
@@ -63,18 +131,118 @@ class BaseTransformer(ABC):
         """
         raise NotImplementedError
 
-    @abstractmethod
     def load(self):
         """
-        Loads the transformed data into the destination tables.
+        Loads the transformed data into the destination table. Then updates the last runmoment of the
+        destination table.
+        """
+        self.load_chunk(self.result, self.runmoment)
+
+    def extract_chunks(self) -> Iterator[pd.DataFrame]:
+        """
+        Ingest the source tables. Then read the rows of the source table since the last runmoment of the
+        destination table in DataFrames of chunk_size rows, sorted by watermark_col.
+        """
+        self._ingest_sources()
+        last_runmoment = self.storage.get_last_runmoment(self.destination_metadata.name)
+        return self.storage.iter_find_frames(
+            self.source_metadata.name,
+            self._get_query(last_runmoment),
+            [self.watermark_col],
+            columns=self.source_columns,
+            batch_size=self.chunk_size,
+        )
+
+    def validate_chunk(self, chunk: pd.DataFrame):
+        """
+        Validates the schema of a chunk of the source table, on the source_columns only.
+        """
+        self.schema_validator.validate_frame(
+            self.source_metadata.name, chunk, self.source_columns
+        )
+
+    def transform_chunk(self, chunk: pd.DataFrame) -> Optional[pd.DataFrame]:
+        """
+        Transforms a chunk of the source table.
         """
         raise NotImplementedError
 
+    def load_chunk(self, result: Optional[pd.DataFrame], watermark: Optional[datetime]):
+        """
+        Upserts a transformed chunk into the destination table. Then advances the runmoment of the destination
+        table to the watermark, if it is set.
+        """
+        if result is not None:
+            self.storage.upsert(self._get_rows(result), self.destination_metadata.name)
+        if watermark is not None:
+            self.storage.set_last_runmoment(self.destination_metadata.name, watermark)
+
+    @staticmethod
+    def _get_rows(result: pd.DataFrame) -> List[dict]:
+        """
+        Get the rows of a result, with missing values as None.
+        """
+        return result.astype(object).where(result.notna(), None).to_dict("records")
+
     def etl(self):
         """
-        Performs the ETL process.
+        Performs the ETL process. Flushes the storage afterwards, so that buffered writes are stored.
+        Runs chunked if chunk_size is set.
         """
+        if self.chunk_size:
+            return self.etl_chunked()
         self.extract()
         self.validate_schemas()
         self.transform()
         self.load()
+        self.storage.flush()
+
+    def etl_chunked(self):
+        """
+        Performs the ETL process per chunk, so that memory is bounded by the chunk_size instead of the number
+        of new rows, and rows are loaded while the rest is transformed. While a chunk is validated and
+        transformed, the next chunk is read and the previous chunk is loaded in the background. Chunks are
+        loaded in order, one at a time.
+
+        After each loaded chunk, the runmoment is advanced to the watermark of the chunk. If a run fails, the
+        next run therefore continues after the last loaded chunk.
+        """
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            chunks = self.extract_chunks()
+            reading = executor.submit(next, chunks, None)
+            loading: Optional[Future] = None
+            chunk, rows = reading.result(), 0
+            while chunk is not None:
+                reading = executor.submit(next, chunks, None)
+                self.validate_chunk(chunk)
+                result = self.transform_chunk(chunk)
+                following = reading.result()
+                watermark = self._get_watermark(chunk, following)
+                if loading is not None:
+                    loading.result()
+                loading = executor.submit(self.load_chunk, result, watermark)
+                rows += len(chunk)
+                self.logger.info(f"Transformed {rows} rows, up to {watermark}.")
+                chunk = following
+            if loading is not None:
+                loading.result()
+        self.storage.flush()
+
+    def _get_watermark(
+        self, chunk: pd.DataFrame, following: Optional[pd.DataFrame]
+    ) -> Optional[datetime]:
+        """
+        Get the watermark of a chunk: the latest value of the watermark_col up to which all source rows are
+        in this or earlier chunks. Source rows with the latest value of the chunk can also be in the following
+        chunk. In that case the watermark is the latest earlier value, and those rows are transformed again
+        if the run is resumed. Return None if the chunk has no such value.
+        """
+        times = pd.to_datetime(chunk[self.watermark_col], utc=True)
+        watermark = times.max()
+        if following is not None and not following.empty:
+            if (
+                pd.to_datetime(following[self.watermark_col], utc=True).min()
+                <= watermark
+            ):
+                watermark = times[times < watermark].max()
+        return None if pd.isna(watermark) else watermark.to_pydatetime()
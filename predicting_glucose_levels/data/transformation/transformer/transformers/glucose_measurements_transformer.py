@@ -1,12 +1,12 @@
 from datetime import datetime
-from typing import List
+from typing import List, Optional, Tuple
 
 import pandas as pd
 
-from predicting_glucose_levels.data.table_metadata import TableMetadata
 from predicting_glucose_levels.data.transformation.transformer.transformers.base_transformer import (
     BaseTransformer,
 )
+from predicting_glucose_levels.helpers.general import to_utc
 
 
 class GlucoseMeasurementTransformer(BaseTransformer):
@@ -14,77 +14,145 @@ class GlucoseMeasurementTransformer(BaseTransformer):
     The GlucoseMeasurementTransformer class is used to transform the entries into glucose measurements.
 
     Attributes:
-        source_metadata: The metadata of the source table.
-        destination_metadata: The metadata of the destination table.
-        source: The source data.
-        result: The result of the transformation.
-        runmoment: The start of the transformation. The runmoment of the destination table will be set to this value.
+        pushdown: Whether to run the transformation as an aggregation pipeline in the storage, if it supports
+            that, instead of in Python. See get_pipeline.
     """
 
-    source_metadata: TableMetadata
-    destination_metadata: TableMetadata
-    source: List[dict]
-    result: pd.DataFrame
-    runmoment: datetime
+    source_tables = ["entries"]
+    destination_tables = ["glucose_measurements"]
+    watermark_col = "dateString"
 
-    def __init__(self):
-        super().__init__()
-        self.source_metadata = self.metadata.get_table("entries")
-        self.destination_metadata = self.metadata.get_table("glucose_measurements")
-        self.runmoment = datetime.now()
+    source_columns = ["_id", "dateString", "delta", "direction", "sgv", "mbg", "type"]
+    pushdown: bool
 
-    def validate_schemas(self):
-        self.schema_validator.validate(self.source_metadata.name, self.source)
+    def __init__(self, pushdown: bool = False, chunk_size: int = None):
+        super().__init__()
+        self.pushdown = pushdown
+        self.chunk_size = chunk_size
 
-    def extract(self):
+    def etl(self):
         """
-        Ingest new entries. Then load only the new entries since the last runmoment of the destination table.
+        Perform the ETL process in Python, or push the transformation down into the storage. The pushed-down
+        transformation is not validated against the schema, the casts of the pipeline fail on invalid values.
         """
-        self.ingester.ingest([self.source_metadata])
+        if not self.pushdown:
+            return super().etl()
+        if not self.storage.supports_pushdown:
+            self.logger.warning("The storage does not support pushdown, using Python.")
+            return super().etl()
+        self._ingest_sources()
         last_runmoment = self.storage.get_last_runmoment(self.destination_metadata.name)
-        self.source = self.storage.find(
+        self.storage.merge_pipeline(
             self.source_metadata.name,
-            [
-                ("type", "ne", "cal"),
-                (self.source_metadata.timestamp_col, "gt", last_runmoment.isoformat()),
-            ],
+            self.get_pipeline(last_runmoment),
+            self.destination_metadata.name,
         )
-        self.logger.info(f"Transforming {len(self.source)} entries.")
+        self.storage.set_last_runmoment(self.destination_metadata.name, self.runmoment)
+        self.storage.flush()
+
+    def _get_query(self, last_runmoment: datetime) -> List[Tuple]:
+        """
+        Get the query of the entries to transform: all but calibrations, since the last runmoment.
+        """
+        return [
+            ("type", "ne", "cal"),
+            (self.source_metadata.timestamp_col, "gt", to_utc(last_runmoment)),
+        ]
 
     def transform(self):
         """
-        Transform the entries into glucose measurements. Include conversion from mg/dL to mmol/L.
+        Transform the entries into glucose measurements.
         """
-        df = pd.DataFrame(self.source)
-        if df.empty:
+        self.result = self.transform_chunk(self.source)
+        if self.result is None:
             self.logger.info("No new entries found.")
-            self.result = None
             return
+        self.logger.info(f"Successfully transformed {len(self.result)} entries.")
+
+    def transform_chunk(self, chunk: pd.DataFrame) -> Optional[pd.DataFrame]:
+        """
+        Transform entries into glucose measurements. Include conversion from mg/dL to mmol/L.
+        """
+        df = chunk
+        if df.empty:
+            return None
         cols = {
             "glucose_measurement_id": df["_id"].astype(str),
             "glucose_measurement_time": pd.to_datetime(df["dateString"]),
             "delta": df["delta"].astype(float),
-            "direction": df["direction"].astype(str),
+            "direction": df["direction"].astype("string"),
             "glucose_value_mg_dl": df["sgv"]
-            .fillna(df.get("mbg", pd.Series()))
-            .astype(float),
+            .astype(float)
+            .fillna(df.get("mbg", pd.Series(dtype=float)).astype(float)),
             "type": df["type"].astype(str),
             "updated_at": pd.to_datetime(datetime.now()),
         }
         # Select relevant cols, and cast and alias each
         df = df.assign(**cols)[cols.keys()]
         df[["glucose_value_mmol_l"]] = df[["glucose_value_mg_dl"]] / 18.0182
-        self.result = df
-        self.logger.info(f"Successfully transformed {len(self.result)} entries.")
+        return df
+
+    def get_pipeline(self, last_runmoment: datetime) -> List[dict]:
+        """
+        Get the transformation as an aggregation pipeline on the entries, which produces the same rows as
+        transform: match the entries of _get_query, then cast and alias the columns, and convert mg/dL to
+        mmol/L. Missing values are null, like in the rows that load stores.
+        """
+        return [
+            {
+                "$match": {
+                    "type": {"$ne": "cal"},
+                    self.source_metadata.timestamp_col: {"$gt": to_utc(last_runmoment)},
+                }
+            },
+            {
+                "$project": {
+                    "_id": 0,
+                    "glucose_measurement_id": {"$toString": "$_id"},
+                    "glucose_measurement_time": {"$toDate": "$dateString"},
+                    "delta": {"$toDouble": "$delta"},
+                    "direction": {"$toString": "$direction"},
+                    "glucose_value_mg_dl": {"$toDouble": {"$ifNull": ["$sgv", "$mbg"]}},
+                    "type": {"$toString": "$type"},
+                    "updated_at": "$$NOW",
+                }
+            },
+            {
+                "$set": {
+                    "glucose_value_mmol_l": {
+                        "$divide": ["$glucose_value_mg_dl", 18.0182]
+                    }
+                }
+            },
+        ]
 
-    def load(self):
+    def verify_pushdown(self, since: datetime = None) -> List[str]:
         """
-        Upsert the transformed entries into the destination table. Then update the last runmoment of the destination table.
+        Transform the entries since a moment, the last runmoment by default, both in Python and with the
+        pipeline, without loading either, and compare the rows. updated_at is not compared, it is the moment of
+        the transformation. Return the ids of the measurements that differ or that only one of both produced.
         """
-        if self.result is not None:
-            # todo: if empty, overwrite. Else upsert.
-            # self.storage.overwrite(self.result, self.destination_metadata.name)
-            self.storage.upsert(
-                self.result.to_dict("records"), self.destination_metadata.name
+        since = since or self.storage.get_last_runmoment(self.destination_metadata.name)
+        self.source = self.storage.find_frame(
+            self.source_metadata.name,
+            self._get_query(since),
+            columns=self.source_columns,
+        )
+        self.transform()
+        key_col = self.destination_metadata.key_col
+        rows = self._get_rows(self.result) if self.result is not None else []
+        expected = {row[key_col]: row for row in rows}
+        actual = {
+            row[key_col]: row
+            for row in self.storage.aggregate(
+                self.source_metadata.name, self.get_pipeline(since)
             )
-        self.storage.set_last_runmoment(self.destination_metadata.name, self.runmoment)
+        }
+        result = []
+        for key in sorted(expected.keys() | actual.keys()):
+            python, pushed = expected.get(key, {}), actual.get(key, {})
+            columns = (python.keys() | pushed.keys()) - {"updated_at"}
+            if any(python.get(c) != pushed.get(c) for c in columns):
+                result.append(key)
+        self.logger.info(f"{len(result)} of {len(expected)} measurements differ.")
+        return result
@@ -1,17 +1,100 @@
+from datetime import datetime
+from typing import Optional
+
+import pandas as pd
+
 from predicting_glucose_levels.data.transformation.transformer.transformers.base_transformer import (
     BaseTransformer,
 )
 
+# The insulin type of each Nightscout eventType that delivers insulin
+INSULIN_TYPES = {
+    "Bolus": "bolus",
+    "Bolus Wizard": "bolus",
+    "Combo Bolus": "bolus",
+    "Meal Bolus": "bolus",
+    "Snack Bolus": "bolus",
+    "Correction Bolus": "correction",
+    "Temp Basal": "temp_basal",
+}
+
 
 class InsulinInjectionTransformer(BaseTransformer):
-    def validate_schemas(self):
-        pass
+    """
+    The InsulinInjectionTransformer class is used to transform the treatments into insulin injections: boluses,
+    corrections and temporary basal rates. All other treatments, such as notes and carbs, are skipped.
+    The transformation is vectorized, each column is converted at once for all treatments.
+    """
 
-    def extract(self):
-        pass
+    source_tables = ["treatments"]
+    destination_tables = ["insulin_injections"]
+    source_columns = [
+        "_id",
+        "created_at",
+        "eventType",
+        "insulin",
+        "absolute",
+        "rate",
+        "duration",
+    ]
+    watermark_col = "created_at"
+
+    def __init__(self, chunk_size: int = None):
+        super().__init__()
+        self.chunk_size = chunk_size
 
     def transform(self):
-        pass
+        """
+        Transform the treatments into insulin injections.
+        """
+        self.result = self.transform_chunk(self.source)
+        if self.result is None:
+            self.logger.info("No new insulin injections found.")
+            return
+        self.logger.info(f"Successfully transformed {len(self.result)} treatments.")
+
+    def transform_chunk(self, chunk: pd.DataFrame) -> Optional[pd.DataFrame]:
+        """
+        Transform treatments into insulin injections. The eventType determines the insulin type. Treatments
+        with an unknown eventType but with insulin are boluses. Numbers may be stored as strings, they are
+        parsed, and invalid numbers are missing.
+
+        Boluses and corrections are kept if they have insulin. Temporary basal rates are kept if they have a
+        rate: the absolute rate in U/h, or the rate if it is missing. Their units are the rate times the
+        duration in minutes, as delivered if the rate runs for its full duration.
+        """
+        df = chunk
+        if df.empty:
+            return None
+        insulin = self._to_number(df, "insulin")
+        rate = self._to_number(df, "absolute").fillna(self._to_number(df, "rate"))
+        duration = self._to_number(df, "duration")
+        insulin_type = df["eventType"].map(INSULIN_TYPES)
+        insulin_type = insulin_type.mask(insulin_type.isna() & (insulin > 0), "bolus")
+        temp_basal = insulin_type == "temp_basal"
+        cols = {
+            "insulin_injection_id": df["_id"].astype(str),
+            "insulin_injection_time": pd.to_datetime(df["created_at"], utc=True),
+            "insulin_type": insulin_type,
+            "insulin_units": insulin.where(~temp_basal, rate * duration / 60),
+            "basal_rate_u_h": rate.where(temp_basal),
+            "duration_minutes": duration.where(temp_basal),
+            "event_type": df["eventType"],
+            "updated_at": pd.to_datetime(datetime.now()),
+        }
+        # Select relevant cols, and cast and alias each
+        df = df.assign(**cols)[cols.keys()]
+        keep = (insulin_type.isin(["bolus", "correction"]) & (insulin > 0)) | (
+            temp_basal & rate.notna()
+        )
+        df = df[keep].reset_index(drop=True)
+        return None if df.empty else df
 
-    def load(self):
-        pass
+    @staticmethod
+    def _to_number(df: pd.DataFrame, column: str) -> pd.Series:
+        """
+        Parse a column as floats. A missing column, and values that are not numbers, are NaN.
+        """
+        if column not in df:
+            return pd.Series(float("nan"), index=df.index)
+        return pd.to_numeric(df[column], errors="coerce").astype(float)
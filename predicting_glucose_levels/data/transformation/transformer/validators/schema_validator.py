@@ -1,31 +1,285 @@
+import numbers
+from collections import Counter
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
 import jsonschema
+import pandas as pd
 from kink import inject
 
 from predicting_glucose_levels.data.metadata import Metadata
 
+# Per JSON schema type: a check of the dtype of a column, which holds for all of its values, and a check of a
+# single value, for columns of object dtype.
+TYPE_CHECKS: Dict[str, Tuple[Callable[[Any], bool], Callable[[Any], bool]]] = {
+    "string": (
+        lambda dtype: isinstance(dtype, pd.StringDtype),
+        lambda value: isinstance(value, str),
+    ),
+    "integer": (
+        lambda dtype: pd.api.types.is_integer_dtype(dtype),
+        lambda value: (
+            isinstance(value, numbers.Integral) and not isinstance(value, bool)
+        )
+        or (isinstance(value, float) and value.is_integer()),
+    ),
+    "number": (
+        lambda dtype: pd.api.types.is_numeric_dtype(dtype)
+        and not pd.api.types.is_bool_dtype(dtype),
+        lambda value: isinstance(value, numbers.Number) and not isinstance(value, bool),
+    ),
+    "boolean": (
+        lambda dtype: pd.api.types.is_bool_dtype(dtype),
+        lambda value: isinstance(value, bool),
+    ),
+    "datetime": (
+        lambda dtype: pd.api.types.is_datetime64_any_dtype(dtype),
+        lambda value: isinstance(value, datetime),
+    ),
+    "object": (lambda dtype: False, lambda value: isinstance(value, dict)),
+    "array": (lambda dtype: False, lambda value: isinstance(value, list)),
+    "null": (lambda dtype: False, lambda value: value is None),
+}
+
+
+class SchemaValidationError(Exception):
+    """
+    Raised when rows do not match the JSON schema of their table.
+
+    Attributes:
+        table_name: The name of the table.
+        errors: The number of violations per rule. A rule is "<column>: <keyword>", or only the keyword for
+            rules on the combination of columns, such as oneOf.
+        rows: The number of rows that were checked.
+    """
+
+    table_name: str
+    errors: Dict[str, int]
+    rows: int
+
+    def __init__(self, table_name: str, errors: Dict[str, int], rows: int):
+        self.table_name = table_name
+        self.errors = errors
+        self.rows = rows
+        summary = ", ".join(f"{rule}: {count}" for rule, count in errors.items())
+        super().__init__(
+            f"{sum(errors.values())} schema violations in {rows} rows of {table_name}: {summary}"
+        )
+
 
 @inject
 class SchemaValidator:
     """
-    Implements a validate() function, that consumes a JSON document and validates it against a JSON schema.
+    Implements a validate() function, that consumes a JSON document and validates it against a JSON schema,
+    and a validate_frame() function, that validates a DataFrame column by column.
 
     Attributes:
         metadata: The metadata class. Used to load the JSON schema.
+        sample_size: If set, only validate this many rows, evenly spread over the data.
+        max_errors: If set, stop validating once this many violations are found.
     """
 
     metadata: Metadata
+    sample_size: Optional[int]
+    max_errors: Optional[int]
 
-    def __init__(self, metadata: Metadata) -> None:
+    def __init__(
+        self, metadata: Metadata, sample_size: int = None, max_errors: int = None
+    ) -> None:
         self.metadata = metadata
+        self.sample_size = sample_size
+        self.max_errors = max_errors
+        self._validators: Dict[Tuple, Tuple[dict, Any]] = {}
 
-    def validate(self, table_name: str, data: dict) -> None:
+    def validate(
+        self, table_name: str, data: List[dict], columns: List[str] = None
+    ) -> None:
         """
-        Validate a JSON document against a JSON schema.
+        Validate a JSON document against a JSON schema. The rows are validated one by one with a validator
+        that is compiled once per table and columns. All violations are counted per rule, and raised together
+        as a SchemaValidationError.
 
         Args:
             table_name (str): The name of the table to validate against.
-            data (dict): The JSON document to validate.
+            data (List[dict]): The rows to validate.
+            columns (List[str]): If the rows were read with only these columns, only validate those columns.
+
+        """
+        _, validator = self._get_validator(table_name, columns)
+        rows = self._sample(data)
+        errors = Counter()
+        for row in rows:
+            for error in validator.iter_errors(row):
+                errors[self._get_rule(error)] += 1
+                if self.max_errors and sum(errors.values()) >= self.max_errors:
+                    raise SchemaValidationError(table_name, dict(errors), len(rows))
+        if errors:
+            raise SchemaValidationError(table_name, dict(errors), len(rows))
+
+    def validate_frame(
+        self, table_name: str, frame: pd.DataFrame, columns: List[str] = None
+    ) -> None:
+        """
+        Validate a DataFrame against the JSON schema of its rows, column by column. Checks the required
+        columns, the types and enums of the columns, and the required columns of the branches of oneOf, anyOf
+        and allOf. Missing values are treated as absent, so they are only checked by required. Violations are
+        counted per rule, and raised together as a SchemaValidationError. Each rule is checked for all rows
+        at once, so with max_errors, the rules after the one that reaches it are not checked.
+
+        Args:
+            table_name (str): The name of the table to validate against.
+            frame (pd.DataFrame): The rows to validate.
+            columns (List[str]): If the rows were read with only these columns, only validate those columns.
+        """
+        schema, _ = self._get_validator(table_name, columns)
+        frame = self._sample(frame)
+        errors = {}
+        for rule, count in self._iter_frame_errors(schema["items"], frame):
+            if not count:
+                continue
+            errors[rule] = count
+            if self.max_errors and sum(errors.values()) >= self.max_errors:
+                break
+        if errors:
+            raise SchemaValidationError(table_name, errors, len(frame))
+
+    def _iter_frame_errors(
+        self, items: dict, frame: pd.DataFrame
+    ) -> Iterator[Tuple[str, int]]:
+        """
+        Check the rules of the schema of a row on the frame, one rule at a time, and yield the number of
+        violations of each rule.
+        """
+        for column in items.get("required", []):
+            missing = frame[column].isna().sum() if column in frame else len(frame)
+            yield f"{column}: required", int(missing)
+        for column, definition in items.get("properties", {}).items():
+            if column not in frame:
+                continue
+            values = frame[column].dropna()
+            if "type" in definition:
+                valid = self._matches_type(values, definition["type"])
+                yield f"{column}: type", int((~valid).sum())
+            if "enum" in definition:
+                yield f"{column}: enum", int((~values.isin(definition["enum"])).sum())
+        for keyword in ["oneOf", "anyOf", "allOf"]:
+            if keyword not in items:
+                continue
+            matches = sum(self._matches_branch(frame, b) for b in items[keyword])
+            if keyword == "oneOf":
+                invalid = matches != 1
+            elif keyword == "anyOf":
+                invalid = matches == 0
+            else:
+                invalid = matches != len(items[keyword])
+            yield keyword, int(invalid.sum())
+
+    def _get_validator(
+        self, table_name: str, columns: Optional[List[str]]
+    ) -> Tuple[dict, Any]:
+        """
+        Get the schema of the table, projected on the columns, and a validator of its rows. Both are created
+        once per table and columns, and then cached. The schema is not checked against the meta-schema,
+        because it is extended with the datetime type.
+        """
+        key = (table_name, tuple(columns) if columns is not None else None)
+        if key not in self._validators:
+            schema = self.metadata.get_table(table_name).json_schema
+            if columns is not None:
+                schema = self._project(schema, columns)
+            validator = self._validator_for(schema)(schema["items"])
+            self._validators[key] = (schema, validator)
+        return self._validators[key]
+
+    def _sample(self, data: Sequence) -> Sequence:
+        """
+        Get at most sample_size rows, evenly spread over the data.
+        """
+        if not self.sample_size or len(data) <= self.sample_size:
+            return data
+        step = -(-len(data) // self.sample_size)
+        return data.iloc[::step] if isinstance(data, pd.DataFrame) else data[::step]
+
+    @staticmethod
+    def _get_rule(error: jsonschema.ValidationError) -> str:
+        """
+        Get the rule that a validation error violates, as "<column>: <keyword>".
+        """
+        if error.validator == "required":
+            column = error.message.split(" is a required property")[0].strip("'\"")
+        elif error.path:
+            column = error.path[0]
+        else:
+            return error.validator
+        return f"{column}: {error.validator}"
 
+    @staticmethod
+    def _matches_type(values: pd.Series, types: Any) -> pd.Series:
+        """
+        Check which values match one of the types. A column with a matching dtype matches as a whole, columns
+        of object dtype are checked value by value. Floats match integer if they have no fraction.
+        """
+        types = types if isinstance(types, list) else [types]
+        result = pd.Series(False, index=values.index)
+        for name in types:
+            check_dtype, check_value = TYPE_CHECKS[name]
+            if check_dtype(values.dtype):
+                return pd.Series(True, index=values.index)
+            if name == "integer" and pd.api.types.is_float_dtype(values.dtype):
+                result |= values % 1 == 0
+            elif values.dtype == object:
+                result |= values.map(check_value).astype(bool)
+        return result
+
+    @staticmethod
+    def _matches_branch(frame: pd.DataFrame, branch: dict) -> pd.Series:
+        """
+        Check which rows have all the required columns of a branch of a combined schema.
+        """
+        result = pd.Series(True, index=frame.index)
+        for column in branch.get("required", []):
+            result &= frame[column].notna() if column in frame else False
+        return result.astype(int)
+
+    @staticmethod
+    def _validator_for(schema: dict):
+        """
+        Get the validator class of the schema, extended with a "datetime" type. Timestamp columns are stored
+        as native datetimes, which JSON schema has no type for.
+        """
+        validator = jsonschema.validators.validator_for(schema)
+        type_checker = validator.TYPE_CHECKER.redefine(
+            "datetime", lambda _, instance: isinstance(instance, datetime)
+        )
+        return jsonschema.validators.extend(validator, type_checker=type_checker)
+
+    @staticmethod
+    def _project(schema: dict, columns: List[str]) -> dict:
+        """
+        Restrict the schema of an array of rows to the columns. Properties and required columns outside the
+        columns are dropped. Required columns in combined schemas (oneOf, anyOf, allOf) are dropped as well;
+        if that empties a branch, the whole combination is dropped, because it can no longer be checked.
         """
-        schema = self.metadata.get_table(table_name).json_schema
-        jsonschema.validate(data, schema)
+        items = dict(schema["items"])
+        items["properties"] = {
+            column: definition
+            for column, definition in items.get("properties", {}).items()
+            if column in columns
+        }
+        if "required" in items:
+            items["required"] = [c for c in items["required"] if c in columns]
+        for keyword in ["oneOf", "anyOf", "allOf"]:
+            if keyword not in items:
+                continue
+            branches = [
+                {
+                    **branch,
+                    "required": [c for c in branch.get("required", []) if c in columns],
+                }
+                for branch in items[keyword]
+            ]
+            if all(branch["required"] for branch in branches):
+                items[keyword] = branches
+            else:
+                del items[keyword]
+        return {**schema, "items": items}
@@ -2,26 +2,37 @@ from logging import LoggerAdapter
 
 from kink import di
 from prefect import flow, get_run_logger, task
+from prefect.task_runners import ConcurrentTaskRunner
 
 from predicting_glucose_levels.data.metadata import Metadata
+from predicting_glucose_levels.data.transformation.scheduler import (
+    TRANSFORMERS,
+    TransformationScheduler,
+)
 from predicting_glucose_levels.data.transformation.transformer.transformers.base_transformer import (
     BaseTransformer,
 )
-from predicting_glucose_levels.data.transformation.transformer.transformers.glucose_measurements_transformer import (
-    GlucoseMeasurementTransformer,
-)
 
 
-@flow(validate_parameters=False)
+@flow(validate_parameters=False, task_runner=ConcurrentTaskRunner())
 def etl():
     # Use dependency injection to inject the prefect logger
     di[LoggerAdapter] = get_run_logger()
-    transformers = [GlucoseMeasurementTransformer]
+    scheduler = TransformationScheduler()
+    dependencies = scheduler.get_dependencies(TRANSFORMERS)
+
+    @task
+    def ingest():
+        scheduler.ingest(list(dependencies))
 
     @task
     def transform_one(_cls):
-        transformer = _cls()
+        transformer = scheduler.create(_cls, {})
         transformer.etl()
 
-    for _cls in transformers:
-        transform_one(_cls)
+    # Ingest each source once, then run each transformer once its dependencies are done
+    ingested = ingest.submit()
+    futures = {}
+    for _cls, dependency_classes in dependencies.items():
+        wait_for = [ingested, *[futures[d] for d in dependency_classes]]
+        futures[_cls] = transform_one.submit(_cls, wait_for=wait_for)
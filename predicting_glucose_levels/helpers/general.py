@@ -1,7 +1,68 @@
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+from itertools import islice
+from typing import Any, Iterable, Iterator, List, Optional, Tuple
 
 import pytz
+from dateutil.parser import isoparse
 
 
 def now():
     return datetime.now(tz=pytz.timezone("Europe/Amsterdam"))
+
+
+def to_utc(value: Any) -> Optional[datetime]:
+    """
+    Convert a timestamp to an aware datetime in UTC. Strings are parsed as ISO 8601. Naive datetimes and
+    strings without offset are assumed to be in local time, like the datetimes of datetime.now(). Pandas
+    timestamps are converted to datetimes first.
+    """
+    if value is None or value != value:
+        return None
+    if isinstance(value, str):
+        try:
+            value = datetime.fromisoformat(value.replace("Z", "+00:00"))
+        except ValueError:
+            value = isoparse(value)
+    if hasattr(value, "to_pydatetime"):
+        value = value.to_pydatetime()
+    if not isinstance(value, datetime):
+        raise ValueError(f"Cannot convert {value!r} to a timestamp.")
+    return value.astimezone(timezone.utc)
+
+
+def to_local(value: Any) -> datetime:
+    """
+    Convert a timestamp read from storage to a naive datetime in local time, like the datetimes of
+    datetime.now(). Naive datetimes are read as UTC, because storage returns them that way. Strings are
+    parsed as ISO 8601, and returned as is when they have no offset.
+    """
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+        return value.astimezone().replace(tzinfo=None) if value.tzinfo else value
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.astimezone().replace(tzinfo=None)
+
+
+def batched(iterable: Iterable, size: int) -> Iterator[List]:
+    """
+    Lazily split an iterable into lists of at most size items. Only one batch is held in memory at a time.
+    """
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def split_window(
+    start: datetime, end: datetime, span: timedelta
+) -> List[Tuple[datetime, datetime]]:
+    """
+    Split the window from start to end into consecutive windows of at most span. The end of each window is
+    the start of the next one.
+    """
+    windows = []
+    while start + span < end:
+        windows.append((start, start + span))
+        start += span
+    windows.append((start, end))
+    return windows
@@ -0,0 +1,60 @@
+import json
+from typing import Any, Iterable, Iterator
+
+WHITESPACE = " \t\r\n"
+# The characters that can follow a complete element of an array
+FOLLOWING = WHITESPACE + ",]"
+
+
+def iter_json_array(chunks: Iterable[str]) -> Iterator[Any]:
+    """
+    Incrementally decode a JSON array from chunks of text, and yield each element as soon as it is complete.
+    Only the text of the elements that are not yet decoded is held in memory, so decoding can overlap with
+    the transfer of the next chunks.
+    """
+    decoder = json.JSONDecoder()
+    chunks = iter(chunks)
+    buffer, position = "", 0
+    started, exhausted = False, False
+    while True:
+        while position < len(buffer) and buffer[position] in WHITESPACE:
+            position += 1
+        if position == len(buffer):
+            if exhausted:
+                raise ValueError("Unexpected end of JSON array.")
+            buffer, position, exhausted = _read(buffer, position, chunks)
+            continue
+        if not started:
+            if buffer[position] != "[":
+                raise ValueError(f"Expected a JSON array, got {buffer[position]!r}.")
+            started = True
+            position += 1
+        elif buffer[position] == "]":
+            return
+        elif buffer[position] == ",":
+            position += 1
+        else:
+            try:
+                element, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if exhausted:
+                    raise
+                buffer, position, exhausted = _read(buffer, position, chunks)
+                continue
+            if not exhausted and (end == len(buffer) or buffer[end] not in FOLLOWING):
+                # A number that ends the buffer, or is cut at a ".", "e" or digit, continues in the next chunk
+                buffer, position, exhausted = _read(buffer, position, chunks)
+                continue
+            yield element
+            position = end
+
+
+def _read(buffer: str, position: int, chunks: Iterator[str]):
+    """
+    Drop the decoded part of the buffer, and append the next chunk. Return the new buffer, the new position
+    and whether the chunks are exhausted.
+    """
+    chunk = next(chunks, None)
+    if chunk is None:
+        return buffer, position, True
+    return buffer[position:] + chunk, 0, False
@@ -1,3 +1,5 @@
+from datetime import datetime
+
 import click
 from kink import di, inject
 from prefect import flow, task
@@ -5,7 +7,15 @@ from prefect.deployments.deployments import Deployment
 
 from predicting_glucose_levels.data import table_metadata
 from predicting_glucose_levels.data.ingestion.ingester import Ingester
+from predicting_glucose_levels.data.ingestion.loader.abstract_loader import (
+    AbstractLoader,
+)
+from predicting_glucose_levels.data.ingestion.loader.replay_loader import ReplayLoader
 from predicting_glucose_levels.data.metadata import Metadata
+from predicting_glucose_levels.data.storage.abstract_storage import AbstractStorage
+from predicting_glucose_levels.data.transformation.scheduler import (
+    TransformationScheduler,
+)
 from predicting_glucose_levels.data.transformation.transformer.transformers import *
 from predicting_glucose_levels.data.transformation.transformer.transformers.glucose_measurements_transformer import (
     GlucoseMeasurementTransformer,
@@ -19,25 +29,89 @@ def cli():
 
 
 @cli.command
+@click.option("--workers", default=1, help="Number of tables to ingest concurrently.")
+@click.option(
+    "--chunk-workers",
+    default=1,
+    help="Number of chunks of a chunked table to ingest concurrently.",
+)
 @inject
-def ingest(metadata: Metadata):
+def ingest(workers: int, chunk_workers: int, metadata: Metadata):
     """
     Ingest all source tables.
     """
 
     tables = [t for t in metadata.tables if t.type == "source_table"]
     ingester = Ingester()
-    ingester.ingest(tables=tables)
+    ingester.ingest(tables=tables, max_workers=workers, chunk_workers=chunk_workers)
+
+
+@cli.command
+@click.option("--directory", required=True, help="Directory to record into.")
+@click.option("--start", type=click.DateTime(), required=True)
+@click.option("--end", type=click.DateTime(), help="Defaults to now.")
+@inject
+def record(
+    directory: str,
+    start: datetime,
+    end: datetime,
+    data_loader: AbstractLoader,
+    metadata: Metadata,
+):
+    """
+    Record the source tables with the configured loader, so that they can be replayed with the ReplayLoader.
+    """
+    end = end or datetime.now()
+    for table in [t for t in metadata.tables if t.type == "source_table"]:
+        rows = ReplayLoader.record(
+            data_loader, directory, start, end, table.endpoint, table.timestamp_col
+        )
+        click.echo(f"Recorded {rows} rows of {table.name}")
+
+
+@cli.command
+@inject
+def migrate(storage: AbstractStorage, metadata: Metadata):
+    """
+    Move rows into the layout declared in the metadata, and convert timestamps that are stored as strings to
+    native datetimes.
+    """
+    for table in metadata.tables:
+        storage.migrate_layout(table.name)
+        storage.migrate_timestamps(table.name)
+
+
+@cli.command
+@click.option(
+    "--pushdown",
+    is_flag=True,
+    help="Run transformations in the storage, if it supports that.",
+)
+@click.option(
+    "--chunk-size",
+    type=int,
+    help="Transform and load this many source rows at a time.",
+)
+@click.option(
+    "--workers", default=4, help="Number of transformers to run concurrently."
+)
+def transform(pushdown: bool, chunk_size: int, workers: int):
+    """
+    Run all defined transformers. Their source tables are ingested once, and transformers that do not
+    depend on each other run concurrently.
+    """
+    scheduler = TransformationScheduler(max_workers=workers)
+    scheduler.run(pushdown=pushdown, chunk_size=chunk_size)
 
 
 @cli.command
-def transform():
+@click.option("--since", type=click.DateTime(), help="Defaults to the last runmoment.")
+def verify_pushdown(since: datetime):
     """
-    Run all defined transformers.
+    Check that the pushed-down transformation produces the same rows as the Python transformation.
     """
-    transformers = [GlucoseMeasurementTransformer]
-    for transformer in transformers:
-        transformer().etl()
+    differences = GlucoseMeasurementTransformer().verify_pushdown(since)
+    click.echo(f"{len(differences)} measurements differ: {differences[:10]}")
 
 
 @cli.command
@@ -0,0 +1,83 @@
+from datetime import datetime, timedelta
+
+import httpx
+import pytest
+
+from predicting_glucose_levels.data.ingestion.loader.abstract_loader import LoaderError
+from predicting_glucose_levels.data.ingestion.loader.async_nightscout_loader import (
+    AsyncNightscoutLoader,
+)
+
+ENTRIES = [
+    {
+        "_id": str(i),
+        "dateString": (datetime(2023, 7, 1) + timedelta(hours=6 * i)).isoformat(),
+    }
+    for i in range(12)
+]
+
+
+def handler(request: httpx.Request) -> httpx.Response:
+    """
+    Mimic the Nightscout API: filter the entries on the dateString window.
+    """
+    params = request.url.params
+    start = params["find[dateString][$gte]"]
+    if "find[dateString][$lte]" in params:
+        rows = [
+            r
+            for r in ENTRIES
+            if start <= r["dateString"] <= params["find[dateString][$lte]"]
+        ]
+    else:
+        rows = [
+            r
+            for r in ENTRIES
+            if start <= r["dateString"] < params["find[dateString][$lt]"]
+        ]
+    return httpx.Response(200, json=rows)
+
+
+@pytest.fixture
+def loader():
+    loader = AsyncNightscoutLoader(
+        "https://nightscout",
+        "secret",
+        sub_window=timedelta(days=1),
+        max_concurrency=2,
+        transport=httpx.MockTransport(handler),
+    )
+    yield loader
+    loader.close()
+
+
+def test_load_splits_window_without_duplicates(loader):
+    # Act
+    result = loader.load(
+        datetime(2023, 7, 1), datetime(2023, 7, 3, 18), "entries", "dateString"
+    )
+
+    # Assert
+    assert [row["_id"] for row in result] == [str(i) for i in range(12)]
+
+
+def test_failed_sub_windows_are_reported_with_the_loaded_rows(loader):
+    # Arrange
+    def failing_handler(request: httpx.Request) -> httpx.Response:
+        if request.url.params["find[dateString][$gte]"].startswith("2023-07-02"):
+            return httpx.Response(502, text="Bad gateway")
+        return handler(request)
+
+    loader._transport = httpx.MockTransport(failing_handler)
+
+    # Act
+    with pytest.raises(LoaderError) as error:
+        loader.load(
+            datetime(2023, 7, 1), datetime(2023, 7, 3, 18), "entries", "dateString"
+        )
+
+    # Assert
+    assert error.value.failed_windows == [(datetime(2023, 7, 2), datetime(2023, 7, 3))]
+    assert [row["_id"] for row in error.value.rows] == [
+        str(i) for i in [0, 1, 2, 3, 8, 9, 10, 11]
+    ]
@@ -0,0 +1,94 @@
+from datetime import datetime, timezone
+from unittest.mock import Mock
+
+import pytest
+
+from predicting_glucose_levels.data.metadata import Metadata
+from predicting_glucose_levels.data.storage.buffered_storage import BufferedStorage
+from predicting_glucose_levels.data.storage.in_memory_storage import InMemoryStorage
+from predicting_glucose_levels.data.table_metadata import TableMetadata
+
+
+@pytest.fixture
+def metadata():
+    tables = {
+        "entries": TableMetadata(
+            name="entries", key_col="key", timestamp_col="timestamp", type="source"
+        ),
+        "runmoments": TableMetadata(
+            name="runmoments",
+            key_col="source",
+            timestamp_col="timestamp",
+            type="config_table",
+        ),
+    }
+    metadata = Mock(spec=Metadata)
+    metadata.get_table.side_effect = tables.__getitem__
+    return metadata
+
+
+@pytest.fixture
+def backend(metadata):
+    backend = InMemoryStorage(metadata, Mock())
+    backend._upsert = Mock(wraps=backend._upsert)
+    return backend
+
+
+@pytest.fixture
+def storage(backend, metadata):
+    return BufferedStorage(backend, metadata, Mock(), max_rows=100, max_age=3600)
+
+
+def moment(hour: int) -> datetime:
+    return datetime(2023, 7, 28, hour, tzinfo=timezone.utc)
+
+
+def test_upserts_are_coalesced_by_timestamp(storage, backend):
+    # Act
+    storage.upsert([{"key": 1, "timestamp": moment(2), "value": "new"}], "entries")
+    storage.upsert(
+        [{"key": 1, "timestamp": moment(1), "value": "old", "extra": 1}], "entries"
+    )
+    backend._upsert.assert_not_called()
+    storage.flush()
+
+    # Assert
+    backend._upsert.assert_called_once()
+    rows = backend.find("entries")
+    assert len(rows) == 1
+    assert (rows[0]["value"], rows[0]["extra"]) == ("new", 1)
+
+
+def test_flushes_when_full(storage, backend):
+    # Act
+    storage.upsert([{"key": k, "timestamp": moment(1)} for k in range(150)], "entries")
+
+    # Assert
+    assert len(backend.find("entries")) == 150
+
+
+def test_runmoments_are_flushed_after_data(storage, backend):
+    # Act
+    storage.upsert([{"key": 1, "timestamp": moment(1)}], "entries")
+    storage.set_last_runmoment("entries", moment(2))
+    storage.upsert([{"key": 2, "timestamp": moment(2)}], "entries")
+    runmoment = storage.get_last_runmoment("entries")
+    backend._upsert.assert_not_called()
+    with storage:
+        pass
+
+    # Assert
+    tables = [call.args[1] for call in backend._upsert.call_args_list]
+    assert tables == ["entries", "runmoments"]
+    assert runmoment == storage.get_last_runmoment("entries")
+
+
+def test_reads_see_buffered_writes(storage, backend):
+    # Act
+    storage.upsert([{"key": 1, "timestamp": moment(1)}], "entries")
+    storage.set_last_runmoment("entries", moment(2))
+    rows = storage.find("entries")
+
+    # Assert
+    assert [row["key"] for row in rows] == [1]
+    assert backend.find("runmoments") == []
@@ -0,0 +1,238 @@
+import os
+from datetime import datetime, timedelta, timezone
+from logging import LoggerAdapter
+from unittest.mock import Mock
+
+import pandas as pd
+import pytest
+from kink import di
+from pymongo import MongoClient
+
+from predicting_glucose_levels.data.ingestion.ingester import Ingester
+from predicting_glucose_levels.data.metadata import Metadata
+from predicting_glucose_levels.data.storage.abstract_storage import AbstractStorage
+from predicting_glucose_levels.data.storage.in_memory_storage import InMemoryStorage
+from predicting_glucose_levels.data.storage.mongo_storage import MongoStorage
+from predicting_glucose_levels.data.transformation.transformer.transformers.glucose_measurements_transformer import (
+    GlucoseMeasurementTransformer,
+)
+from predicting_glucose_levels.data.transformation.transformer.validators.schema_validator import (
+    SchemaValidator,
+)
+from predicting_glucose_levels.helpers.general import to_local
+
+START = datetime(2023, 7, 28, tzinfo=timezone.utc)
+ENTRY = {"date": 0, "device": "test", "sysTime": "", "utcOffset": 0}
+ENTRIES = [
+    {
+        **ENTRY,
+        "_id": "a",
+        "dateString": START,
+        "sgv": 90,
+        "delta": 1.5,
+        "direction": "Flat",
+        "type": "sgv",
+    },
+    {
+        **ENTRY,
+        "_id": "b",
+        "dateString": START + timedelta(hours=1),
+        "mbg": 99.5,
+        "type": "mbg",
+    },
+    {
+        **ENTRY,
+        "_id": "c",
+        "dateString": START + timedelta(hours=2),
+        "mbg": 5,
+        "type": "cal",
+    },
+]
+# The rows that the pipeline of the transformer produces from ENTRIES
+PUSHED = [
+    {
+        "glucose_measurement_id": "a",
+        "glucose_measurement_time": START,
+        "delta": 1.5,
+        "direction": "Flat",
+        "glucose_value_mg_dl": 90.0,
+        "type": "sgv",
+        "updated_at": START,
+        "glucose_value_mmol_l": 90 / 18.0182,
+    },
+    {
+        "glucose_measurement_id": "b",
+        "glucose_measurement_time": START + timedelta(hours=1),
+        "delta": None,
+        "direction": None,
+        "glucose_value_mg_dl": 99.5,
+        "type": "mbg",
+        "updated_at": START,
+        "glucose_value_mmol_l": 99.5 / 18.0182,
+    },
+]
+
+
+def register(storage: AbstractStorage):
+    """
+    Upsert the entries into the storage, and inject it into the transformers while the test runs.
+    """
+    storage.upsert(ENTRIES, "entries")
+    services = dict(di._services)
+    di[Metadata] = storage.metadata
+    di[AbstractStorage] = storage
+    di[Ingester] = Mock(spec=Ingester)
+    di[SchemaValidator] = SchemaValidator(storage.metadata)
+    di[LoggerAdapter] = Mock()
+    yield storage
+    di._services.clear()
+    di._services.update(services)
+
+
+@pytest.fixture
+def storage():
+    yield from register(InMemoryStorage(Metadata(), Mock()))
+
+
+@pytest.fixture(params=["bucketed", "flat"])
+def mongo_storage(request):
+    """
+    A MongoStorage on a scratch database of the MongoDB server in MONGO_URI, which is dropped afterwards.
+    The glucose measurements are stored in buckets, as declared in their metadata, or as separate documents.
+    """
+    client = MongoClient(
+        os.getenv("MONGO_URI"),
+        username=os.getenv("MONGO_USER"),
+        password=os.getenv("MONGO_PASSWORD"),
+        tz_aware=True,
+    )
+    client.drop_database("test_pushdown")
+    metadata = Metadata()
+    if request.param == "flat":
+        metadata.get_table("glucose_measurements").bucket_col = None
+    storage = MongoStorage(client, client["test_pushdown"], metadata, Mock())
+    storage.set_indexes()
+    yield from register(storage)
+    client.drop_database("test_pushdown")
+
+
+def test_verify_pushdown_matches_python(storage):
+    # Arrange
+    storage.aggregate = Mock(return_value=iter(PUSHED))
+
+    # Act
+    result = GlucoseMeasurementTransformer().verify_pushdown()
+
+    # Assert
+    assert result == []
+    assert storage.aggregate.call_args.args[0] == "entries"
+
+
+@pytest.mark.skipif(
+    not os.getenv("MONGO_URI"), reason="Requires a MongoDB server in MONGO_URI"
+)
+def test_pushdown_on_mongo_matches_python(mongo_storage):
+    # Arrange
+    python = GlucoseMeasurementTransformer()
+    python.extract()
+    python.transform()
+    expected = python._get_rows(python.result)
+
+    # Act
+    differences = GlucoseMeasurementTransformer().verify_pushdown()
+    GlucoseMeasurementTransformer(pushdown=True).etl()
+    result = mongo_storage.find("glucose_measurements", sort=["glucose_measurement_id"])
+
+    # Assert
+    assert differences == []
+    assert [{**row, "updated_at": None} for row in result] == [
+        {**row, "updated_at": None} for row in expected
+    ]
+
+
+def test_verify_pushdown_reports_differences(storage):
+    # Arrange
+    pushed = [PUSHED[0], {**PUSHED[1], "glucose_value_mmol_l": 5.5}]
+    storage.aggregate = Mock(return_value=iter(pushed))
+
+    # Act
+    result = GlucoseMeasurementTransformer().verify_pushdown()
+
+    # Assert
+    assert result == ["b"]
+
+
+def test_etl_with_pushdown_merges_pipeline(storage):
+    # Arrange
+    storage.supports_pushdown = True
+    storage.merge_pipeline = Mock()
+    transformer = GlucoseMeasurementTransformer(pushdown=True)
+
+    # Act
+    transformer.etl()
+
+    # Assert
+    source, pipeline, destination = storage.merge_pipeline.call_args.args
+    assert (source, destination) == ("entries", "glucose_measurements")
+    assert pipeline == transformer.get_pipeline(datetime(2020, 1, 1))
+    assert storage.find("glucose_measurements") == []
+    assert storage.get_last_runmoment("glucose_measurements") == transformer.runmoment
+
+
+def test_etl_without_pushdown_support_uses_python(storage):
+    # Act
+    GlucoseMeasurementTransformer(pushdown=True).etl()
+    result = storage.find("glucose_measurements", sort=["glucose_measurement_id"])
+
+    # Assert
+    assert [row["glucose_measurement_id"] for row in result] == ["a", "b"]
+    assert (result[1]["delta"], result[1]["direction"]) == (None, None)
+
+
+def test_etl_chunked_advances_runmoment_per_chunk(storage):
+    # Arrange
+    transformer = GlucoseMeasurementTransformer(chunk_size=1)
+    load_chunk = transformer.load_chunk
+
+    def load_first_chunk(result, watermark):
+        if storage.find("glucose_measurements"):
+            raise Exception("Failed")
+        load_chunk(result, watermark)
+
+    transformer.load_chunk = load_first_chunk
+
+    # Act
+    with pytest.raises(Exception, match="Failed"):
+        transformer.etl()
+    first = storage.get_last_runmoment("glucose_measurements")
+    GlucoseMeasurementTransformer(chunk_size=1).etl()
+    result = storage.find("glucose_measurements", sort=["glucose_measurement_id"])
+
+    # Assert
+    assert first == to_local(START)
+    assert [row["glucose_measurement_id"] for row in result] == ["a", "b"]
+    assert storage.get_last_runmoment("glucose_measurements") == to_local(
+        START + timedelta(hours=1)
+    )
+
+
+@pytest.mark.parametrize(
+    "chunk, following, expected",
+    [([1, 2], None, 2), ([1, 2], [3], 2), ([1, 2], [2, 3], 1), ([2, 2], [2], None)],
+)
+def test_watermark_excludes_times_of_following_chunk(
+    storage, chunk, following, expected
+):
+    # Arrange
+    transformer = GlucoseMeasurementTransformer()
+
+    def frame(hours):
+        return pd.DataFrame({"dateString": [START + timedelta(hours=h) for h in hours]})
+
+    # Act
+    result = transformer._get_watermark(
+        frame(chunk), frame(following) if following else None
+    )
+
+    # Assert
+    assert result == (START + timedelta(hours=expected) if expected else None)
@@ -0,0 +1,120 @@
+from datetime import datetime, timedelta, timezone
+from unittest.mock import Mock
+
+import pandas as pd
+import pytest
+
+from predicting_glucose_levels.data.metadata import Metadata
+from predicting_glucose_levels.data.storage.in_memory_storage import InMemoryStorage
+from predicting_glucose_levels.data.table_metadata import TableMetadata
+
+START = datetime(2023, 7, 28, tzinfo=timezone.utc)
+
+
+@pytest.fixture
+def storage():
+    metadata = Mock(spec=Metadata)
+    metadata.get_table.return_value = TableMetadata(
+        name="test_table", key_col="key", timestamp_col="timestamp", type="test_table"
+    )
+    storage = InMemoryStorage(metadata, Mock())
+    storage.upsert(
+        [
+            {"key": k, "timestamp": START + timedelta(hours=k), "value": k % 3}
+            for k in range(10)
+        ],
+        "test_table",
+    )
+    return storage
+
+
+@pytest.mark.parametrize(
+    "query, expected",
+    [
+        ([("value", "eq", 1)], [1, 4, 7]),
+        ([("value", "ne", 0), ("key", "lt", 3)], [1, 2]),
+        ([("value", "in", [2])], [2, 5, 8]),
+        ([("value", "nin", [0, 1])], [2, 5, 8]),
+        ([("key", "gte", 8)], [8, 9]),
+        ([("key", "lte", 1)], [0, 1]),
+        ([("key", "in", [3, 3, 11])], [3]),
+        ([("missing", "eq", None)], list(range(10))),
+        ([("missing", "ne", 1), ("key", "gt", 8)], [9]),
+    ],
+)
+def test_operators(storage, query, expected):
+    # Act
+    result = storage.find("test_table", query, ["key"])
+
+    # Assert
+    assert [row["key"] for row in result] == expected
+
+
+def test_range_on_index(storage):
+    # Act
+    result = storage.find(
+        "test_table",
+        [
+            ("timestamp", "gt", START + timedelta(hours=2)),
+            ("timestamp", "lte", START + timedelta(hours=5)),
+        ],
+        ["timestamp"],
+        asc=False,
+        columns=["key"],
+    )
+
+    # Assert
+    assert result == [{"key": 5}, {"key": 4}, {"key": 3}]
+
+
+def test_upsert_updates_row_and_index(storage):
+    # Act
+    result = storage.upsert(
+        [
+            {"key": 0, "timestamp": START + timedelta(days=1)},
+            {"key": 1, "value": 1},
+            {"key": 10, "timestamp": START},
+        ],
+        "test_table",
+    )
+    last = storage.find_one("test_table", [], ["timestamp"], False)
+
+    # Assert
+    assert (result.matched, result.upserted, result.modified) == (2, 1, 2)
+    assert (last["key"], last["value"]) == (0, 0)
+    assert storage.tables["test_table"].keys[:2] == [10, 1]
+
+
+def test_overwrite_and_find_frame(storage):
+    # Act
+    storage.overwrite(pd.DataFrame({"key": [1, 2], "value": [3, 4]}), "test_table")
+    result = storage.find_frame("test_table", sort=["key"], columns=["value"])
+
+    # Assert
+    assert result["value"].tolist() == [3, 4]
+
+
+def test_failed_overwrite_keeps_table(storage):
+    # Arrange
+    data = pd.DataFrame({"key": [1, [2]], "value": [3, 4]})
+
+    # Act
+    with pytest.raises(TypeError):
+        storage.overwrite(data, "test_table")
+    result = storage.find("test_table", sort=["key"])
+
+    # Assert
+    assert [row["key"] for row in result] == list(range(10))
+
+
+def test_upsert_detects_changes(storage):
+    # Arrange
+    storage.metadata.get_table.return_value.detect_changes = True
+    data = [{"key": 11, "value": 1}, {"key": 12, "value": 2}]
+    storage.upsert(data, "test_table")
+
+    # Act
+    result = storage.upsert(data, "test_table")
+
+    # Assert
+    assert result.skipped == 2
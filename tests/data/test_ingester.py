@@ -1,12 +1,15 @@
+from datetime import datetime
 from unittest.mock import Mock
 
 import pytest
 
-from predicting_glucose_levels.data.ingestion.ingester import Ingester
+from predicting_glucose_levels.data.ingestion.ingester import Ingester, IngestionError
 from predicting_glucose_levels.data.ingestion.loader.abstract_loader import (
     AbstractLoader,
 )
+from predicting_glucose_levels.data.ingestion.loader.retrying_loader import LoaderStats
 from predicting_glucose_levels.data.storage.abstract_storage import AbstractStorage
+from predicting_glucose_levels.data.storage.upsert_result import UpsertResult
 from predicting_glucose_levels.data.table_metadata import TableMetadata
 
 
@@ -17,7 +20,9 @@ def mock_data_loader():
 
 @pytest.fixture
 def mock_storage():
-    return Mock(spec=AbstractStorage)
+    storage = Mock(spec=AbstractStorage)
+    storage.upsert.return_value = UpsertResult()
+    return storage
 
 
 @pytest.fixture
@@ -59,6 +64,31 @@ def test_ingest_single_table(ingester, mock_data_loader, mock_storage):
     mock_storage.set_last_runmoment.assert_called_with("table_1", "2023-07-29")
 
 
+def test_ingest_logs_loader_stats_per_table(ingester, mock_data_loader, mock_storage):
+    # Arrange
+    table = TableMetadata(
+        name="table_1",
+        endpoint="endpoint",
+        timestamp_col="timestamp",
+        key_col="key",
+        type="source_table",
+    )
+    mock_storage.get_window.return_value = ("2023-07-28", "2023-07-29")
+    mock_data_loader.load.return_value = []
+    mock_data_loader.stats = LoaderStats(retries=2, splits=1)
+    ingester.logger = Mock()
+
+    # Act
+    ingester.ingest([table])
+
+    # Assert
+    messages = [call.args[0] for call in ingester.logger.info.call_args_list]
+    assert (
+        "Loader stats after ingesting table_1: LoaderStats(retries=2, splits=1)"
+        in messages
+    )
+
+
 def test_ingest_multiple_tables(ingester, mock_data_loader, mock_storage):
     # Arrange
     table1 = TableMetadata(
@@ -99,3 +129,131 @@ def test_ingest_multiple_tables(ingester, mock_data_loader, mock_storage):
     assert mock_data_loader.load.call_count == 2
     assert mock_storage.upsert.call_count == 2
     assert mock_storage.set_last_runmoment.call_count == 2
+
+
+def test_ingest_paginated_table(ingester, mock_data_loader, mock_storage):
+    """
+    Test that a table with a page size is upserted page by page.
+    """
+    # Arrange
+    table = TableMetadata(
+        name="table_1",
+        endpoint="endpoint",
+        timestamp_col="timestamp",
+        key_col="key",
+        type="source_table",
+        page_size=1,
+    )
+    mock_storage.get_window.return_value = ("2023-07-28", "2023-07-29")
+    mock_data_loader.load_pages.return_value = iter(
+        [
+            [{"key": 2, "timestamp": "2023-07-29T08:30:00"}],
+            [{"key": 1, "timestamp": "2023-07-28T12:00:00"}],
+        ]
+    )
+
+    # Act
+    ingester.ingest([table])
+
+    # Assert
+    mock_data_loader.load.assert_not_called()
+    mock_data_loader.load_pages.assert_called_with(
+        "2023-07-28", "2023-07-29", "endpoint", "timestamp", 1
+    )
+    assert mock_storage.upsert.call_count == 2
+    mock_storage.set_last_runmoment.assert_called_once_with("table_1", "2023-07-29")
+
+
+def test_ingest_concurrently_aggregates_errors(
+    ingester, mock_data_loader, mock_storage
+):
+    """
+    Test that a failing table does not stop the other tables from being ingested.
+    """
+    # Arrange
+    tables = [
+        TableMetadata(
+            name=name,
+            endpoint=name,
+            timestamp_col="timestamp",
+            key_col="key",
+            type="source_table",
+        )
+        for name in ["table_1", "table_2", "table_3"]
+    ]
+    mock_storage.get_window.return_value = ("2023-07-28", "2023-07-29")
+
+    def load(start, end, endpoint, timestamp_col):
+        if endpoint == "table_2":
+            raise Exception("Nightscout is down")
+        return [{"key": 1, "timestamp": "2023-07-28T12:00:00"}]
+
+    mock_data_loader.load.side_effect = load
+
+    # Act
+    with pytest.raises(IngestionError) as e:
+        ingester.ingest(tables, max_workers=3)
+
+    # Assert
+    assert list(e.value.errors) == ["table_2"]
+    assert mock_storage.upsert.call_count == 2
+    assert {c.args[0] for c in mock_storage.set_last_runmoment.call_args_list} == {
+        "table_1",
+        "table_3",
+    }
+
+
+def chunked_table():
+    return TableMetadata(
+        name="table_1",
+        endpoint="endpoint",
+        timestamp_col="timestamp",
+        key_col="key",
+        type="source_table",
+        chunk_hours=24,
+    )
+
+
+def test_ingest_chunked_table_sets_runmoment_per_chunk(
+    ingester, mock_data_loader, mock_storage
+):
+    # Arrange
+    mock_storage.get_window.return_value = (
+        datetime(2023, 7, 1),
+        datetime(2023, 7, 3, 12),
+    )
+    mock_data_loader.load.return_value = []
+
+    # Act
+    ingester.ingest([chunked_table()])
+
+    # Assert
+    assert mock_data_loader.load.call_count == 3
+    assert [c.args[1] for c in mock_storage.set_last_runmoment.call_args_list] == [
+        datetime(2023, 7, 2),
+        datetime(2023, 7, 3),
+        datetime(2023, 7, 3, 12),
+    ]
+
+
+def test_ingest_chunks_concurrently_never_skips_failed_chunk(
+    ingester, mock_data_loader, mock_storage
+):
+    # Arrange
+    mock_storage.get_window.return_value = (datetime(2023, 7, 1), datetime(2023, 7, 5))
+
+    def load(start, end, endpoint, timestamp_col):
+        if start == datetime(2023, 7, 2):
+            raise Exception("Nightscout is down")
+        return []
+
+    mock_data_loader.load.side_effect = load
+
+    # Act
+    with pytest.raises(Exception, match="Nightscout is down"):
+        ingester.ingest([chunked_table()], chunk_workers=4)
+
+    # Assert
+    runmoments = [c.args[1] for c in mock_storage.set_last_runmoment.call_args_list]
+    assert runmoments == sorted(runmoments)
+    assert all(runmoment <= datetime(2023, 7, 2) for runmoment in runmoments)
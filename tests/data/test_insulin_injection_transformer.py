@@ -0,0 +1,103 @@
+from datetime import datetime, timedelta, timezone
+from logging import LoggerAdapter
+from unittest.mock import Mock
+
+import pytest
+from kink import di
+
+from predicting_glucose_levels.data.ingestion.ingester import Ingester
+from predicting_glucose_levels.data.metadata import Metadata
+from predicting_glucose_levels.data.storage.abstract_storage import AbstractStorage
+from predicting_glucose_levels.data.storage.in_memory_storage import InMemoryStorage
+from predicting_glucose_levels.data.transformation.transformer.transformers.insulin_injection_transformer import (
+    InsulinInjectionTransformer,
+)
+from predicting_glucose_levels.data.transformation.transformer.validators.schema_validator import (
+    SchemaValidator,
+)
+from predicting_glucose_levels.helpers.general import to_local
+
+START = datetime(2023, 7, 28, tzinfo=timezone.utc)
+
+
+def treatment(key: str, hours: int, event_type: str, **columns) -> dict:
+    return {
+        "_id": key,
+        "created_at": START + timedelta(hours=hours),
+        "eventType": event_type,
+        **columns,
+    }
+
+
+TREATMENTS = [
+    treatment("meal", 0, "Meal Bolus", insulin=4.5, carbs="40"),
+    treatment("correction", 1, "Correction Bolus", insulin=1),
+    treatment("basal", 2, "Temp Basal", absolute=0.8, duration=30),
+    treatment("suspend", 3, "Temp Basal", rate=0, duration=60),
+    treatment("injection", 4, "<none>", insulin=2),
+    treatment("carbs", 5, "Carb Correction", carbs="20"),
+    treatment("note", 6, "Note"),
+]
+
+
+@pytest.fixture
+def storage():
+    metadata = Metadata()
+    storage = InMemoryStorage(metadata, Mock())
+    storage.upsert(TREATMENTS, "treatments")
+    services = dict(di._services)
+    di[Metadata] = metadata
+    di[AbstractStorage] = storage
+    di[Ingester] = Mock(spec=Ingester)
+    di[SchemaValidator] = SchemaValidator(metadata)
+    di[LoggerAdapter] = Mock()
+    yield storage
+    di._services.clear()
+    di._services.update(services)
+
+
+def test_transform_projects_insulin_events(storage):
+    # Act
+    InsulinInjectionTransformer().etl()
+    result = storage.find("insulin_injections", sort=["insulin_injection_time"])
+
+    # Assert
+    assert [
+        (row["insulin_injection_id"], row["insulin_type"], row["insulin_units"])
+        for row in result
+    ] == [
+        ("meal", "bolus", 4.5),
+        ("correction", "correction", 1.0),
+        ("basal", "temp_basal", 0.4),
+        ("suspend", "temp_basal", 0.0),
+        ("injection", "bolus", 2.0),
+    ]
+    assert (result[2]["basal_rate_u_h"], result[2]["duration_minutes"]) == (0.8, 30)
+    assert (result[0]["basal_rate_u_h"], result[0]["duration_minutes"]) == (None, None)
+    assert result[0]["insulin_injection_time"] == START
+
+
+def test_etl_is_incremental(storage):
+    # Arrange
+    InsulinInjectionTransformer().etl()
+    storage.set_last_runmoment("insulin_injections", START + timedelta(hours=6))
+    storage.upsert([treatment("late", 7, "Meal Bolus", insulin=3)], "treatments")
+    transformer = InsulinInjectionTransformer()
+
+    # Act
+    transformer.etl()
+
+    # Assert
+    assert transformer.result["insulin_injection_id"].tolist() == ["late"]
+    assert len(storage.find("insulin_injections")) == 6
+
+
+def test_etl_chunked(storage):
+    # Act
+    InsulinInjectionTransformer(chunk_size=2).etl()
+
+    # Assert
+    assert len(storage.find("insulin_injections")) == 5
+    assert storage.get_last_runmoment("insulin_injections") == to_local(
+        START + timedelta(hours=6)
+    )
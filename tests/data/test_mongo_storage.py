@@ -1,7 +1,8 @@
-from datetime import datetime
-from unittest.mock import Mock
+from datetime import datetime, timezone
+from unittest.mock import MagicMock, Mock
 
 import mongomock
+import pandas as pd
 import pytest
 from kink import di
 
@@ -187,3 +188,430 @@ def test_convert_query_is_used(mongo_storage):
 
     # Assert
     mongo_storage.convert_query.assert_called_once_with(query)
+
+
+def test_upsert_in_batches_returns_counts(mongo_storage):
+    """
+    Test that upserting in multiple batches reports the combined counts of all batches.
+    """
+    # Arrange
+    table_name = "test_table"
+    mongo_storage.batch_size = 2
+    mongo_storage.insert([{"key": 1, "value": "one"}], table_name)
+    data = [{"key": i, "value": str(i)} for i in range(1, 6)]
+
+    # Act
+    result = mongo_storage.upsert(iter(data), table_name)
+
+    # Assert
+    assert result.matched == 1
+    assert result.upserted == 4
+    assert result.modified == 1
+    assert len(mongo_storage.get(table_name)) == 5
+
+
+def test_upsert_coalesces_duplicate_keys(mongo_storage):
+    # Arrange
+    table_name = "test_table"
+    data = [{"key": 1, "value": "one"}, {"key": 1, "value": "two"}]
+
+    # Act
+    result = mongo_storage.upsert(data, table_name)
+
+    # Assert
+    assert result.upserted == 1
+    assert mongo_storage.find_one(table_name, [("key", "eq", 1)])["value"] == "two"
+
+
+def test_iter_find_chunks(mongo_storage):
+    # Arrange
+    table_name = "test_table"
+    mongo_storage.insert([{"key": i} for i in range(5)], table_name)
+
+    # Act
+    chunks = list(
+        mongo_storage.iter_find_chunks(table_name, sort=["key"], chunk_size=2)
+    )
+
+    # Assert
+    assert [[row["key"] for row in chunk] for chunk in chunks] == [[0, 1], [2, 3], [4]]
+
+
+def test_find_with_limit(mongo_storage):
+    # Arrange
+    table_name = "test_table"
+    mongo_storage.insert([{"key": i} for i in range(5)], table_name)
+
+    # Act
+    result = mongo_storage.find(table_name, sort=["key"], asc=False, limit=2)
+
+    # Assert
+    assert [row["key"] for row in result] == [4, 3]
+
+
+def test_find_with_columns(mongo_storage):
+    # Arrange
+    table_name = "test_table"
+    mongo_storage.insert([{"key": 1, "value": "one", "other": "x"}], table_name)
+
+    # Act
+    result = mongo_storage.find(table_name, columns=["key", "value"])
+
+    # Assert
+    assert result == [{"key": 1, "value": "one"}]
+
+
+def test_find_frame_uses_schema_dtypes(mongo_storage):
+    # Arrange
+    table_name = "test_table"
+    mongo_storage.metadata.get_table.return_value.json_schema = {
+        "items": {
+            "properties": {
+                "key": {"type": "integer"},
+                "value": {"type": ["number", "null"]},
+            }
+        }
+    }
+    mongo_storage.insert([{"key": 1, "value": 1.5}, {"key": 2}], table_name)
+
+    # Act
+    inferred = mongo_storage.find_frame(table_name, columns=["key", "value"])
+    result = mongo_storage.find_frame(
+        table_name, columns=["key", "value"], batch_size=1, typed=True
+    )
+
+    # Assert
+    assert str(inferred["key"].dtype) == "int64"
+    assert list(result["key"]) == [1, 2]
+    assert str(result["key"].dtype) == "Int64"
+    assert str(result["value"].dtype) == "float64"
+    assert result["value"].isna().tolist() == [False, True]
+
+
+def test_set_indexes_from_metadata(mongo_storage, mongo):
+    # Arrange
+    mongo_storage.metadata.tables = [
+        TableMetadata(
+            name="test_table",
+            key_col="key",
+            timestamp_col="timestamp",
+            type="test_table",
+            indexes=[
+                {"keys": ["key"], "unique": True},
+                {"keys": ["type", ["timestamp", -1]]},
+            ],
+        )
+    ]
+
+    # Act
+    mongo_storage.set_indexes()
+    mongo_storage.set_indexes()
+
+    # Assert
+    keys = [
+        index["key"]
+        for index in mongo["test_database"]["test_table"].index_information().values()
+    ]
+    assert [("key", 1)] in keys
+    assert [("type", 1), ("timestamp", -1)] in keys
+
+
+def test_warns_about_unindexed_query(mongo_storage):
+    # Arrange
+    mongo_storage.logger = Mock()
+    mongo_storage.metadata.get_table.return_value.indexes = [{"keys": ["key"]}]
+
+    # Act
+    mongo_storage.find("test_table", [("key", "eq", 1)])
+    mongo_storage.find("test_table", [("value", "eq", 1)])
+    mongo_storage.find("test_table", [("value", "eq", 2)])
+
+    # Assert
+    mongo_storage.logger.warning.assert_called_once()
+
+
+def test_timestamp_col_is_stored_as_utc_datetime(mongo_storage):
+    # Arrange
+    table_name = "test_table"
+    data = [{"key": 1, "timestamp": "2023-07-28T12:00:00+02:00"}]
+
+    # Act
+    mongo_storage.upsert(data, table_name)
+    result = mongo_storage.find(
+        table_name, [("timestamp", "gt", datetime(2023, 7, 28, 9, tzinfo=timezone.utc))]
+    )
+
+    # Assert
+    assert result[0]["timestamp"] == datetime(2023, 7, 28, 10)
+
+
+def test_overwrite_stores_timestamp_col_as_utc_datetime(mongo_storage):
+    # Arrange
+    table_name = "test_table"
+    data = pd.DataFrame({"key": [1], "timestamp": ["2023-07-28T12:00:00+02:00"]})
+
+    # Act
+    mongo_storage.overwrite(data, table_name)
+    result = mongo_storage.find(
+        table_name, [("timestamp", "gt", datetime(2023, 7, 28, 9, tzinfo=timezone.utc))]
+    )
+
+    # Assert
+    assert result[0]["timestamp"] == datetime(2023, 7, 28, 10)
+    assert data["timestamp"][0] == "2023-07-28T12:00:00+02:00"
+
+
+def test_migrate_timestamps(mongo_storage, mongo):
+    # Arrange
+    table_name = "test_table"
+    mongo["test_database"][table_name].insert_many(
+        [
+            {"key": 1, "timestamp": "2023-07-28T12:00:00+02:00", "value": "one"},
+            {"key": 2, "timestamp": datetime(2023, 7, 28, 11)},
+        ]
+    )
+
+    # Act
+    migrated = mongo_storage.migrate_timestamps(table_name)
+    result = mongo_storage.find(table_name, sort=["key"])
+
+    # Assert
+    assert migrated == 1
+    assert [row["timestamp"] for row in result] == [
+        datetime(2023, 7, 28, 10),
+        datetime(2023, 7, 28, 11),
+    ]
+    assert result[0]["value"] == "one"
+
+
+@pytest.fixture
+def bucketed_storage(mongo_storage):
+    mongo_storage.metadata.get_table.return_value = TableMetadata(
+        name="test_table",
+        key_col="key",
+        timestamp_col="timestamp",
+        type="test_table",
+        bucket_col="time",
+        bucket_hours=24,
+    )
+    return mongo_storage
+
+
+def test_bucketed_upsert_and_find(bucketed_storage, mongo):
+    # Arrange
+    table_name = "test_table"
+    day = datetime(2023, 7, 28, tzinfo=timezone.utc)
+    data = [
+        {"key": 1, "time": day.replace(hour=1), "value": "one"},
+        {"key": 2, "time": day.replace(hour=2), "value": "two"},
+        {"key": 3, "time": day.replace(day=29, hour=1), "value": "three"},
+    ]
+    moved = [{"key": 1, "time": day.replace(day=29, hour=2), "value": "moved"}]
+
+    # Act
+    first = bucketed_storage.upsert(data, table_name)
+    second = bucketed_storage.upsert(moved, table_name)
+    result = bucketed_storage.find(
+        table_name,
+        [("time", "gte", day.replace(day=29))],
+        ["time"],
+        columns=["key", "value"],
+    )
+
+    # Assert
+    assert mongo["test_database"][table_name].count_documents({}) == 2
+    assert (first.upserted, second.matched, second.upserted) == (3, 1, 0)
+    assert result == [{"key": 3, "value": "three"}, {"key": 1, "value": "moved"}]
+    assert len(bucketed_storage.find(table_name, [("key", "eq", 1)])) == 1
+
+
+def test_migrate_layout(bucketed_storage, mongo):
+    # Arrange
+    table_name = "test_table"
+    time = datetime(2023, 7, 28, 1, tzinfo=timezone.utc)
+    mongo["test_database"][table_name].insert_many(
+        [{"key": 1, "time": time}, {"key": 2, "time": time.replace(hour=2)}]
+    )
+
+    # Act
+    moved = bucketed_storage.migrate_layout(table_name)
+    result = bucketed_storage.find(table_name, sort=["key"], columns=["key"])
+
+    # Assert
+    assert moved == 2
+    assert mongo["test_database"][table_name].count_documents({}) == 1
+    assert result == [{"key": 1}, {"key": 2}]
+
+
+def test_bucketed_partial_upsert_keeps_columns(bucketed_storage):
+    # Arrange
+    table_name = "test_table"
+    time = datetime(2023, 7, 28, 1, tzinfo=timezone.utc)
+    bucketed_storage.upsert(
+        [{"key": 1, "time": time, "value": "one", "extra": 1}], table_name
+    )
+
+    # Act
+    result = bucketed_storage.upsert([{"key": 1, "value": "updated"}], table_name)
+    rows = bucketed_storage.find(table_name)
+
+    # Assert
+    assert (result.matched, result.upserted) == (1, 0)
+    assert len(rows) == 1
+    assert (rows[0]["value"], rows[0]["extra"]) == ("updated", 1)
+    assert rows[0]["time"] == time.replace(tzinfo=None)
+
+
+def test_migrate_timestamps_of_bucketed_table(bucketed_storage):
+    # Arrange
+    table_name = "test_table"
+    time = datetime(2023, 7, 28, 1, tzinfo=timezone.utc)
+    bucketed_storage.upsert([{"key": 1, "time": time, "value": "one"}], table_name)
+    bucketed_storage.database[table_name].update_one(
+        {}, {"$set": {"rows.0.timestamp": "2023-07-28T12:00:00+02:00"}}
+    )
+
+    # Act
+    migrated = bucketed_storage.migrate_timestamps(table_name)
+    rows = bucketed_storage.find(table_name)
+
+    # Assert
+    assert migrated == 1
+    assert (rows[0]["timestamp"], rows[0]["value"]) == (
+        datetime(2023, 7, 28, 10),
+        "one",
+    )
+
+
+def test_migrate_layout_normalizes_timestamps(bucketed_storage, mongo):
+    # Arrange
+    table_name = "test_table"
+    time = datetime(2023, 7, 28, 1, tzinfo=timezone.utc)
+    mongo["test_database"][table_name].insert_one(
+        {"key": 1, "time": time, "timestamp": "2023-07-28T12:00:00+02:00"}
+    )
+
+    # Act
+    bucketed_storage.migrate_layout(table_name)
+    rows = bucketed_storage.find(table_name)
+
+    # Assert
+    assert rows[0]["timestamp"] == datetime(2023, 7, 28, 10)
+
+
+def test_overwrite_swaps_staging_collection(mongo_storage, mongo):
+    # Arrange
+    table_name = "test_table"
+    mongo_storage.batch_size = 2
+    mongo_storage.metadata.get_table.return_value.indexes = [{"keys": ["key"]}]
+    mongo_storage.insert([{"key": 0}], table_name)
+    data = pd.DataFrame({"key": [1, 2, 3], "value": ["one", "two", "three"]})
+
+    # Act
+    mongo_storage.overwrite(data, table_name)
+
+    # Assert
+    database = mongo["test_database"]
+    assert [row["key"] for row in mongo_storage.find(table_name, sort=["key"])] == [
+        1,
+        2,
+        3,
+    ]
+    assert database.list_collection_names() == [table_name]
+    assert "key_1" in database[table_name].index_information()
+
+
+def test_failed_overwrite_keeps_table(mongo_storage, mongo):
+    # Arrange
+    table_name = "test_table"
+    mongo_storage.insert([{"key": 0}], table_name)
+    mongo_storage.metadata.get_table.return_value.indexes = [{"keys": ["key"]}]
+    mongo_storage._set_table_indexes = Mock(side_effect=RuntimeError)
+
+    # Act
+    with pytest.raises(RuntimeError):
+        mongo_storage.overwrite(pd.DataFrame({"key": [1]}), table_name)
+
+    # Assert
+    assert [row["key"] for row in mongo_storage.find(table_name)] == [0]
+    assert mongo["test_database"].list_collection_names() == [table_name]
+
+
+def test_upsert_skips_unchanged_rows(mongo_storage):
+    # Arrange
+    table_name = "test_table"
+    mongo_storage.metadata.get_table.return_value.detect_changes = True
+    data = [{"key": 1, "value": "one"}, {"key": 2, "value": "two"}]
+    mongo_storage.upsert(data, table_name)
+    updated_at = mongo_storage.find_one(table_name, [("key", "eq", 1)])["updated_at"]
+
+    # Act
+    unchanged = mongo_storage.upsert(data, table_name)
+    changed = mongo_storage.upsert(
+        [{"key": 1, "value": "one"}, {"key": 2, "value": "changed"}], table_name
+    )
+
+    # Assert
+    assert (unchanged.skipped, unchanged.matched) == (2, 0)
+    assert (changed.skipped, changed.modified) == (1, 1)
+    assert changed.get_skip_ratio() == 0.5
+    row = mongo_storage.find_one(table_name, [("key", "eq", 1)])
+    assert row["updated_at"] == updated_at
+
+
+def test_runmoments_are_cached(mongo_storage):
+    # Arrange
+    mongo_storage.metadata.get_table().key_col = "source"
+    timestamp = datetime(2023, 7, 28, 12)
+    mongo_storage.set_last_runmoment("one", timestamp)
+    mongo_storage.set_last_runmoment("two", timestamp)
+    mongo_storage.find_one = Mock(wraps=mongo_storage.find_one)
+
+    # Act
+    cached = [mongo_storage.get_last_runmoment(s) for s in ["one", "two", "one"]]
+    mongo_storage.runmoment_ttl = 0
+    expired = mongo_storage.get_last_runmoment("one")
+
+    # Assert
+    assert cached == [timestamp] * 3
+    assert expired == timestamp
+    mongo_storage.find_one.assert_called_once()
+
+
+def test_aggregate_unwinds_buckets(bucketed_storage):
+    # Arrange
+    day = datetime(2023, 7, 28, tzinfo=timezone.utc)
+    data = [
+        {"key": 1, "time": day.replace(hour=1), "value": 1},
+        {"key": 2, "time": day.replace(day=29), "value": 2},
+    ]
+    bucketed_storage.upsert(data, "test_table")
+
+    # Act
+    result = bucketed_storage.aggregate(
+        "test_table",
+        [{"$match": {"value": {"$gt": 1}}}, {"$project": {"_id": 0, "key": 1}}],
+    )
+
+    # Assert
+    assert list(result) == [{"key": 2}]
+
+
+def test_merge_pipeline_groups_into_buckets(bucketed_storage, mongo):
+    # Arrange
+    bucketed_storage.database = MagicMock()
+    pipeline = [{"$match": {"value": 1}}]
+
+    # Act
+    bucketed_storage.merge_pipeline("source", pipeline, "test_table")
+
+    # Assert
+    stages = bucketed_storage.database["source"].aggregate.call_args.args[0]
+    assert [list(stage)[0] for stage in stages[-4:]] == [
+        "$match",
+        "$unset",
+        "$group",
+        "$merge",
+    ]
+    assert stages[-1]["$merge"]["into"] == "test_table"
+    assert stages[-1]["$merge"]["on"] == "_id"
@@ -0,0 +1,114 @@
+import json
+from datetime import datetime
+from unittest.mock import MagicMock, Mock
+
+import pytest
+
+from predicting_glucose_levels.data.ingestion.loader.nightscout_loader import (
+    NightscoutLoader,
+)
+from predicting_glucose_levels.helpers.streaming import iter_json_array
+
+ENTRIES = [
+    {"_id": "4", "dateString": "2023-07-28T12:15:00"},
+    {"_id": "3", "dateString": "2023-07-28T12:10:00"},
+    {"_id": "2", "dateString": "2023-07-28T12:10:00"},
+    {"_id": "1", "dateString": "2023-07-28T12:00:00"},
+]
+
+
+def fake_get(url, params, **kwargs):
+    """
+    Mimic the Nightscout API: filter on the dateString window, newest first, at most count entities.
+    """
+    rows = [
+        row
+        for row in ENTRIES
+        if params["find[dateString][$gte]"]
+        <= row["dateString"]
+        <= params["find[dateString][$lte]"]
+    ]
+    return Mock(status_code=200, json=Mock(return_value=rows[: params["count"]]))
+
+
+@pytest.fixture
+def loader():
+    loader = NightscoutLoader("https://nightscout", "secret")
+    loader.session = Mock()
+    loader.session.get.side_effect = fake_get
+    return loader
+
+
+def test_load_pages_yields_each_entity_once(loader):
+    # Act
+    pages = list(
+        loader.load_pages(
+            datetime(2023, 7, 28), datetime(2023, 7, 29), "entries", "dateString", 3
+        )
+    )
+
+    # Assert
+    assert all(len(page) <= 3 for page in pages)
+    assert [row["_id"] for page in pages for row in page] == ["4", "3", "2", "1"]
+
+
+def test_load_pages_fails_if_page_cannot_advance(loader):
+    # Act / Assert
+    with pytest.raises(Exception, match="Increase the page size"):
+        list(
+            loader.load_pages(
+                datetime(2023, 7, 28),
+                datetime(2023, 7, 28, 12, 10),
+                "entries",
+                "dateString",
+                1,
+            )
+        )
+
+
+def test_stream_decodes_pages_and_projects_columns(loader):
+    # Arrange
+    body = json.dumps(ENTRIES).encode()
+    response = MagicMock(status_code=200, encoding=None)
+    response.iter_content.return_value = (
+        body[i : i + 7] for i in range(0, len(body), 7)
+    )
+    loader.session.get.side_effect = None
+    loader.session.get.return_value = response
+    loader.stream = True
+
+    # Act
+    pages = list(
+        loader.load_pages(
+            datetime(2023, 7, 28),
+            datetime(2023, 7, 29),
+            "entries",
+            "dateString",
+            3,
+            columns=["_id"],
+        )
+    )
+
+    # Assert
+    assert pages == [[{"_id": "4"}, {"_id": "3"}, {"_id": "2"}], [{"_id": "1"}]]
+    response.json.assert_not_called()
+
+
+def test_iter_json_array_decodes_chunks_split_at_every_offset():
+    # Arrange
+    text = '[{"sgv":120,"delta":-1.5e-3},-45000000000.0E0,12E10, "a,]",[true,null],7]'
+    elements = [
+        {"sgv": 120, "delta": -0.0015},
+        -45000000000.0,
+        12e10,
+        "a,]",
+        [True, None],
+        7,
+    ]
+
+    for offset in range(len(text) + 1):
+        # Act
+        result = list(iter_json_array([text[:offset], text[offset:]]))
+
+        # Assert
+        assert result == elements, offset
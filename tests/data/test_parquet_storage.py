@@ -0,0 +1,222 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from unittest.mock import Mock
+
+import pandas as pd
+import pytest
+
+from predicting_glucose_levels.data.metadata import Metadata
+from predicting_glucose_levels.data.storage.parquet_storage import ParquetStorage
+from predicting_glucose_levels.data.table_metadata import TableMetadata
+
+
+@pytest.fixture
+def parquet_storage(tmp_path):
+    metadata = Mock(spec=Metadata)
+    metadata.get_table.return_value = TableMetadata(
+        name="test_table", key_col="key", timestamp_col="timestamp", type="test_table"
+    )
+    storage = ParquetStorage(str(tmp_path), metadata, Mock())
+    storage.setup()
+    return storage
+
+
+def moment(month: int, day: int = 1) -> datetime:
+    return datetime(2023, month, day, tzinfo=timezone.utc)
+
+
+def test_upsert_and_find(parquet_storage, tmp_path):
+    # Arrange
+    table_name = "test_table"
+    data = [
+        {"key": 1, "timestamp": moment(1), "value": "one"},
+        {"key": 2, "timestamp": moment(2), "value": "two"},
+        {"key": 3, "timestamp": moment(2, 15), "value": "three"},
+    ]
+
+    # Act
+    result = parquet_storage.upsert(data, table_name)
+    rows = parquet_storage.find(
+        table_name, [("timestamp", "gte", moment(2))], ["timestamp"], False
+    )
+
+    # Assert
+    assert result.upserted == 3
+    assert sorted(p.name for p in (tmp_path / table_name).iterdir()) == [
+        "2023-01.parquet",
+        "2023-02.parquet",
+    ]
+    assert [row["key"] for row in rows] == [3, 2]
+
+
+def test_query_prunes_partitions(parquet_storage):
+    # Arrange
+    table_name = "test_table"
+    data = [{"key": m, "timestamp": moment(m)} for m in range(1, 7)]
+    parquet_storage.upsert(data, table_name)
+    parquet_storage._read_table = Mock(wraps=parquet_storage._read_table)
+
+    # Act
+    rows = parquet_storage.find(
+        table_name,
+        [("timestamp", "gt", moment(3)), ("timestamp", "lt", moment(5))],
+        columns=["key"],
+    )
+
+    # Assert
+    assert rows == [{"key": 4}]
+    read = [call.args[0][-15:] for call in parquet_storage._read_table.call_args_list]
+    assert read == ["2023-03.parquet", "2023-04.parquet", "2023-05.parquet"]
+
+
+def test_upsert_merges_and_moves_rows(parquet_storage):
+    # Arrange
+    table_name = "test_table"
+    parquet_storage.upsert(
+        [{"key": 1, "timestamp": moment(1), "value": "one", "extra": 1}], table_name
+    )
+
+    # Act
+    result = parquet_storage.upsert(
+        [{"key": 1, "timestamp": moment(3), "value": "moved"}], table_name
+    )
+    rows = parquet_storage.find(table_name)
+
+    # Assert
+    assert (result.matched, result.upserted, result.modified) == (1, 0, 1)
+    assert len(rows) == 1
+    assert (rows[0]["value"], rows[0]["extra"]) == ("moved", 1)
+    assert parquet_storage._get_partitions(table_name, []) == [
+        parquet_storage._get_path(f"{parquet_storage.directory}/test_table", "2023-03")
+    ]
+
+
+def test_find_frame_and_overwrite(parquet_storage):
+    # Arrange
+    table_name = "test_table"
+    data = pd.DataFrame(
+        {
+            "key": [1, 2, 3],
+            "timestamp": [moment(2), moment(1), moment(3)],
+            "value": [1, None, 3],
+        }
+    ).astype({"value": "Int64"})
+
+    # Act
+    parquet_storage.overwrite(data, table_name)
+    frame = parquet_storage.find_frame(
+        table_name, [("value", "ne", 3)], ["timestamp"], columns=["key", "value"]
+    )
+
+    # Assert
+    assert frame["key"].tolist() == [2, 1]
+    assert str(frame["value"].dtype) == "Int64"
+
+
+def test_runmoments_round_trip(parquet_storage):
+    # Arrange
+    parquet_storage.metadata.get_table.return_value = TableMetadata(
+        name="runmoments", key_col="source", timestamp_col="timestamp", type="config"
+    )
+    timestamp = datetime(2023, 7, 28, 12)
+
+    # Act
+    parquet_storage.set_last_runmoment("entries", timestamp)
+    parquet_storage.set_last_runmoment("entries", timestamp.replace(month=8))
+
+    # Assert
+    assert parquet_storage.get_last_runmoment("entries") == timestamp.replace(month=8)
+    assert len(parquet_storage.find("runmoments")) == 1
+
+
+def test_upsert_rows_with_different_columns(parquet_storage):
+    # Arrange
+    parquet_storage.metadata.get_table.return_value = TableMetadata(
+        name="test_table",
+        key_col="key",
+        timestamp_col="timestamp",
+        type="test_table",
+        json_schema={
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "carbs": {"type": ["string", "null"]},
+                    "insulin": {"type": "number"},
+                },
+            },
+        },
+    )
+    table_name = "test_table"
+    data = [
+        {"key": 1, "timestamp": moment(1), "carbs": "20"},
+        {"key": 2, "timestamp": moment(1, 2), "carbs": 15, "insulin": 1.5},
+    ]
+
+    # Act
+    parquet_storage.upsert(data, table_name)
+    parquet_storage.upsert(
+        [{"key": 3, "timestamp": moment(1, 3), "notes": "note"}], table_name
+    )
+    rows = parquet_storage.find(table_name, sort=["timestamp"])
+
+    # Assert
+    assert [(r["carbs"], r["insulin"], r["notes"]) for r in rows] == [
+        ("20", None, None),
+        ("15", 1.5, None),
+        (None, None, "note"),
+    ]
+
+
+def test_upsert_raises_on_mixed_types_without_schema(parquet_storage, tmp_path):
+    # Arrange
+    table_name = "test_table"
+    data = [
+        {"key": 1, "timestamp": moment(1), "carbs": "20"},
+        {"key": 2, "timestamp": moment(1, 2), "carbs": 15},
+    ]
+
+    # Act
+    with pytest.raises(ValueError, match="carbs"):
+        parquet_storage.upsert(data, table_name)
+
+    # Assert
+    assert not list((tmp_path / table_name).glob("*.parquet"))
+
+
+def test_concurrent_upserts(parquet_storage):
+    # Arrange
+    parquet_storage.metadata.get_table.return_value = TableMetadata(
+        name="runmoments", key_col="source", timestamp_col="timestamp", type="config"
+    )
+    timestamp = datetime(2023, 7, 28, 12)
+
+    # Act
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(
+            executor.map(
+                lambda i: parquet_storage.set_last_runmoment(
+                    f"source_{i}", timestamp + timedelta(minutes=i)
+                ),
+                range(32),
+            )
+        )
+
+    # Assert
+    assert len(parquet_storage.find("runmoments")) == 32
+
+
+def test_upsert_reads_keys_once(parquet_storage):
+    # Arrange
+    table_name = "test_table"
+    parquet_storage._read_keys = Mock(wraps=parquet_storage._read_keys)
+
+    # Act
+    for key in range(3):
+        parquet_storage.upsert([{"key": key, "timestamp": moment(1)}], table_name)
+    parquet_storage.upsert([{"key": 0, "timestamp": moment(2)}], table_name)
+    rows = parquet_storage.find(table_name, sort=["key"])
+
+    # Assert
+    parquet_storage._read_keys.assert_called_once()
+    assert [(r["key"], r["timestamp"].month) for r in rows] == [(0, 2), (1, 1), (2, 1)]
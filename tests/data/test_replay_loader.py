@@ -0,0 +1,66 @@
+from datetime import datetime, timedelta
+from unittest.mock import Mock
+
+import pytest
+
+from predicting_glucose_levels.data.ingestion.loader.abstract_loader import (
+    AbstractLoader,
+)
+from predicting_glucose_levels.data.ingestion.loader.replay_loader import ReplayLoader
+
+START = datetime(2023, 7, 1)
+ENTRIES = [
+    {"_id": str(i), "dateString": (START + timedelta(minutes=5 * i)).isoformat()}
+    for i in range(100)
+]
+
+
+@pytest.fixture
+def loader(tmp_path):
+    # Record in reverse order, like Nightscout returns entries
+    ReplayLoader.write(tmp_path, "entries", "dateString", ENTRIES[::-1], block_size=7)
+    return ReplayLoader(tmp_path)
+
+
+def test_load_window(loader):
+    # Act
+    result = loader.load(
+        START + timedelta(minutes=50),
+        START + timedelta(minutes=100),
+        "entries",
+        "dateString",
+    )
+
+    # Assert
+    assert [row["_id"] for row in result] == [str(i) for i in range(10, 21)]
+
+
+def test_load_pages_with_columns(loader):
+    # Act
+    pages = list(
+        loader.load_pages(
+            START, START + timedelta(days=1), "entries", "dateString", 40, ["_id"]
+        )
+    )
+
+    # Assert
+    assert [len(page) for page in pages] == [40, 40, 20]
+    assert pages[0][0] == {"_id": "0"}
+
+
+def test_record(tmp_path):
+    # Arrange
+    source = Mock(spec=AbstractLoader)
+    source.load.return_value = ENTRIES
+
+    # Act
+    recorded = ReplayLoader.record(
+        source, tmp_path, START, START + timedelta(days=1), "entries", "dateString"
+    )
+    result = ReplayLoader(tmp_path).load(
+        START, START + timedelta(days=1), "entries", "dateString"
+    )
+
+    # Assert
+    assert recorded == 100
+    assert result == ENTRIES
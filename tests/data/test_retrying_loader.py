@@ -0,0 +1,126 @@
+from datetime import datetime, timedelta
+from unittest.mock import Mock
+
+import pytest
+
+from predicting_glucose_levels.data.ingestion.loader.abstract_loader import (
+    AbstractLoader,
+    LoaderError,
+    LoaderTimeout,
+)
+from predicting_glucose_levels.data.ingestion.loader.retrying_loader import (
+    RetryingLoader,
+)
+
+START = datetime(2023, 7, 1)
+END = datetime(2023, 7, 3)
+
+
+@pytest.fixture
+def inner():
+    return Mock(spec=AbstractLoader)
+
+
+@pytest.fixture
+def loader(inner):
+    return RetryingLoader(
+        inner, Mock(), retries=2, backoff=0, min_span=timedelta(days=1)
+    )
+
+
+def test_retries_transient_errors(loader, inner):
+    # Arrange
+    inner.load.side_effect = [LoaderError("502"), [{"key": 1}]]
+
+    # Act
+    result = loader.load(START, END, "entries", "dateString")
+
+    # Assert
+    assert result == [{"key": 1}]
+    assert loader.stats.retries == 1
+    assert loader.stats.splits == 0
+
+
+def test_bisects_window_on_timeout(loader, inner):
+    # Arrange
+    def load(start, end, endpoint, timestamp_col, columns=None):
+        if end - start > timedelta(days=1):
+            raise LoaderTimeout("timeout")
+        return [{"start": start}]
+
+    inner.load.side_effect = load
+
+    # Act
+    result = loader.load(START, END, "entries", "dateString")
+
+    # Assert
+    assert result == [{"start": START}, {"start": START + timedelta(days=1)}]
+    assert loader.stats.splits == 1
+
+
+def test_raises_non_retryable_errors(loader, inner):
+    # Arrange
+    inner.load.side_effect = LoaderError("401", retryable=False)
+
+    # Act / Assert
+    with pytest.raises(LoaderError, match="401"):
+        loader.load(START, START + timedelta(hours=1), "entries", "dateString")
+    assert inner.load.call_count == 1
+
+
+def test_does_not_split_on_non_retryable_errors(loader, inner):
+    # Arrange
+    loader.retries = 0
+    inner.load.side_effect = LoaderError("401", retryable=False)
+
+    # Act / Assert
+    with pytest.raises(LoaderError, match="401"):
+        loader.load(START, END, "entries", "dateString")
+    assert inner.load.call_count == 1
+    assert loader.stats.splits == 0
+
+
+def test_retries_only_failed_sub_windows(loader, inner):
+    # Arrange
+    middle = START + timedelta(days=1)
+    error = LoaderError("502")
+    error.failed_windows = [(middle, END)]
+    error.rows = [{"key": 1}]
+    inner.load.side_effect = [error, [{"key": 2}]]
+
+    # Act
+    result = loader.load(START, END, "entries", "dateString")
+
+    # Assert
+    assert result == [{"key": 1}, {"key": 2}]
+    assert inner.load.call_args.args[:2] == (middle, END)
+    assert loader.stats.retries == 1
+
+
+def test_slow_windows_shrink_next_windows(loader, inner):
+    # Arrange
+    loader.latency_budget = -1
+    inner.load.return_value = []
+
+    # Act
+    loader.load(START, START + timedelta(days=4), "entries", "dateString")
+    loader.load(START, START + timedelta(days=4), "entries", "dateString")
+
+    # Assert
+    assert loader.max_span == timedelta(days=1)
+    assert inner.load.call_count == 1 + 2
+
+
+def test_slow_paged_windows_shrink_next_windows(loader, inner):
+    # Arrange
+    loader.latency_budget = -1
+    inner.load_pages.side_effect = lambda *args: iter([[{"key": 1}], []])
+
+    # Act
+    pages = list(loader.load_pages(START, START + timedelta(days=4), "e", "t", 10))
+    list(loader.load_pages(START, START + timedelta(days=4), "e", "t", 10))
+
+    # Assert
+    assert pages == [[{"key": 1}], []]
+    assert loader.max_span == timedelta(days=1)
+    assert inner.load_pages.call_count == 1 + 2
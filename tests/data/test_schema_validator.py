@@ -0,0 +1,111 @@
+from datetime import datetime
+from unittest.mock import Mock
+
+import pandas as pd
+import pytest
+
+from predicting_glucose_levels.data.metadata import Metadata
+from predicting_glucose_levels.data.table_metadata import TableMetadata
+from predicting_glucose_levels.data.transformation.transformer.validators.schema_validator import (
+    SchemaValidationError,
+    SchemaValidator,
+)
+
+SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {
+            "_id": {"type": "string"},
+            "dateString": {"type": "datetime"},
+            "sgv": {"type": "integer"},
+            "mbg": {"type": "number"},
+            "type": {"type": "string", "enum": ["sgv", "mbg"]},
+        },
+        "oneOf": [{"required": ["mbg"]}, {"required": ["sgv"]}],
+        "required": ["_id", "dateString", "type"],
+    },
+}
+ROWS = [
+    {"_id": "a", "dateString": datetime(2023, 7, 28), "sgv": 100, "type": "sgv"},
+    {"_id": "b", "dateString": datetime(2023, 7, 28), "mbg": 5.5, "type": "mbg"},
+]
+INVALID = [
+    {"_id": 1, "dateString": datetime(2023, 7, 28), "sgv": 100, "type": "sgv"},
+    {"_id": "d", "dateString": "2023-07-28", "sgv": 1.5, "mbg": 1, "type": "cal"},
+    {"dateString": datetime(2023, 7, 28), "sgv": 100, "type": "sgv"},
+]
+EXPECTED = {
+    "_id: type": 1,
+    "dateString: type": 1,
+    "sgv: type": 1,
+    "type: enum": 1,
+    "oneOf": 1,
+    "_id: required": 1,
+}
+
+
+@pytest.fixture
+def validator():
+    metadata = Mock(spec=Metadata)
+    metadata.get_table.return_value = TableMetadata(
+        name="entries", key_col="_id", timestamp_col="dateString", type="source"
+    )
+    metadata.get_table.return_value.json_schema = SCHEMA
+    return SchemaValidator(metadata)
+
+
+def test_valid_rows_pass(validator):
+    validator.validate("entries", ROWS)
+    validator.validate_frame("entries", pd.DataFrame(ROWS))
+
+
+def test_violations_are_counted_per_rule(validator):
+    # Act
+    with pytest.raises(SchemaValidationError) as rows_error:
+        validator.validate("entries", ROWS + INVALID)
+    with pytest.raises(SchemaValidationError) as frame_error:
+        validator.validate_frame("entries", pd.DataFrame(ROWS + INVALID))
+
+    # Assert
+    assert rows_error.value.errors == EXPECTED
+    assert frame_error.value.errors == EXPECTED
+    assert rows_error.value.rows == frame_error.value.rows == 5
+
+
+def test_validator_is_compiled_once(validator):
+    # Act
+    validator.validate("entries", ROWS, ["_id", "sgv"])
+    validator.validate("entries", ROWS, ["_id", "sgv"])
+
+    # Assert
+    validator.metadata.get_table.assert_called_once()
+
+
+def test_sample_and_max_errors(validator):
+    # Arrange
+    rows = [{**ROWS[0], "_id": i} for i in range(100)]
+    validator.sample_size = 10
+
+    # Act
+    with pytest.raises(SchemaValidationError) as sampled:
+        validator.validate_frame("entries", pd.DataFrame(rows))
+    validator.max_errors = 3
+    with pytest.raises(SchemaValidationError) as limited:
+        validator.validate("entries", rows)
+
+    # Assert
+    assert sampled.value.errors == {"_id: type": 10}
+    assert limited.value.errors == {"_id: type": 3}
+
+
+def test_validate_frame_stops_at_max_errors(validator):
+    # Arrange
+    validator.max_errors = 2
+
+    # Act
+    with pytest.raises(SchemaValidationError) as error:
+        validator.validate_frame("entries", pd.DataFrame(INVALID))
+
+    # Assert
+    assert error.value.errors == {"_id: required": 1, "_id: type": 1}
@@ -0,0 +1,118 @@
+from threading import Barrier
+from unittest.mock import Mock
+
+import pytest
+
+from predicting_glucose_levels.data.ingestion.ingester import Ingester
+from predicting_glucose_levels.data.metadata import Metadata
+from predicting_glucose_levels.data.table_metadata import TableMetadata
+from predicting_glucose_levels.data.transformation.scheduler import (
+    TransformationError,
+    TransformationScheduler,
+)
+
+SOURCES = ["entries", "treatments"]
+
+
+def make_transformer(name, sources, destinations, etl):
+    return type(
+        name,
+        (),
+        {
+            "source_tables": sources,
+            "destination_tables": destinations,
+            "ingest_sources": True,
+            "etl": lambda self: etl(name),
+        },
+    )
+
+
+@pytest.fixture
+def ingester():
+    return Mock(spec=Ingester)
+
+
+@pytest.fixture
+def scheduler(ingester):
+    metadata = Mock(spec=Metadata)
+    metadata.get_table.side_effect = lambda table: TableMetadata(
+        name=table,
+        key_col="key",
+        timestamp_col="timestamp",
+        type="source_table" if table in SOURCES else "destination_table",
+    )
+    return TransformationScheduler(ingester, metadata, Mock(), max_workers=2)
+
+
+def test_dependencies_are_sorted():
+    # Arrange
+    a = make_transformer("A", ["entries"], ["x"], print)
+    b = make_transformer("B", ["x", "y"], ["z"], print)
+    c = make_transformer("C", ["treatments"], ["y"], print)
+
+    # Act
+    result = TransformationScheduler.get_dependencies([b, c, a])
+
+    # Assert
+    assert list(result) == [c, a, b]
+    assert result[b] == [a, c]
+
+
+def test_cyclic_dependencies_raise():
+    # Arrange
+    a = make_transformer("A", ["y"], ["x"], print)
+    b = make_transformer("B", ["x"], ["y"], print)
+
+    # Act & Assert
+    with pytest.raises(Exception, match="depend on each other"):
+        TransformationScheduler.get_dependencies([a, b])
+
+
+def test_run_ingests_sources_once_and_respects_dependencies(scheduler, ingester):
+    # Arrange
+    calls = []
+    a = make_transformer("A", ["entries"], ["x"], calls.append)
+    b = make_transformer("B", ["entries", "x"], ["y"], calls.append)
+    c = make_transformer("C", ["treatments"], ["z"], calls.append)
+
+    # Act
+    scheduler.run([b, c, a], chunk_size=10)
+
+    # Assert
+    ingester.ingest.assert_called_once()
+    assert sorted(t.name for t in ingester.ingest.call_args.args[0]) == SOURCES
+    assert calls.index("A") < calls.index("B")
+    assert sorted(calls) == ["A", "B", "C"]
+
+
+def test_independent_transformers_run_concurrently(scheduler):
+    # Arrange
+    barrier = Barrier(2, timeout=5)
+    a = make_transformer("A", ["entries"], ["x"], lambda _: barrier.wait())
+    b = make_transformer("B", ["treatments"], ["y"], lambda _: barrier.wait())
+
+    # Act
+    scheduler.run([a, b])
+
+    # Assert
+    assert not barrier.broken
+
+
+def test_failure_skips_dependents(scheduler):
+    # Arrange
+    calls = []
+
+    def fail(name):
+        raise Exception("Failed")
+
+    a = make_transformer("A", ["entries"], ["x"], fail)
+    b = make_transformer("B", ["x"], ["y"], calls.append)
+    c = make_transformer("C", ["treatments"], ["z"], calls.append)
+
+    # Act
+    with pytest.raises(TransformationError) as error:
+        scheduler.run([a, b, c])
+
+    # Assert
+    assert calls == ["C"]
+    assert set(error.value.errors) == {"A", "B"}